@@ -0,0 +1,101 @@
+"""Compares payload size and decode time of categories tree cache entry formats:
+pickled model instances (as before records), pickled records and columnar (see SITECATS_CACHE_PACK).
+Decode time includes assembling of the tree cache structure (records and lookup indexes).
+Also shows the time to map a snapshot file (see SITECATS_CACHE_MMAP_DIR).
+
+No DB is required:
+
+    python benchmarks/cache_pack.py [categories_number]
+
+"""
+import os
+import pickle
+import sys
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from os.path import dirname, abspath
+from random import randint, seed
+from timeit import timeit
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import django  # noqa
+from django.conf import settings  # noqa
+
+settings.configure(
+    INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes', 'sitecats'],
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+)
+django.setup()
+
+from sitecats.models import Category  # noqa
+from sitecats.packing import pack_records, unpack_records  # noqa
+from sitecats.records import CategoryRecord  # noqa
+from sitecats.snapshot import Snapshot, write_snapshot  # noqa
+from sitecats.utils import Cache  # noqa
+
+CATEGORIES_NUM = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+
+def get_records():
+    seed(1)
+    records = []
+    now = datetime(2021, 1, 1)
+    # Values of fields not in CategoryRecord.FIELDS.
+    extra = {'creator_id': 1, 'time_created': now, 'time_modified': now, 'ties_count': 0}
+    extra = [extra[attname] for attname in CategoryRecord.get_attnames(Category)[len(CategoryRecord.FIELDS):]]
+
+    for idx in range(1, CATEGORIES_NUM + 1):
+        parent_id = randint(1, idx - 1) if idx > 10 else None
+        records.append(CategoryRecord(Category, (
+            idx, f'alias{idx}' if idx % 10 == 0 else None, f'Category {idx}', parent_id, idx,
+            'Some note' if idx % 3 else '', None, None, False, *extra)))
+
+    return records
+
+
+def main():
+    cache = Cache.__new__(Cache)  # Signals are not required.
+    records = get_records()
+
+    def assemble(items):
+        return cache._cache_assemble('version', items)
+
+    def unpack(data):
+        return cache._cache_assemble(*unpack_records(data, Category))
+
+    tree = assemble(records)
+    tree_index = tree[cache.CACHE_NAME_TREE_ORDER], tree[cache.CACHE_NAME_TREE_SPANS]
+
+    # Tree as it was stored before records: model instances.
+    instances = {record.id: record.hydrate() for record in records}
+    tree_instances = dict(tree)
+    tree_instances[cache.CACHE_NAME_IDS] = instances
+    tree_instances[cache.CACHE_NAME_ALIASES] = {
+        alias: instances[record.id] for alias, record in tree[cache.CACHE_NAME_ALIASES].items()}
+
+    payloads = {
+        'pickle (model instances)': (pickle.dumps(tree_instances, pickle.HIGHEST_PROTOCOL), pickle.loads),
+        'pickle (records)': (pickle.dumps(tree, pickle.HIGHEST_PROTOCOL), pickle.loads),
+        'columnar': (pack_records('version', records, Category, tree=tree_index), unpack),
+        'columnar + zlib': (pack_records('version', records, Category, tree=tree_index, compress=True), unpack),
+    }
+
+    print(f'Categories: {CATEGORIES_NUM}')
+
+    for name, (payload, decode) in payloads.items():
+        elapsed = timeit(lambda: decode(payload), number=5) / 5
+        print(f'{name}: {len(payload) / 1024:.0f} KB, decode {elapsed * 1000:.0f} ms')
+
+    with TemporaryDirectory() as directory:
+        path = write_snapshot(directory, 'version', records, Category, tree_index)
+        names = {name: name for name in (
+            'ids', 'aliases', 'parents', 'version', 'child_parents',
+            'parent_ranks', 'titles', 'tree_order', 'tree_spans')}
+
+        elapsed = timeit(lambda: Snapshot(path, Category).get_structure(names), number=5) / 5
+        print(f'snapshot (mmap): {os.path.getsize(path) / 1024:.0f} KB, map {elapsed * 1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
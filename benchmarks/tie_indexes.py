@@ -0,0 +1,110 @@
+"""Compares query plans and timings of hot ties queries with and without
+composite ties indexes (see sitecats/migrations/0003_tie_indexes.py).
+
+Uses in-memory SQLite database:
+
+    python benchmarks/tie_indexes.py [ties_number]
+
+"""
+import sys
+from os.path import dirname, abspath
+from random import randint, seed
+from timeit import timeit
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import django  # noqa
+from django.conf import settings  # noqa
+
+settings.configure(
+    INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes', 'sitecats'],
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+)
+django.setup()
+
+from django.contrib.auth.models import User  # noqa
+from django.contrib.contenttypes.models import ContentType  # noqa
+from django.core.management import call_command  # noqa
+from django.db import connection  # noqa
+from django.db.models import Count  # noqa
+
+from sitecats.models import Category, Tie  # noqa
+
+TIES_NUM = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+CATEGORIES_NUM = 500
+OBJECTS_NUM = TIES_NUM // 5
+INDEXES = ['sitecats_tie_ct_obj', 'sitecats_tie_ct_cat']
+
+
+def fill():
+    seed(1)
+    call_command('migrate', verbosity=0)
+
+    user = User.objects.create(username='bench')
+    Category.objects.bulk_create([
+        Category(title=f'cat{idx}', creator=user, sort_order=idx) for idx in range(CATEGORIES_NUM)])
+
+    category_ids = list(Category.objects.values_list('id', flat=True))
+    ctypes = list(ContentType.objects.values_list('id', flat=True))
+
+    Tie.objects.bulk_create([
+        Tie(
+            category_id=category_ids[randint(0, CATEGORIES_NUM - 1)],
+            content_type_id=ctypes[randint(0, len(ctypes) - 1)],
+            object_id=randint(1, OBJECTS_NUM),
+            creator=user,
+        ) for _ in range(TIES_NUM)
+    ], batch_size=5000)
+
+    cursor = connection.cursor()
+    cursor.execute('ANALYZE')
+
+    return ctypes[0], category_ids[:20]
+
+
+def get_queries(ctype_id, category_ids):
+    ties = Tie.objects
+
+    return {
+        # get_category_lists(), remove_from_category()
+        'object categories': ties.filter(
+            content_type_id=ctype_id, object_id=OBJECTS_NUM // 2).values_list('category_id'),
+        # get_ties_for_categories_qs(), filter_by_categories()
+        'objects in categories': ties.filter(
+            content_type_id=ctype_id, category_id__in=category_ids).values('object_id'),
+        # get_ties_stats()
+        'ties stats': ties.filter(
+            content_type_id=ctype_id, category_id__in=category_ids).values(
+            'category_id').annotate(ties_num=Count('category')).order_by(),
+    }
+
+
+def run(title, queries):
+    print(f'\n=== {title} ===')
+    cursor = connection.cursor()
+
+    for name, qs in queries.items():
+        sql, params = qs.query.sql_with_params()
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        plan = '; '.join(row[-1] for row in cursor.fetchall())
+
+        elapsed = timeit(lambda: list(qs.all()), number=20) / 20
+
+        print(f'{name}: {elapsed * 1000:.2f} ms\n    {plan}')
+
+
+def main():
+    queries = get_queries(*fill())
+
+    run('With composite indexes', queries)
+
+    cursor = connection.cursor()
+    for index in INDEXES:
+        cursor.execute(f'DROP INDEX {index}')
+    cursor.execute('ANALYZE')
+
+    run('Without composite indexes', queries)
+
+
+if __name__ == '__main__':
+    main()
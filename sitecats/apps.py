@@ -1,4 +1,7 @@
 from django.apps import AppConfig
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, router
+from django.db.models.signals import post_migrate
 from django.utils.translation import gettext_lazy as _
 
 
@@ -14,6 +17,49 @@ class SitecatsConfig(AppConfig):
         return self._cat_cache
 
     def ready(self):
-        """Instantiate global cache object when ready."""
-        from .utils import Cache
+        """Instantiate global cache object when ready. Preload categories tree if required."""
+        from .settings import CACHE_SHARDED, CACHE_PRELOAD, TIES_COUNT, TIES_UNIQUE
+
+        if TIES_COUNT:
+            from .models import CategoryTiesCountMixin
+            from .utils import get_category_model
+
+            if not issubclass(get_category_model(), CategoryTiesCountMixin):
+                raise ImproperlyConfigured(
+                    'SITECATS_TIES_COUNT requires category model to inherit from CategoryTiesCountMixin.')
+
+        if TIES_UNIQUE:
+            from .utils import get_tie_model
+
+            post_migrate.connect(
+                self._restore_ties_unique, sender=get_tie_model()._meta.app_config,
+                dispatch_uid='sitecats_ties_unique')
+
+        if CACHE_SHARDED:
+            from .sharding import ShardedCache as Cache
+        else:
+            from .utils import Cache
+
         self._cat_cache = Cache()
+
+        if CACHE_PRELOAD:
+            try:
+                self._cat_cache.preload()
+
+            except DatabaseError:
+                # E.g. tables are not created yet.
+                pass
+
+    def _restore_ties_unique(self, using: str, **kwargs):
+        """Creates ties unique index if it is missing. See SITECATS_TIES_UNIQUE.
+
+        The index is not a part of migrations state, so it is lost
+        if ties table is rebuilt (e.g. on SQLite field alteration).
+
+        """
+        from .utils import get_tie_model
+
+        tie_model = get_tie_model()
+
+        if router.db_for_write(tie_model) == using and not tie_model.has_unique():
+            tie_model.set_unique()
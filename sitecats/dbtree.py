@@ -0,0 +1,154 @@
+"""Categories tree queries made by DB itself using recursive CTE (WITH RECURSIVE).
+
+Unlike `Cache` these do not require the whole categories tree to be loaded
+into memory, which is handy for management commands, background tasks, etc.
+
+Supported by SQLite 3.8.3+, PostgreSQL, MySQL 8+.
+
+"""
+from typing import List, Tuple, Union, Type
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router
+from django.db.models import QuerySet
+from django.db.models.expressions import RawSQL
+
+from .records import get_category_id
+from .utils import get_category_model, get_tie_model
+
+if False:  # pragma: nocover
+    from .models import CategoryBase, TieBase, ModelWithCategory  # noqa
+
+
+TypeCategory = Union['CategoryBase', int]
+
+
+def _get_table_info() -> Tuple[str, str, str, str]:
+    """Returns DB alias, quoted categories table name, pk and parent columns."""
+
+    model = get_category_model()
+    using = router.db_for_read(model)
+    quote = connections[using].ops.quote_name
+    opts = model._meta
+
+    return using, quote(opts.db_table), quote(opts.pk.column), quote(opts.get_field('parent').column)
+
+
+def get_subtree_sql(category: TypeCategory, include_self: bool = True) -> Tuple[str, List[int]]:
+    """Returns SQL (and its params) selecting IDs of categories under the given one (at any depth).
+
+    :param category: Category or its ID
+    :param include_self: Whether to include category ID itself
+
+    """
+    _, table, pk, parent = _get_table_info()
+
+    start_column = pk if include_self else parent
+
+    sql = (
+        f'WITH RECURSIVE subtree(id) AS ('
+        f'SELECT {pk} FROM {table} WHERE {start_column} = %s '
+        f'UNION ALL '
+        f'SELECT c.{pk} FROM {table} c INNER JOIN subtree s ON c.{parent} = s.id'
+        f') SELECT id FROM subtree'
+    )
+
+    return sql, [get_category_id(category)]
+
+
+class SubtreeIds(RawSQL):
+    """Expression selecting IDs of categories under the given one (at any depth)
+    to be used in `__in` lookups, e.g.: `Category.objects.filter(pk__in=SubtreeIds(category))`.
+
+    """
+    def __init__(self, category: TypeCategory, include_self: bool = True):
+        """
+        :param category: Category or its ID
+        :param include_self: Whether to include category ID itself
+
+        """
+        super().__init__(*get_subtree_sql(category, include_self=include_self))
+
+    def as_sql(self, compiler, connection):
+        # Lookups wrap the expression into parentheses themselves.
+        # Django < 3.0 does that unconditionally, and `IN ((WITH ...))` is not a subquery.
+        return self.sql, self.params
+
+
+def get_descendant_ids(category: TypeCategory, include_self: bool = False) -> List[int]:
+    """Returns IDs of categories under the given one (at any depth).
+
+    :param category: Category or its ID
+    :param include_self: Whether to include category ID itself
+
+    """
+    using = _get_table_info()[0]
+    sql, params = get_subtree_sql(category, include_self=include_self)
+
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_ancestor_ids(category: TypeCategory) -> List[int]:
+    """Returns IDs of ancestors of the given category
+    starting from the root one down to the direct parent.
+
+    :param category: Category or its ID
+
+    """
+    using, table, pk, parent = _get_table_info()
+
+    sql = (
+        f'WITH RECURSIVE ancestors(id, parent_id, depth) AS ('
+        f'SELECT {pk}, {parent}, 0 FROM {table} WHERE {pk} = %s '
+        f'UNION ALL '
+        f'SELECT c.{pk}, c.{parent}, a.depth + 1 FROM {table} c INNER JOIN ancestors a ON c.{pk} = a.parent_id'
+        f') SELECT id FROM ancestors WHERE depth > 0 ORDER BY depth DESC'
+    )
+
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, [get_category_id(category)])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_subtree_ties_qs(
+        category: TypeCategory,
+        model: Type['ModelWithCategory'] = None,
+        include_self: bool = True
+
+) -> Union[List['TieBase'], QuerySet]:
+    """Returns a QuerySet of Ties for categories under the given one (at any depth).
+    Subtree is computed by DB within the same query.
+
+    :param category: Category or its ID
+    :param model: Model to filter ties by
+    :param include_self: Whether to include ties to the category itself
+
+    """
+    filter_kwargs = {
+        'category_id__in': SubtreeIds(category, include_self=include_self)
+    }
+
+    if model is not None:
+        filter_kwargs['content_type'] = ContentType.objects.get_for_model(model, for_concrete_model=False)
+
+    return get_tie_model().objects.filter(**filter_kwargs)
+
+
+def get_subtree_objects_qs(
+        model: Type['ModelWithCategory'],
+        category: TypeCategory,
+        include_self: bool = True
+
+) -> Union[List['ModelWithCategory'], QuerySet]:
+    """Returns a QuerySet of objects of the given model associated
+    with categories under the given one (at any depth).
+
+    :param model: Model to get objects of
+    :param category: Category or its ID
+    :param include_self: Whether to include objects associated with the category itself
+
+    """
+    ids = get_subtree_ties_qs(category, model=model, include_self=include_self).values('object_id')
+    return model.objects.filter(pk__in=ids)
@@ -28,3 +28,6 @@ class SitecatsLockedCategoryDelete(SitecatsException):
 class SitecatsValidationError(SitecatsException, ValidationError):
     """Exception raised by CategoryRequestHandler on request data validation errors."""
 
+
+class SitecatsImportError(SitecatsException):
+    """Exception raised on categories import errors."""
@@ -0,0 +1,310 @@
+import csv
+import json
+from typing import IO, Iterator, Iterable, Dict, Any, Optional, Tuple, List
+
+from django.db.models import F, Q
+
+from .exceptions import SitecatsImportError
+from .utils import get_category_model, get_cache
+
+if False:  # pragma: nocover
+    from django.contrib.auth.models import User  # noqa
+
+
+FORMAT_JSONL = 'jsonl'
+FORMAT_CSV = 'csv'
+
+FIELDS = (
+    'title', 'alias', 'slug', 'note', 'status', 'is_locked', 'sort_order',
+    'parent_alias', 'parent_slug', 'parent_path',
+)
+"""Fields of exported (imported) category records.
+
+Parent category is addressed by `parent_alias`, `parent_slug` or `parent_path`
+(titles from the root category down to the parent joined by a separator) in that order.
+Root categories have none of these.
+
+"""
+
+
+def export_categories(
+        stream: IO[str],
+        fmt: str = FORMAT_JSONL,
+        path_separator: str = '/',
+        chunk_size: int = 1000
+
+) -> int:
+    """Writes categories tree into a stream level by level (parents before children).
+    Returns a number of categories exported.
+
+    :param stream: Text stream to write to
+    :param fmt: Format: jsonl or csv
+    :param path_separator: String to join titles in `parent_path`.
+    :param chunk_size: Number of parent categories to fetch children for at once.
+
+    """
+    if fmt == FORMAT_CSV:
+        writer = csv.DictWriter(stream, fieldnames=FIELDS)
+        writer.writeheader()
+        write = writer.writerow
+
+    else:
+        def write(record):
+            stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    manager = get_category_model()._default_manager
+    values = ('id', 'parent_id', 'title', 'alias', 'slug', 'note', 'status', 'is_locked', 'sort_order')
+
+    exported = 0
+
+    # Parent ID -> (path, alias, slug).
+    level = {None: ('', None, None)}
+
+    while level:
+        next_level = {}
+        parent_ids = list(level)
+
+        for idx in range(0, len(parent_ids), chunk_size):
+            chunk = parent_ids[idx:idx + chunk_size]
+
+            if chunk == [None]:
+                rows = manager.filter(parent__isnull=True)
+            else:
+                rows = manager.filter(parent_id__in=chunk)
+
+            for row in rows.order_by('sort_order').values(*values).iterator(chunk_size=chunk_size):
+                parent_path, parent_alias, parent_slug = level[row['parent_id']]
+
+                write({
+                    'title': row['title'],
+                    'alias': row['alias'] or '',
+                    'slug': row['slug'] or '',
+                    'note': row['note'],
+                    'status': row['status'],
+                    'is_locked': row['is_locked'],
+                    'sort_order': row['sort_order'],
+                    'parent_alias': parent_alias or '',
+                    'parent_slug': parent_slug or '',
+                    'parent_path': parent_path,
+                })
+                exported += 1
+
+                path = f"{parent_path}{path_separator}{row['title']}" if parent_path else row['title']
+                next_level[row['id']] = (path, row['alias'], row['slug'])
+
+        level = next_level
+
+    return exported
+
+
+def read_records(stream: IO[str], fmt: str = FORMAT_JSONL) -> Iterator[Dict[str, Any]]:
+    """Reads category records from a stream one by one.
+
+    :param stream: Text stream to read from
+    :param fmt: Format: jsonl or csv
+
+    """
+    if fmt == FORMAT_CSV:
+        for record in csv.DictReader(stream):
+            status = record.get('status')
+            sort_order = record.get('sort_order')
+
+            record['status'] = int(status) if status else None
+            record['sort_order'] = int(sort_order) if sort_order else 0
+            record['is_locked'] = str(record.get('is_locked')).lower() in ('1', 'true', 'yes')
+
+            yield record
+
+    else:
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def import_categories(
+        records: Iterable[Dict[str, Any]],
+        creator: 'User',
+        path_separator: str = '/',
+        batch_size: int = 1000
+
+) -> int:
+    """Creates categories from records (see `FIELDS` and `read_records()`).
+    Returns a number of categories created.
+
+    Categories are inserted level by level with `bulk_create()`.
+    Categories already existing (the same title under the same parent) are skipped.
+    Categories cache is invalidated once at the end (even if import fails midway:
+    categories created by then are kept).
+
+    :param records: Category records. Parents are expected to be addressable
+        either from DB or from the records themselves.
+    :param creator: User to be set as a creator of categories
+    :param path_separator: String separating titles in `parent_path`
+    :param batch_size: Number of categories to create at once.
+
+    """
+    model = get_category_model()
+    manager = model._default_manager
+
+    by_alias = {}
+    by_slug = {}
+    # (parent ID, title) -> ID
+    by_title = {}
+
+    for category_id, parent_id, title, alias, slug in manager.values_list(
+            'id', 'parent_id', 'title', 'alias', 'slug').iterator(chunk_size=batch_size):
+
+        by_title[(parent_id, title)] = category_id
+
+        if alias:
+            by_alias[alias] = category_id
+
+        if slug:
+            by_slug[slug] = category_id
+
+    paths = {}
+
+    def resolve_path(path: str) -> Optional[int]:
+        category_id = paths.get(path, False)
+
+        if category_id is False:
+            category_id = None
+
+            for title in path.split(path_separator):
+                category_id = by_title.get((category_id, title.strip()))
+                if category_id is None:
+                    break
+
+            if category_id is not None:
+                paths[path] = category_id
+
+        return category_id
+
+    def resolve_parent(record: dict) -> Tuple[bool, Optional[int]]:
+        # Returns (resolved, parent ID).
+        parent_alias = record.get('parent_alias')
+        if parent_alias:
+            return parent_alias in by_alias, by_alias.get(parent_alias)
+
+        parent_slug = record.get('parent_slug')
+        if parent_slug:
+            return parent_slug in by_slug, by_slug.get(parent_slug)
+
+        parent_path = record.get('parent_path')
+        if parent_path:
+            parent_id = resolve_path(parent_path)
+            return parent_id is not None, parent_id
+
+        return True, None
+
+    created = 0
+
+    def create(level: List[Tuple[Optional[int], dict]]):
+        nonlocal created
+        categories = []
+
+        for parent_id, record in level:
+            title = record['title'].strip()
+
+            if (parent_id, title) in by_title:
+                continue  # Already exists.
+
+            by_title[(parent_id, title)] = None  # Guard against duplicates in records.
+
+            categories.append(model(
+                title=title,
+                alias=record.get('alias') or None,
+                slug=record.get('slug') or None,
+                note=record.get('note') or '',
+                status=record.get('status'),
+                is_locked=bool(record.get('is_locked')),
+                sort_order=record.get('sort_order') or 0,
+                parent_id=parent_id,
+                creator=creator,
+            ))
+
+        if not categories:
+            return
+
+        manager.bulk_create(categories, batch_size=batch_size)
+        created += len(categories)
+
+        if any(category.pk is None for category in categories):
+            # Backend is unable to return IDs from bulk insert. Get them by unique title-parent pair.
+            parent_ids = {category.parent_id for category in categories}
+            titles = {category.title for category in categories}
+
+            condition = Q(parent_id__in=parent_ids - {None})
+            if None in parent_ids:
+                condition |= Q(parent__isnull=True)
+
+            ids = {
+                (parent_id, title): category_id
+                for category_id, parent_id, title in manager.filter(
+                    condition, title__in=titles).values_list('id', 'parent_id', 'title')
+            }
+
+            for category in categories:
+                category.pk = ids[(category.parent_id, category.title)]
+
+        new_ids = []
+
+        for category in categories:
+            new_ids.append(category.pk)
+            by_title[(category.parent_id, category.title)] = category.pk
+
+            if category.alias:
+                by_alias[category.alias] = category.pk
+
+            if category.slug:
+                by_slug[category.slug] = category.pk
+
+        # Default sort order is ID as in CategoryBase.save().
+        for idx in range(0, len(new_ids), batch_size):
+            manager.filter(pk__in=new_ids[idx:idx + batch_size], sort_order=0).update(sort_order=F('pk'))
+
+    def flush(batch: List[dict]) -> List[dict]:
+        # Creates categories level by level while parents could be resolved.
+        # Returns records left unresolved.
+        while batch:
+            level = []
+            unresolved = []
+
+            for record in batch:
+                resolved, parent_id = resolve_parent(record)
+
+                if resolved:
+                    level.append((parent_id, record))
+                else:
+                    unresolved.append(record)
+
+            if not level:
+                break
+
+            create(level)
+            batch = unresolved
+
+        return batch
+
+    batch = []
+
+    try:
+        for record in records:
+            batch.append(record)
+
+            if len(batch) >= batch_size:
+                batch = flush(batch)
+
+        batch = flush(batch)
+
+    finally:
+        # Categories are created bypassing signals.
+        if created:
+            get_cache().invalidate()
+
+    if batch:
+        raise SitecatsImportError(
+            f"Unable to resolve parents for {len(batch)} categories, e.g. `{batch[0]['title']}`.")
+
+    return created
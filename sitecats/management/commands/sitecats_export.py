@@ -0,0 +1,34 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from ...exchange import export_categories, FORMAT_JSONL, FORMAT_CSV
+
+
+class Command(BaseCommand):
+
+    help = 'Exports categories tree as JSON Lines or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output', dest='output', default=None,
+            help='File to write to. Defaults to stdout.')
+        parser.add_argument(
+            '--format', dest='fmt', choices=[FORMAT_JSONL, FORMAT_CSV], default=None,
+            help='Export format. Deduced from output file extension if not set, defaults to jsonl.')
+        parser.add_argument(
+            '--sep', dest='path_separator', default='/',
+            help='Separator for titles in parent path.')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        fmt = options['fmt'] or (FORMAT_CSV if output and output.endswith('.csv') else FORMAT_JSONL)
+
+        if output:
+            with open(output, 'w', encoding='utf-8', newline='') as stream:
+                exported = export_categories(stream, fmt=fmt, path_separator=options['path_separator'])
+
+        else:
+            exported = export_categories(sys.stdout, fmt=fmt, path_separator=options['path_separator'])
+
+        self.stderr.write(f'Categories exported: {exported}.')
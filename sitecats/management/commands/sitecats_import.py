@@ -0,0 +1,56 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from ...exceptions import SitecatsImportError
+from ...exchange import import_categories, read_records, FORMAT_JSONL, FORMAT_CSV
+
+
+class Command(BaseCommand):
+
+    help = 'Imports categories tree from JSON Lines or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='File to read from.')
+        parser.add_argument(
+            '--user', dest='user', required=True,
+            help='Username (or ID) of a user to be set as categories creator.')
+        parser.add_argument(
+            '--format', dest='fmt', choices=[FORMAT_JSONL, FORMAT_CSV], default=None,
+            help='Import format. Deduced from source file extension if not set, defaults to jsonl.')
+        parser.add_argument(
+            '--sep', dest='path_separator', default='/',
+            help='Separator for titles in parent path.')
+        parser.add_argument(
+            '--batch', type=int, default=1000, dest='batch_size',
+            help='Number of categories to create at once.')
+
+    def handle(self, *args, **options):
+        source = options['source']
+        fmt = options['fmt'] or (FORMAT_CSV if source.endswith('.csv') else FORMAT_JSONL)
+
+        user_model = get_user_model()
+        user = options['user']
+
+        try:
+            creator = user_model._default_manager.get_by_natural_key(user)
+
+        except user_model.DoesNotExist:
+            try:
+                creator = user_model._default_manager.get(pk=user)
+
+            except (user_model.DoesNotExist, ValueError):
+                raise CommandError(f'User `{user}` not found.')
+
+        with open(source, encoding='utf-8', newline='') as stream:
+            try:
+                created = import_categories(
+                    read_records(stream, fmt=fmt),
+                    creator,
+                    path_separator=options['path_separator'],
+                    batch_size=options['batch_size'],
+                )
+
+            except SitecatsImportError as e:
+                raise CommandError(f'{e}')
+
+        self.stdout.write(f'Categories imported: {created}.')
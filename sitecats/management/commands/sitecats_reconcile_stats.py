@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from ...utils import get_cache
+
+
+class Command(BaseCommand):
+
+    help = 'Recounts cached categories popularity (ties) stats to correct counters drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk', type=int, default=1000, dest='chunk_size',
+            help='Number of cache entries to set at once.')
+
+    def handle(self, *args, **options):
+        entries_num = get_cache().reconcile_ties_stats(chunk_size=options['chunk_size'])
+        self.stdout.write(f'Ties stats reconciled. Cache entries set: {entries_num}.')
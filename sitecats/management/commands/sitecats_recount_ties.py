@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...utils import get_category_model
+
+
+class Command(BaseCommand):
+
+    help = 'Recounts persisted categories ties counters (CategoryTiesCountMixin.ties_count).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk', type=int, default=1000, dest='chunk_size',
+            help='Number of categories to recount at once.')
+
+    def handle(self, *args, **options):
+        model = get_category_model()
+
+        if not hasattr(model, 'recount_ties'):
+            raise CommandError(f'{model.__name__} has no ties counter. See CategoryTiesCountMixin.')
+
+        categories_num = model.recount_ties(chunk_size=options['chunk_size'])
+        self.stdout.write(f'Ties counters recounted. Categories processed: {categories_num}.')
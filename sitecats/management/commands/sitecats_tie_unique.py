@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from ...utils import get_tie_model
+
+
+class Command(BaseCommand):
+
+    help = 'Creates (or drops) a unique index on ties (category, content type, object ID) preventing duplicate ties.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--drop', action='store_true', dest='drop',
+            help='Drop the index instead of creating it.')
+
+    def handle(self, *args, **options):
+        unique = not options['drop']
+
+        try:
+            get_tie_model().set_unique(unique)
+
+        except DatabaseError as e:
+            raise CommandError(f'Unable to change ties unique index (duplicate ties should be removed beforehand): {e}')
+
+        self.stdout.write(f'Ties unique index {"created" if unique else "dropped"}.')
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitecats', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='ties_count',
+            field=models.PositiveIntegerField(db_index=True, default=0, editable=False, help_text='Number of objects tied to this category.', verbose_name='Ties count'),
+        ),
+    ]
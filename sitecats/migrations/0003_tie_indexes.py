@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sitecats', '0002_category_ties_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tie',
+            index=models.Index(fields=['content_type', 'object_id'], name='sitecats_tie_ct_obj'),
+        ),
+        migrations.AddIndex(
+            model_name='tie',
+            index=models.Index(fields=['content_type', 'category', 'object_id'], name='sitecats_tie_ct_cat'),
+        ),
+    ]
+
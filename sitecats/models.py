@@ -1,16 +1,19 @@
 from collections import defaultdict
-from typing import Union, Dict, List, Any
+from typing import Union, Dict, List, Any, Iterable, Iterator, Tuple, Type
 
+from django import VERSION as DJANGO_VERSION
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, router, transaction, connections
+from django.db.models.functions import Coalesce
 from django.http import HttpRequest
 from django.utils.translation import gettext_lazy as _
 
 from .exceptions import SitecatsLockedCategoryDelete
-from .settings import MODEL_CATEGORY, MODEL_TIE
-from .utils import get_tie_model
+from .settings import MODEL_CATEGORY, MODEL_TIE, TIES_COUNT
+from .records import CategoryRecord, TiedCategory, get_category_id, get_category_instance
+from .utils import get_tie_model, get_category_model, get_cache
 
 if False:  # pragma: nocover
     from django.contrib.auth.models import User # noqa
@@ -19,6 +22,12 @@ if False:  # pragma: nocover
 USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
 
+TypeCategory = Union['CategoryBase', int]
+TypeCategoryRef = Union['CategoryBase', int, str]
+TypeObjectsCategories = Union[
+    Iterable[Tuple['ModelWithCategory', TypeCategory]],
+    Dict['ModelWithCategory', Iterable[TypeCategory]]
+]
 TypeLinked = Dict['CategoryBase', Union[List[int], List['ModelWithCategory'], models.QuerySet]]
 
 
@@ -85,10 +94,44 @@ class CategoryBase(models.Model):
         :param parent:
 
         """
+        if parent is not None:
+            parent = get_category_instance(parent)
+
         obj = cls(title=title, creator=creator, parent=parent)
         obj.save()
         return obj
 
+    @classmethod
+    def shift_ties_count(cls, category_ids: Iterable[int], delta: int):
+        """Atomically increments (decrements) persisted ties counters
+        of the given categories if TIES_COUNT is set (see `CategoryTiesCountMixin`).
+
+        :param category_ids:
+        :param delta:
+
+        """
+        if TIES_COUNT and delta:
+            cls._default_manager.filter(pk__in=category_ids).update(ties_count=models.F('ties_count') + delta)
+
+    @classmethod
+    def shift_ties_counts(cls, deltas: Dict[int, int]):
+        """Same as `shift_ties_count()` but for different deltas of categories.
+        Categories are updated in groups by delta.
+
+        :param deltas: Deltas indexed by category IDs.
+
+        """
+        if not TIES_COUNT:
+            return
+
+        by_delta = {}
+
+        for category_id, delta in deltas.items():
+            by_delta.setdefault(delta, []).append(category_id)
+
+        for delta, category_ids in by_delta.items():
+            cls.shift_ties_count(category_ids, delta)
+
     def delete(self, *args, **kwargs):
         """Overridden to handle `is_locked`.
 
@@ -115,7 +158,18 @@ class CategoryBase(models.Model):
 
         if self.sort_order == 0:
             self.sort_order = self.id
-            self.save()
+            # Update directly to spare another save() with its signals.
+            type(self)._default_manager.filter(pk=self.pk).update(sort_order=self.sort_order)
+
+    def __eq__(self, other):
+        if isinstance(other, (CategoryRecord, TiedCategory)):
+            # Before Django 3.0 Model.__eq__() returns False instead of NotImplemented
+            # for objects other than model instances, so we delegate explicitly.
+            return other == self
+
+        return super(CategoryBase, self).__eq__(other)
+
+    __hash__ = models.Model.__hash__
 
     def __str__(self):
         alias = ''
@@ -124,6 +178,51 @@ class CategoryBase(models.Model):
         return f'{self.title}{alias}'
 
 
+class CategoryTiesCountMixin(models.Model):
+    """Mix in this model to a category model (alongside with `CategoryBase`)
+    to have a persisted ties counter maintained if SITECATS_TIES_COUNT is set.
+
+    Counters are maintained by sitecats API (e.g. `add_to_category()`, `remove_from_category()`),
+    ties deleted directly (`Tie.delete()`) or by cascade (e.g. with objects tied)
+    are not counted. Use `sitecats_recount_ties` command to recount.
+
+    """
+    ties_count = models.PositiveIntegerField(
+        _('Ties count'),
+        help_text=_('Number of objects tied to this category.'), db_index=True, default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def recount_ties(cls, category_ids: Iterable[int] = None, chunk_size: int = 1000) -> int:
+        """Recounts persisted ties counters of the given (or all) categories
+        chunk by chunk. Returns a number of categories processed.
+
+        :param category_ids: Categories to recount. If not set all categories are recounted.
+        :param chunk_size: Number of categories to recount at once.
+
+        """
+        if category_ids is None:
+            category_ids = cls._default_manager.order_by('pk').values_list('pk', flat=True)
+
+        category_ids = list(category_ids)
+
+        ties_count = models.Subquery(
+            get_tie_model().objects.filter(
+                category=models.OuterRef('pk')
+            ).order_by().values('category').annotate(ties_num=models.Count('pk')).values('ties_num'),
+            output_field=models.PositiveIntegerField()
+        )
+
+        for idx in range(0, len(category_ids), chunk_size):
+            cls._default_manager.filter(
+                pk__in=category_ids[idx:idx + chunk_size]
+            ).update(ties_count=Coalesce(ties_count, 0))
+
+        return len(category_ids)
+
+
 class TieBase(models.Model):
     """Base class for ties models.
 
@@ -155,6 +254,17 @@ class TieBase(models.Model):
         verbose_name = _('Tie')
         verbose_name_plural = _('Ties')
 
+    # Fields for composite indexes recommended for ties models (see `Tie`):
+    #   * object categories lookup: get_category_lists(), remove_from_category();
+    #   * ties for categories, ties stats grouped by category, objects in categories subqueries.
+    INDEX_FIELDS: List[List[str]] = [
+        ['content_type', 'object_id'],
+        ['content_type', 'category', 'object_id'],
+    ]
+
+    # Fields of an optional unique index preventing duplicate ties (see `set_unique()`).
+    UNIQUE_FIELDS: List[str] = ['category', 'content_type', 'object_id']
+
     def __str__(self):
         return f'{self.content_type}:{self.object_id} tied to {self.category}'
 
@@ -209,14 +319,212 @@ class TieBase(models.Model):
 
         return results
 
+    @classmethod
+    def iter_linked_objects(
+            cls,
+            filter_kwargs: dict = None,
+            by_category: bool = False,
+            chunk_size: int = 2000
+
+    ) -> Iterator[Union[Tuple[Type[models.Model], List[int]], Tuple['CategoryBase', Type[models.Model], List[int]]]]:
+        """Generator variant of `get_linked_objects()` for constant memory usage.
+
+        Yields `(model, ids_chunk)` tuples or `(category, model, ids_chunk)`
+        if `by_category` is True. Chunks for the same model (category) follow each other.
+        Categories are taken from sitecats cache.
+
+        :param dict filter_kwargs: Filter for ties.
+        :param bool by_category: If True linked objects IDs are grouped by categories.
+        :param int chunk_size: Maximum number of IDs in a chunk. Also used for DB fetches.
+
+        """
+        filter_kwargs = filter_kwargs or {}
+
+        order_by = ['content_type_id', 'object_id']
+        if by_category:
+            order_by.insert(1, 'category_id')
+
+        rows = cls.objects.filter(**filter_kwargs).order_by(*order_by).values_list(
+            'content_type_id', 'category_id', 'object_id').iterator(chunk_size=chunk_size)
+
+        get_category = get_cache().get_category_by_id
+
+        def get_model(type_id):
+            return ContentType.objects.get_for_id(type_id).model_class()
+
+        group = None
+        ids = []
+        last_id = None
+
+        def flush():
+            type_id, category_id = group
+            if by_category:
+                return get_category(category_id), get_model(type_id), ids
+            return get_model(type_id), ids
+
+        for type_id, category_id, object_id in rows:
+            key = (type_id, category_id if by_category else None)
+
+            if key != group:
+                if ids:
+                    yield flush()
+                group = key
+                ids = []
+                last_id = None
+
+            elif object_id == last_id:
+                continue  # The same object tied to a number of categories.
+
+            ids.append(object_id)
+            last_id = object_id
+
+            if len(ids) >= chunk_size:
+                yield flush()
+                ids = []
+
+        if ids:
+            yield flush()
+
+    @classmethod
+    def merge_categories(cls, source: TypeCategory, target: TypeCategory) -> int:
+        """Moves all ties from source category to target category.
+        Ties duplicating already existing target category ties are dropped.
+        Returns a number of ties moved.
+
+        Set-based SQL statements are used, so no ties signals are sent
+        (unless ties have dependent objects to be deleted by cascade).
+        Ties counters and stats are updated once at the end.
+
+        Source category itself is left intact.
+
+        :param source: Category (or its ID) to move ties from
+        :param target: Category (or its ID) to move ties to
+
+        """
+        source_id = get_category_id(source)
+        target_id = get_category_id(target)
+
+        if source_id == target_id:
+            return 0
+
+        duplicates = cls.objects.filter(category_id=source_id).annotate(
+            duplicate=models.Exists(cls.objects.filter(
+                category_id=target_id,
+                content_type=models.OuterRef('content_type'),
+                object_id=models.OuterRef('object_id'),
+            ))
+        ).filter(duplicate=True)
+
+        with transaction.atomic(using=router.db_for_write(cls)):
+            dropped = _delete_ties(cls.objects.filter(pk__in=models.Subquery(duplicates.values('pk'))))
+            moved = cls.objects.filter(category_id=source_id).update(category_id=target_id)
+
+            get_category_model().shift_ties_counts({source_id: -moved, target_id: moved})
+
+        if moved or dropped:
+            get_cache().reset_ties_stats()
+
+        return moved
+
+    @classmethod
+    def set_unique(cls, unique: bool = True):
+        """Creates (or drops) a unique index on (category, content_type, object_id)
+        preventing duplicate ties. Duplicate ties should be removed beforehand.
+
+        The index is not a part of migrations state, so it could be set up at any time,
+        but it is lost if ties table is rebuilt (see SITECATS_TIES_UNIQUE).
+
+        :param unique: Whether to create or to drop the index.
+
+        """
+        using = router.db_for_write(cls)
+        connection = connections[using]
+        quote = connection.ops.quote_name
+        opts = cls._meta
+
+        index = quote(f'{opts.db_table}_unique')
+        table = quote(opts.db_table)
+
+        if unique:
+            columns = ', '.join(quote(opts.get_field(name).column) for name in cls.UNIQUE_FIELDS)
+            sql = f'CREATE UNIQUE INDEX {index} ON {table} ({columns})'
+
+        elif connection.vendor == 'mysql':
+            sql = f'DROP INDEX {index} ON {table}'
+
+        else:
+            sql = f'DROP INDEX {index}'
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+
+    @classmethod
+    def has_unique(cls) -> bool:
+        """Returns whether duplicate ties are prevented by a unique index
+        (or a constraint) on (category, content_type, object_id).
+
+        """
+        connection = connections[router.db_for_write(cls)]
+        opts = cls._meta
+        columns = {opts.get_field(name).column for name in cls.UNIQUE_FIELDS}
+
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, opts.db_table)
+
+        return any(
+            constraint['unique'] and set(constraint['columns'] or ()) == columns
+            for constraint in constraints.values())
+
+
+def _delete_ties(ties: models.QuerySet) -> int:
+    """Deletes ties from the given QuerySet and updates ties counters in one transaction.
+    Returns a number of ties deleted.
+
+    Ties are deleted using one DELETE statement (no signals are sent) unless
+    there are objects depending on them (e.g. for custom ties models),
+    in that case a regular delete is made to handle cascades.
 
-class Category(CategoryBase):
+    :param ties:
+
+    """
+    deltas = {
+        item['category_id']: -item['ties_num']
+        for item in ties.order_by().values('category_id').annotate(ties_num=models.Count('pk'))
+    }
+
+    if not deltas:
+        return 0
+
+    model = ties.model
+    cascades = any(related.on_delete is not models.DO_NOTHING for related in model._meta.related_objects)
+
+    with transaction.atomic(using=ties.db):
+
+        if cascades:
+            deleted = ties.delete()[1].get(model._meta.label, 0)
+
+        else:
+            # The same single statement delete Django itself uses when no signals and cascades are involved.
+            deleted = ties._raw_delete(ties.db)
+
+        get_category_model().shift_ties_counts(deltas)
+
+    return deleted
+
+
+class Category(CategoryBase, CategoryTiesCountMixin):
     """Built-in category class. Default functionality."""
 
 
 class Tie(TieBase):
     """Built-in Tie class. Default functionality."""
 
+    class Meta(TieBase.Meta):
+        indexes = [
+            models.Index(fields=TieBase.INDEX_FIELDS[0], name='sitecats_tie_ct_obj'),
+            models.Index(fields=TieBase.INDEX_FIELDS[1], name='sitecats_tie_ct_cat'),
+        ]
+
 
 class ModelWithCategory(models.Model):
     """Helper class for models with tags.
@@ -230,6 +538,7 @@ class ModelWithCategory(models.Model):
         abstract = True
 
     _category_lists_init_kwargs = None
+    _category_lists = None
     _category_editor = None
 
     def set_category_lists_init_kwargs(self, kwa_dict: dict):
@@ -240,6 +549,18 @@ class ModelWithCategory(models.Model):
 
         """
         self._category_lists_init_kwargs = kwa_dict
+        self._category_lists = None  # Prefetched lists are spawned with other arguments.
+
+    def set_category_lists(self, lists: List['CategoryList']):
+        """Sets prefetched CategoryList objects to be returned by
+        get_category_lists() called without arguments.
+
+        See `toolbox.get_category_lists_bulk()`.
+
+        :param lists:
+
+        """
+        self._category_lists = lists
 
     def get_category_lists(
             self,
@@ -258,6 +579,9 @@ class ModelWithCategory(models.Model):
         if self._category_editor is not None:  # Return editor lists instead of plain lists if it's enabled.
             return self._category_editor.get_lists()
 
+        if self._category_lists is not None and init_kwargs is None and additional_parents_aliases is None:
+            return self._category_lists
+
         from .toolbox import get_category_lists
 
         init_kwargs = init_kwargs or {}
@@ -323,12 +647,18 @@ class ModelWithCategory(models.Model):
 
         """
         init_kwargs = {
-            'category': category,
+            'category': get_category_instance(category),
             'creator': user,
             'linked_object': self
         }
         tie = self.categories.model(**init_kwargs)  # That's a model of Tie.
-        tie.save()
+
+        with transaction.atomic(using=router.db_for_write(type(tie))):
+            tie.save()
+            get_category_model().shift_ties_count([tie.category_id], 1)
+
+        self._category_lists = None  # Prefetched lists are stale now.
+
         return tie
 
     def remove_from_category(self, category: CategoryBase):
@@ -338,7 +668,151 @@ class ModelWithCategory(models.Model):
 
         """
         ctype = ContentType.objects.get_for_model(self)
-        self.categories.model.objects.filter(category=category, content_type=ctype, object_id=self.id).delete()
+        tie_model = self.categories.model
+        category_id = get_category_id(category)
+
+        with transaction.atomic(using=router.db_for_write(tie_model)):
+            _, deleted = tie_model.objects.filter(
+                category_id=category_id, content_type=ctype, object_id=self.id).delete()
+            get_category_model().shift_ties_count([category_id], -deleted.get(tie_model._meta.label, 0))
+
+        self._category_lists = None  # Prefetched lists are stale now.
+
+    @classmethod
+    def bulk_add_to_category(
+            cls,
+            pairs: TypeObjectsCategories,
+            user: 'User',
+            batch_size: int = 1000
+
+    ) -> int:
+        """Adds a number of objects to categories at once. Ties already existing are skipped.
+        Returns a number of ties created.
+
+        Ties are created with `bulk_create()`, so no ties signals are sent.
+        Ties counters are updated batch by batch alongside with ties (so that they are consistent
+        even if a batch fails), ties stats are reset once at the end.
+
+        If ties unique index is set (see `TieBase.set_unique()`), ties created concurrently
+        in the meantime are skipped on insertion instead of failing the batch (Django 2.2+).
+        Those are still counted then, use `sitecats_recount_ties` command to recount.
+
+        E.g.: Article.bulk_add_to_category({article_1: [cat_1, cat_2], article_2: [cat_1]}, user)
+
+        :param pairs: Pairs of (object, category) or a dictionary of categories indexed by objects.
+            Categories could be passed as objects or IDs.
+        :param user: User heir who adds
+        :param batch_size: Number of ties to process (check and create) at once.
+
+        """
+        if isinstance(pairs, dict):
+            pairs = ((obj, category) for obj, categories in pairs.items() for category in categories)
+
+        tie_model = get_tie_model()
+        ctype_ids = {}
+        seen = set()
+        created = 0
+        create_kwargs = {'batch_size': batch_size}
+
+        if DJANGO_VERSION >= (2, 2) and tie_model.has_unique():
+            create_kwargs['ignore_conflicts'] = True
+
+        def process(batch):
+            existing = set()
+            by_ctype = {}
+            deltas = {}
+
+            for ctype_id, object_id, category_id in batch:
+                by_ctype.setdefault(ctype_id, (set(), set()))
+                by_ctype[ctype_id][0].add(object_id)
+                by_ctype[ctype_id][1].add(category_id)
+
+            for ctype_id, (object_ids, category_ids) in by_ctype.items():
+                existing.update(tie_model.objects.filter(
+                    content_type_id=ctype_id, object_id__in=object_ids, category_id__in=category_ids
+                ).values_list('content_type_id', 'object_id', 'category_id'))
+
+            ties = []
+
+            for ctype_id, object_id, category_id in batch:
+                if (ctype_id, object_id, category_id) in existing:
+                    continue
+
+                ties.append(tie_model(
+                    content_type_id=ctype_id, object_id=object_id, category_id=category_id, creator=user))
+                deltas[category_id] = deltas.get(category_id, 0) + 1
+
+            with transaction.atomic(using=router.db_for_write(tie_model)):
+                tie_model.objects.bulk_create(ties, **create_kwargs)
+                get_category_model().shift_ties_counts(deltas)
+
+            return len(ties)
+
+        batch = []
+
+        try:
+            for obj, category in pairs:
+                obj_cls = type(obj)
+
+                if obj_cls not in ctype_ids:
+                    ctype_ids[obj_cls] = ContentType.objects.get_for_model(obj_cls).id
+
+                item = (ctype_ids[obj_cls], obj.id, get_category_id(category))
+
+                if item in seen:
+                    continue
+
+                seen.add(item)
+                batch.append(item)
+
+                if len(batch) >= batch_size:
+                    created += process(batch)
+                    batch = []
+
+            if batch:
+                created += process(batch)
+
+        finally:
+            if created:
+                get_cache().reset_ties_stats()
+
+        return created
+
+    @classmethod
+    def bulk_remove_from_category(
+            cls,
+            categories: Union[TypeCategory, List[TypeCategory]],
+            objects: Union[models.QuerySet, List['ModelWithCategory']] = None
+
+    ) -> int:
+        """Removes the given objects (or all objects of this type) from categories at once.
+        Returns a number of ties deleted.
+
+        Set-based SQL statements are used, so no ties signals are sent
+        (unless ties have dependent objects to be deleted by cascade).
+        Ties counters and stats are updated once at the end.
+
+        E.g.: Article.bulk_remove_from_category([cat_1, cat_2], Article.objects.filter(title__startswith='a'))
+
+        :param categories: Category (or its ID) or a list of categories
+        :param objects: QuerySet or a list of objects of this type.
+            If not set all objects of this type are removed from categories.
+
+        """
+        ties = cls.get_ties_for_categories_qs(categories)
+
+        if objects is not None:
+            if isinstance(objects, models.QuerySet):
+                ties = ties.filter(object_id__in=objects.values('pk'))
+            else:
+                ties = ties.filter(object_id__in=[obj.id for obj in objects])
+
+        deleted = _delete_ties(ties)
+
+        if deleted:
+            get_cache().reset_ties_stats()
+
+        return deleted
 
     @classmethod
     def get_ties_for_categories_qs(
@@ -361,7 +835,7 @@ class ModelWithCategory(models.Model):
         category_ids = []
 
         for category in categories:
-            category_ids.append(category.id if isinstance(category, models.Model) else category)
+            category_ids.append(get_category_id(category))
 
         filter_kwargs = {
             'content_type': ContentType.objects.get_for_model(cls, for_concrete_model=False),
@@ -379,14 +853,106 @@ class ModelWithCategory(models.Model):
     @classmethod
     def get_from_category_qs(
             cls,
-            category: 'CategoryBase'
+            category: 'CategoryBase',
+            include_descendants: bool = False
 
     ) -> Union[List['ModelWithCategory'], models.QuerySet]:
         """Returns a QuerySet of objects of this type associated with the given category.
 
         :param category:
+        :param include_descendants: Whether to also get objects associated
+            with categories under the given one (at any depth).
 
         """
-        ids = cls.get_ties_for_categories_qs(category).values_list('object_id').distinct()
-        filter_kwargs = {'id__in': [i[0] for i in ids]}
-        return cls.objects.filter(**filter_kwargs)
+        categories = category
+
+        if include_descendants:
+            category_id = get_category_id(category)
+            categories = get_cache().get_subtree_ids(category_id) or [category_id]
+
+        # Subquery instead of a list of IDs to keep it in one query.
+        ids = cls.get_ties_for_categories_qs(categories).values('object_id')
+        return cls.objects.filter(pk__in=ids)
+
+    @classmethod
+    def filter_by_categories(
+            cls,
+            all_of: Iterable[TypeCategoryRef] = None,
+            any_of: Iterable[TypeCategoryRef] = None,
+            none_of: Iterable[TypeCategoryRef] = None,
+            include_descendants: bool = False,
+            queryset: models.QuerySet = None
+
+    ) -> models.QuerySet:
+        """Returns a QuerySet of objects of this type filtered by categories
+        they are associated with. Category predicates are compiled into subqueries,
+        so that filtering is done with one SQL query.
+
+            # Articles both in `python` and `django`, but not in `archived`.
+            Article.filter_by_categories(all_of=['python', 'django'], none_of=['archived'])
+
+        :param all_of: Categories (objects, IDs or aliases) objects should be associated with all of.
+        :param any_of: Categories (objects, IDs or aliases) objects should be associated with at least one of.
+        :param none_of: Categories (objects, IDs or aliases) objects should not be associated with.
+        :param include_descendants: Whether a category should also match objects associated
+            with categories under it (at any depth).
+        :param queryset: QuerySet to filter. If not set all objects of this type are filtered.
+
+        """
+        cache = get_cache()
+
+        def expand(categories: Iterable[TypeCategoryRef]) -> List[set]:
+            # A set of matching category IDs for every category given.
+            groups = []
+
+            for category in categories or []:
+
+                if isinstance(category, str):
+                    category = cache.get_category_by_alias(category)
+
+                if category is None:
+                    groups.append(set())
+                    continue
+
+                category_id = get_category_id(category)
+                category_ids = {category_id}
+
+                if include_descendants:
+                    category_ids.update(cache.get_subtree_ids(category_id))
+
+                groups.append(category_ids)
+
+            return groups
+
+        def get_ids_qs(category_ids: set) -> models.QuerySet:
+            return cls.get_ties_for_categories_qs(list(category_ids)).values('object_id')
+
+        qs = cls.objects.all() if queryset is None else queryset
+
+        all_of = expand(all_of)
+        any_of = expand(any_of)
+        none_of = set().union(*expand(none_of))
+
+        if not all(all_of) or (any_of and not any(any_of)):
+            # Unknown categories could not be matched.
+            return qs.none()
+
+        if all_of:
+            if include_descendants:
+                # Every subtree is matched by any of its categories.
+                for category_ids in all_of:
+                    qs = qs.filter(pk__in=get_ids_qs(category_ids))
+
+            else:
+                category_ids = set().union(*all_of)
+                qs = qs.filter(pk__in=get_ids_qs(category_ids).annotate(
+                    matched=models.Count('category_id', distinct=True)
+                ).filter(matched=len(category_ids)).values('object_id'))
+
+        if any_of:
+            qs = qs.filter(pk__in=get_ids_qs(set().union(*any_of)))
+
+        if none_of:
+            qs = qs.exclude(pk__in=get_ids_qs(none_of))
+
+        return qs
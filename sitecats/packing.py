@@ -0,0 +1,238 @@
+"""Compact columnar format for categories tree put into Django cache.
+
+Category records are stored as parallel arrays of IDs, parent positions,
+sort orders and indexes into a table of interned strings, alongside
+with tree order and lookup indexes, optionally compressed with zlib. See SITECATS_CACHE_PACK.
+
+Values of other category model fields (e.g. of custom ones) are pickled.
+
+"""
+import marshal
+import pickle
+import zlib
+from array import array
+from typing import List, Tuple, Type, Dict, Optional, Sequence
+
+from .records import CategoryRecord
+
+if False:  # pragma: nocover
+    from .models import CategoryBase  # noqa
+
+
+TypeTree = Tuple[List[int], Dict[int, Tuple[int, int, int]]]
+TypeIndex = Tuple[Dict[Optional[str], List[int]], Dict[Optional[str], Dict[str, int]]]
+
+FORMAT_VERSION = 3
+
+# Stands for None in integer columns.
+NULL = -(2 ** 31)
+
+MARK_PLAIN = b'p'
+MARK_COMPRESSED = b'z'
+
+
+def _pack_column(values: Sequence[int]) -> Tuple[str, bytes]:
+    # 32-bit integers are used if possible.
+    typecode = 'i' if not values or (NULL <= min(values) and max(values) < 2 ** 31) else 'q'
+    return typecode, array(typecode, values).tobytes()
+
+
+def _get_offsets(groups: List[list]) -> List[int]:
+    # Boundaries of groups concatenated into one column.
+    offsets = [0]
+    for group in groups:
+        offsets.append(offsets[-1] + len(group))
+    return offsets
+
+
+def pack_records(
+        version: str,
+        records: List[CategoryRecord],
+        model: Type['CategoryBase'],
+        tree: Optional[TypeTree] = None,
+        compress: bool = False,
+        index: Optional[TypeIndex] = None
+) -> bytes:
+    """Packs category records into bytes.
+
+    :param version: Tree version stamp.
+    :param records: Category records (usually ordered by `sort_order`).
+    :param model: Category model (its fields other than the basic ones are pickled).
+    :param tree: Tree order (category IDs in preorder) and spans ({category ID: (enter, leave, depth)}).
+    :param compress: Whether to compress data with zlib.
+    :param index: Children IDs by parent aliases ({alias: [ID, ...]}) and children IDs
+        by casefolded titles under parent aliases ({alias: {title: ID}}).
+        Packed to spare their calculation on unpacking.
+
+    """
+    strings = {}
+
+    def intern(value):
+        if value is None:
+            return NULL
+        idx = strings.get(value)
+        if idx is None:
+            idx = strings[value] = len(strings)
+        return idx
+
+    positions = {record.id: position for position, record in enumerate(records)}
+
+    columns = [
+        [record.id for record in records],
+        [positions.get(record.parent_id, NULL) for record in records],
+        [record.sort_order for record in records],
+        [NULL if record.status is None else record.status for record in records],
+        [int(record.is_locked) for record in records],
+        [intern(record.alias) for record in records],
+        [intern(record.title) for record in records],
+        [intern(record.note) for record in records],
+        [intern(record.slug) for record in records],
+    ]
+
+    tree_columns = []
+
+    if tree:
+        # Leaving positions and depths in tree order. Entering position is an index in that order.
+        order, spans = tree
+        tree_columns = [
+            [positions[category_id] for category_id in order],
+            [spans[category_id][1] for category_id in order],
+            [spans[category_id][2] for category_id in order],
+        ]
+
+    index_columns = []
+
+    if index:
+        parents, titles = index
+        children = list(parents.values())
+        titles = [titles.get(parent_alias, {}) for parent_alias in parents]
+        index_columns = [
+            [intern(parent_alias) for parent_alias in parents],
+            [child_id for child_ids in children for child_id in child_ids],
+            _get_offsets(children),
+            [intern(title) for parent_titles in titles for title in parent_titles],
+            [child_id for parent_titles in titles for child_id in parent_titles.values()],
+            _get_offsets(titles),
+        ]
+
+    extra_start = len(CategoryRecord.FIELDS)
+    extra_attnames = CategoryRecord.get_attnames(model)[extra_start:]
+
+    data = marshal.dumps((
+        FORMAT_VERSION,
+        version,
+        list(strings),
+        [_pack_column(column) for column in columns],
+        [_pack_column(column) for column in tree_columns],
+        [_pack_column(column) for column in index_columns],
+        extra_attnames,
+        pickle.dumps(
+            [list(column) for column in zip(*(record._values[extra_start:] for record in records))],
+            pickle.HIGHEST_PROTOCOL),
+    ))
+
+    if compress:
+        return MARK_COMPRESSED + zlib.compress(data)
+
+    return MARK_PLAIN + data
+
+
+def unpack_columns(
+        data: bytes
+) -> Tuple[str, List[str], List[List[int]], List[List[int]], List[List[int]], Tuple[str, ...], List[list]]:
+    """Unpacks data packed by `pack_records()` into version, strings table, fields columns,
+    tree columns, index columns, other fields attribute names and their columns.
+
+    :param data:
+
+    """
+    mark, data = data[:1], data[1:]
+
+    if mark == MARK_COMPRESSED:
+        data = zlib.decompress(data)
+
+    format_version, version, strings, *packed = marshal.loads(data)
+
+    if format_version != FORMAT_VERSION:
+        raise ValueError(f'Unsupported categories tree format: {format_version}')
+
+    columns, tree_columns, index_columns, extra_attnames, extra_columns = packed
+
+    def unpack(packed_columns):
+        unpacked = []
+        for typecode, column in packed_columns:
+            values = array(typecode)
+            values.frombytes(column)
+            unpacked.append(values.tolist())
+        return unpacked
+
+    return (
+        version, strings, unpack(columns), unpack(tree_columns), unpack(index_columns),
+        tuple(extra_attnames), pickle.loads(extra_columns))
+
+
+def unpack_records(
+        data: bytes,
+        model: Type['CategoryBase']
+) -> Tuple[str, List[CategoryRecord], Optional[TypeTree], Optional[TypeIndex]]:
+    """Unpacks data packed by `pack_records()` into version, category records,
+    tree order and spans, and lookup indexes (the latter two if packed).
+
+    Raises ValueError if data format is not supported or data is packed for other category model fields.
+
+    :param data:
+    :param model: Category model.
+
+    """
+    version, strings, columns, tree_columns, index_columns, extra_attnames, extra_columns = unpack_columns(data)
+
+    if extra_attnames != CategoryRecord.get_attnames(model)[len(CategoryRecord.FIELDS):]:
+        raise ValueError('Categories tree is packed for other category model fields')
+
+    ids, parents, sort_orders, statuses, locks, aliases, titles, notes, slugs = columns
+
+    strings.append(None)  # NULL is resolved into the last item.
+
+    def resolve(indexes):
+        return [strings[-1 if idx == NULL else idx] for idx in indexes]
+
+    records = CategoryRecord.make_many(model, zip(
+        ids,
+        resolve(aliases),
+        resolve(titles),
+        [None if idx == NULL else ids[idx] for idx in parents],
+        sort_orders,
+        resolve(notes),
+        [None if status == NULL else status for status in statuses],
+        resolve(slugs),
+        [lock == 1 for lock in locks],
+        *extra_columns,
+    ))
+
+    tree = None
+
+    if tree_columns:
+        order, leaves, depths = tree_columns
+        order = [ids[position] for position in order]
+        tree = order, dict(zip(order, zip(range(len(order)), leaves, depths)))
+
+    index = None
+
+    if index_columns:
+        parent_aliases, children, children_offsets, title_keys, title_ids, title_offsets = index_columns
+        parent_aliases = resolve(parent_aliases)
+        title_keys = resolve(title_keys)
+        index = (
+            {
+                parent_alias: children[children_offsets[idx]:children_offsets[idx + 1]]
+                for idx, parent_alias in enumerate(parent_aliases)
+            },
+            {
+                parent_alias: dict(zip(
+                    title_keys[title_offsets[idx]:title_offsets[idx + 1]],
+                    title_ids[title_offsets[idx]:title_offsets[idx + 1]]))
+                for idx, parent_alias in enumerate(parent_aliases)
+            },
+        )
+
+    return version, records, tree, index
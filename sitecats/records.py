@@ -0,0 +1,266 @@
+"""Lightweight categories representations handed out by categories cache."""
+from typing import Any, Dict, Iterable, List, Tuple, Type, Union
+
+from django.db.models import DEFERRED, Model
+
+if False:  # pragma: nocover
+    from .models import CategoryBase  # noqa
+
+
+def _field(position: int) -> property:
+    return property(lambda record: record._values[position])
+
+
+class CategoryRecord:
+    """Immutable compact category data stored in categories cache.
+
+    Records are shared between threads (and requests), so they can not be changed.
+    Compares equal to model instances of the same category.
+
+    Records store values of all concrete fields of a category model (see `get_attnames()`).
+    Other attributes are taken from a category model instance hydrated on demand
+    (once per record, see `hydrate()`), so that custom model methods are available.
+
+    Records are not model instances, so use `hydrate()` to pass them to ORM
+    (e.g. `Tie(category=record.hydrate())`) or filter by IDs (e.g. `filter(parent_id=record.id)`).
+
+    """
+    FIELDS: Tuple[str, ...] = (
+        'id', 'alias', 'title', 'parent_id', 'sort_order', 'note', 'status', 'slug', 'is_locked')
+
+    __slots__ = ('model', '_values', '_instance')
+
+    _attnames: Dict[Type['CategoryBase'], Tuple[str, ...]] = {}
+    _positions: Dict[Type['CategoryBase'], Dict[str, int]] = {}
+
+    def __new__(cls, model: Type['CategoryBase'], values: Iterable[Any]):
+        """
+        :param model: Category model.
+        :param values: Field values in `get_attnames()` order.
+
+        """
+        record = object.__new__(cls)
+        _set_model(record, model)
+        _set_values(record, tuple(values))
+        return record
+
+    @classmethod
+    def get_attnames(cls, model: Type['CategoryBase']) -> Tuple[str, ...]:
+        """Returns names of attributes stored in records of the given model:
+        `FIELDS` followed by other concrete fields attribute names.
+
+        :param model: Category model.
+
+        """
+        attnames = cls._attnames.get(model)
+
+        if attnames is None:
+            attnames = cls.FIELDS + tuple(
+                field.attname for field in model._meta.concrete_fields if field.attname not in cls.FIELDS)
+            cls._positions[model] = {attname: position for position, attname in enumerate(attnames)}
+            cls._attnames[model] = attnames
+
+        return attnames
+
+    @classmethod
+    def make_many(cls, model: Type['CategoryBase'], rows: Iterable[Tuple[Any, ...]]) -> List['CategoryRecord']:
+        """Spawns records for the given field values rows. Faster than spawning one by one.
+
+        :param model: Category model.
+        :param rows: Field values tuples in `get_attnames()` order.
+
+        """
+        new = object.__new__
+        set_model = _set_model
+        set_values = _set_values
+        records = []
+
+        for values in rows:
+            record = new(cls)
+            set_model(record, model)
+            set_values(record, values)
+            records.append(record)
+
+        return records
+
+    @classmethod
+    def from_category(cls, category: 'CategoryBase') -> 'CategoryRecord':
+        """Spawns a record from a category model instance.
+
+        :param category:
+
+        """
+        model = type(category)
+        return cls(model, (getattr(category, attname) for attname in cls.get_attnames(model)))
+
+    id = _field(0)
+    alias = _field(1)
+    title = _field(2)
+    parent_id = _field(3)
+    sort_order = _field(4)
+    note = _field(5)
+    status = _field(6)
+    slug = _field(7)
+    is_locked = _field(8)
+    pk = id
+
+    def hydrate(self) -> 'CategoryBase':
+        """Returns a new category model instance with data from this record."""
+        model = self.model
+        self.get_attnames(model)
+        positions = self._positions[model]
+        values = self._values
+        # Values are expected in model fields order.
+        attnames = [field.attname for field in model._meta.concrete_fields]
+
+        return model.from_db(None, attnames, [values[positions[attname]] for attname in attnames])
+
+    def _get_instance(self) -> 'CategoryBase':
+        # Hydrated instance shared by all users of the record: it is not to be changed.
+        try:
+            return self._instance
+
+        except AttributeError:
+            instance = self.hydrate()
+            _set_instance(self, instance)
+            return instance
+
+    def __getattr__(self, name: str) -> Any:
+        # Called only for attributes not having properties.
+        if name.startswith('_'):
+            # Protect from hydration on introspection (copy, pickle, etc.).
+            raise AttributeError(name)
+
+        model = self.model
+        self.get_attnames(model)
+        position = self._positions[model].get(name)
+
+        if position is not None:
+            value = self._values[position]
+            if value is not DEFERRED:
+                return value
+
+        return getattr(self._get_instance(), name)
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    def __delattr__(self, name: str):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    def __reduce__(self):
+        model = self.model
+        return _restore_record, (model, self.get_attnames(model), self._values)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, CategoryRecord):
+            return self.model is other.model and self.id == other.id
+
+        if isinstance(other, Model):
+            return isinstance(other, self.model) and self.id == other.pk
+
+        return NotImplemented
+
+    def __ne__(self, other: Any) -> bool:
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self) -> int:
+        # The same as for model instances.
+        return hash(self.id)
+
+    def __str__(self) -> str:
+        from .models import CategoryBase
+
+        if self.model.__str__ is CategoryBase.__str__:
+            # Spare hydration for the default representation.
+            return CategoryBase.__str__(self)
+
+        return str(self._get_instance())
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self.model.__name__} {self.id}: {self.title}>'
+
+
+# Slots setters bypassing immutability guard.
+_set_model = CategoryRecord.model.__set__
+_set_values = CategoryRecord._values.__set__
+_set_instance = CategoryRecord._instance.__set__
+
+
+def _restore_record(model: Type['CategoryBase'], attnames: Tuple[str, ...], values: Tuple[Any, ...]) -> CategoryRecord:
+    # Model fields may be changed since a record is pickled: values of new fields are deferred.
+    values = dict(zip(attnames, values))
+    return CategoryRecord(model, (values.get(attname, DEFERRED) for attname in CategoryRecord.get_attnames(model)))
+
+
+class TiedCategory:
+    """Category record with ties stats calculated for a particular request.
+
+    Category attributes are available from the wrapper itself.
+
+    """
+    __slots__ = ('category', 'ties_num')
+
+    def __init__(self, category: CategoryRecord, ties_num: int):
+        """
+        :param category: Category record.
+        :param ties_num: Number of ties.
+
+        """
+        self.category = category
+        self.ties_num = ties_num
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        return getattr(self.category, name)
+
+    def __reduce__(self):
+        return self.__class__, (self.category, self.ties_num)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, TiedCategory):
+            other = other.category
+
+        return self.category == other
+
+    def __hash__(self) -> int:
+        return hash(self.category)
+
+    def __str__(self) -> str:
+        return str(self.category)
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} {self.category!r}: {self.ties_num}>'
+
+
+TypeCategoryLike = Union['CategoryBase', CategoryRecord, TiedCategory]
+
+
+def get_category_id(category: Union[TypeCategoryLike, int]) -> int:
+    """Returns ID of a category given as a model instance, a record or an ID.
+
+    :param category:
+
+    """
+    if isinstance(category, (Model, CategoryRecord, TiedCategory)):
+        return category.id
+
+    return category
+
+
+def get_category_instance(category: TypeCategoryLike) -> 'CategoryBase':
+    """Returns a model instance for a category given as a model instance or a record.
+
+    :param category:
+
+    """
+    if isinstance(category, TiedCategory):
+        category = category.category
+
+    if isinstance(category, CategoryRecord):
+        return category.hydrate()
+
+    return category
@@ -9,3 +9,52 @@ MODEL_TIE = getattr(settings, 'SITECATS_MODEL_TIE', 'sitecats.Tie')
 
 UNRESOLVED_URL_MARKER = getattr(settings, 'SITECATS_UNRESOLVED_URL_MARKER', '#unresolved')
 """String returned instead of a category URL if unresolved."""
+
+CACHE_CHECK_INTERVAL = getattr(settings, 'SITECATS_CACHE_CHECK_INTERVAL', 10)
+"""Number of seconds a process-local copy of categories tree is trusted
+before its version is checked against Django cache again.
+The version is also checked once per request."""
+
+CACHE_STALE_REBUILD = getattr(settings, 'SITECATS_CACHE_STALE_REBUILD', False)
+"""Whether categories tree should be rebuilt by just one process under a lock,
+while the others keep serving the previous tree generation until the new one is published."""
+
+CACHE_REBUILD_LOCK_TIMEOUT = getattr(settings, 'SITECATS_CACHE_REBUILD_LOCK_TIMEOUT', 60)
+"""Number of seconds categories tree rebuild lock is held at most."""
+
+CACHE_PATCH = getattr(settings, 'SITECATS_CACHE_PATCH', True)
+"""Whether a change of a single category should be applied to cached categories tree
+incrementally instead of dropping the whole tree."""
+
+CACHE_PACK = getattr(settings, 'SITECATS_CACHE_PACK', False)
+"""Whether categories tree should be put into Django cache in compact columnar format
+(smaller and faster to decode) instead of pickled objects. Use 'zlib' to also compress it
+(even smaller, but slower to decode)."""
+
+CACHE_SHARDED = getattr(settings, 'SITECATS_CACHE_SHARDED', False)
+"""Whether categories tree should be put into Django cache by branches loaded lazily
+instead of one entry. Useful for very large trees."""
+
+CACHE_SHARD_DEPTH = getattr(settings, 'SITECATS_CACHE_SHARD_DEPTH', 0)
+"""Depth (0 for root categories) of categories to be branch roots when SITECATS_CACHE_SHARDED is set."""
+
+CACHE_MMAP_DIR = getattr(settings, 'SITECATS_CACHE_MMAP_DIR', None)
+"""Directory to put categories tree snapshot files into. If set, processes of a host
+map the same snapshot file and read the tree from it in place instead of
+keeping their own copies. Not used when SITECATS_CACHE_SHARDED is set."""
+
+CACHE_PRELOAD = getattr(settings, 'SITECATS_CACHE_PRELOAD', False)
+"""Whether categories tree should be loaded on application start (see Cache.preload()),
+e.g. in a parent process of a preforking server before workers are forked."""
+
+TIES_STATS_CACHE = getattr(settings, 'SITECATS_TIES_STATS_CACHE', False)
+"""Whether categories popularity (ties) stats should be cached and kept up to date
+on ties save/delete instead of counting ties on every request."""
+
+TIES_COUNT = getattr(settings, 'SITECATS_TIES_COUNT', False)
+"""Whether persisted categories ties counters (CategoryTiesCountMixin.ties_count) should be maintained
+on ties addition and removal. Category model should inherit from CategoryTiesCountMixin."""
+
+TIES_UNIQUE = getattr(settings, 'SITECATS_TIES_UNIQUE', False)
+"""Whether a unique index on ties (category, content type, object ID) should be created
+(see TieBase.set_unique()) on `migrate` if it is missing, e.g. lost when ties table is rebuilt."""
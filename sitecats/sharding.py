@@ -0,0 +1,678 @@
+"""Branch-sharded categories cache for very large trees. See SITECATS_CACHE_SHARDED.
+
+Categories down to SITECATS_CACHE_SHARD_DEPTH form a small head kept in a top-level index entry.
+Categories at that depth are branch roots: a branch (a root and all categories under it)
+is put into a separate Django cache entry, loaded lazily and cached per branch.
+
+Categories are routed to branches with ID-to-branch maps chunked by ID ranges
+and alias-to-branch maps chunked by alias hashes. Evicted maps are built from DB.
+
+"""
+from operator import attrgetter
+from typing import Optional, List, Set, Tuple, Dict, Union
+from uuid import uuid4
+from zlib import crc32
+
+from django.core.cache import cache
+
+from .dbtree import SubtreeIds
+from .records import CategoryRecord
+from .settings import CACHE_PATCH, CACHE_REBUILD_LOCK_TIMEOUT, CACHE_SHARD_DEPTH
+from .utils import Cache, get_category_model
+
+if False:  # pragma: nocover
+    from .models import CategoryBase  # noqa
+
+
+class ShardedCache(Cache):
+    """Categories cache loading tree branches lazily.
+
+    Differences from `Cache`:
+
+        * `None` parent alias addresses only categories from the head
+          (root categories and children of alias-less categories in the head).
+
+        * Methods requiring the whole tree (e.g. `get_descendant_ids(None)`) load all branches.
+
+    """
+    CACHE_ENTRY_NAME: str = 'sitecats_index'
+    CACHE_ENTRY_VERSION: str = 'sitecats_index_version'
+    CACHE_ENTRY_LOCK: str = 'sitecats_index_lock'
+    CACHE_ENTRY_INVALIDATED: str = 'sitecats_index_invalidated'
+    CACHE_ENTRY_BRANCH: str = 'sitecats_branch'
+    CACHE_ENTRY_IDS: str = 'sitecats_ids'
+    CACHE_ENTRY_ALIASES: str = 'sitecats_aliases'
+
+    INDEX_HEAD: str = 'head'
+    INDEX_BRANCHES: str = 'branches'
+    INDEX_ALIASES: str = 'aliases'
+    INDEX_ALIASES_CHUNKS_NUM: str = 'aliases_chunks_num'
+    INDEX_CHUNKS: str = 'chunks'
+
+    # Number of IDs range covered by one ID-to-branch map.
+    IDS_CHUNK_SIZE: int = 10000
+
+    # Number of aliases (on average) covered by one alias-to-branch map.
+    ALIASES_CHUNK_SIZE: int = 10000
+
+    # Number of entries to put into Django cache at once.
+    PUT_CHUNK_SIZE: int = 100
+
+    def __init__(self):
+        super().__init__()
+        # Process-local branches and ID-to-branch (alias-to-branch) maps: {key: (version, data)}.
+        self._branches = {}
+        self._chunks = {}
+        # Maps entry names to index entries with maps versions.
+        self._chunks_indexes = {
+            self.CACHE_ENTRY_IDS: self.INDEX_CHUNKS,
+            self.CACHE_ENTRY_ALIASES: self.INDEX_ALIASES,
+        }
+
+    def _branch_key(self, root_id: int, version: str) -> str:
+        return f'{self.CACHE_ENTRY_BRANCH}:{root_id}:{version}'
+
+    def _chunk_key(self, entry_name: str, chunk_id: int, version: str) -> str:
+        return f'{entry_name}:{chunk_id}:{version}'
+
+    @staticmethod
+    def _get_alias_chunk_id(alias: str, chunks_num: int) -> int:
+        # Hash is stable across processes unlike hash().
+        return crc32(alias.encode()) % chunks_num
+
+    def _cache_build(self, version: str) -> dict:
+        """Builds categories tree index from DB and publishes branches
+        and ID-to-branch maps into Django cache.
+
+        :param version: Version stamp to tag index with.
+
+        """
+        model = get_category_model()
+        categories = CategoryRecord.make_many(
+            model, model.objects.order_by('sort_order').values_list(*CategoryRecord.get_attnames(model)))
+
+        ids = {category.id: category for category in categories}
+        children = {}
+
+        for category in categories:
+            parent_id = category.parent_id if category.parent_id in ids else None
+            children.setdefault(parent_id, []).append(category)
+
+        head = []
+        branches = {}
+        routes = {}  # Category ID to branch root ID for categories under roots.
+
+        stack = [(category, 0, None) for category in children.get(None, [])]
+
+        while stack:
+            category, depth, root_id = stack.pop()
+
+            if depth == CACHE_SHARD_DEPTH:
+                root_id = category.id
+
+            if depth <= CACHE_SHARD_DEPTH:
+                head.append(category)
+
+            if root_id is not None:
+                branches.setdefault(root_id, []).append(category)
+
+                if depth > CACHE_SHARD_DEPTH:
+                    routes[category.id] = root_id
+
+            stack.extend((child, depth + 1, root_id) for child in children.get(category.id, []))
+
+        by_sort_order = attrgetter('sort_order')
+
+        alias_routes = {
+            category.alias: routes[category.id]
+            for category in categories if category.alias and category.id in routes}
+
+        index = {
+            self.CACHE_NAME_VERSION: version,
+            self.INDEX_HEAD: self._cache_assemble(version, sorted(head, key=by_sort_order)),
+            self.INDEX_BRANCHES: {},
+            self.INDEX_ALIASES: {},
+            self.INDEX_ALIASES_CHUNKS_NUM: len(alias_routes) // self.ALIASES_CHUNK_SIZE + 1,
+            self.INDEX_CHUNKS: {},
+        }
+
+        entries = {}
+
+        for root_id, branch in branches.items():
+            branch_version = index[self.INDEX_BRANCHES][root_id] = uuid4().hex
+            entries[self._branch_key(root_id, branch_version)] = self._cache_encode(
+                self._cache_assemble(branch_version, sorted(branch, key=by_sort_order)))
+
+        self._chunks = {}
+        chunks = {self.CACHE_ENTRY_IDS: {}, self.CACHE_ENTRY_ALIASES: {}}
+
+        for category_id, root_id in routes.items():
+            chunks[self.CACHE_ENTRY_IDS].setdefault(category_id // self.IDS_CHUNK_SIZE, {})[category_id] = root_id
+
+        for alias, root_id in alias_routes.items():
+            chunk_id = self._get_alias_chunk_id(alias, index[self.INDEX_ALIASES_CHUNKS_NUM])
+            chunks[self.CACHE_ENTRY_ALIASES].setdefault(chunk_id, {})[alias] = root_id
+
+        for entry_name, entry_chunks in chunks.items():
+            for chunk_id, chunk in entry_chunks.items():
+                chunk_version = index[self._chunks_indexes[entry_name]][chunk_id] = uuid4().hex
+                entries[self._chunk_key(entry_name, chunk_id, chunk_version)] = chunk
+                # Kept locally to spare fetching just built maps.
+                self._chunks[(entry_name, chunk_id)] = (chunk_version, chunk)
+
+        items = list(entries.items())
+
+        for idx in range(0, len(items), self.PUT_CHUNK_SIZE):
+            cache.set_many(dict(items[idx:idx + self.PUT_CHUNK_SIZE]), self.CACHE_TIMEOUT)
+
+        self._branches = {}
+
+        return index
+
+    def _cache_encode(self, cache_: dict) -> dict:
+        if self.INDEX_HEAD not in cache_:
+            return super()._cache_encode(cache_)
+
+        index = dict(cache_)
+        index[self.INDEX_HEAD] = super()._cache_encode(index[self.INDEX_HEAD])
+
+        return index
+
+    def _cache_decode(self, value: Optional[dict]) -> Optional[dict]:
+        if value is None or self.INDEX_HEAD not in value:
+            return super()._cache_decode(value)
+
+        index = dict(value)
+        index[self.INDEX_HEAD] = super()._cache_decode(index[self.INDEX_HEAD])
+
+        return index
+
+    def _cache_map(self, version: str) -> Optional[dict]:
+        # Snapshot files (see SITECATS_CACHE_MMAP_DIR) are not used for sharded tree.
+        return None
+
+    def _cache_localize(self, cache_: dict) -> dict:
+        return cache_
+
+    def _cache_empty(self, **kwargs):
+        super()._cache_empty(**kwargs)
+        self._chunks = {}
+
+    def _get_head(self) -> dict:
+        self._cache_init()
+        return self._cache[self.INDEX_HEAD]
+
+    def _get_branch(self, root_id: int) -> Optional[dict]:
+        """Returns cache structure for a branch with the given root.
+        Branch is taken from Django cache or built from DB if required.
+
+        :param root_id:
+
+        """
+        self._cache_init()
+        version = self._cache[self.INDEX_BRANCHES].get(root_id)
+
+        if version is None:
+            return None
+
+        local = self._branches.get(root_id)
+
+        if local is not None and local[0] == version:
+            return local[1]
+
+        key = self._branch_key(root_id, version)
+        branch = self._cache_decode(cache.get(key))
+
+        if branch is None:
+            # Evicted or invalidated: build from DB.
+            model = get_category_model()
+            branch = self._cache_assemble(version, CategoryRecord.make_many(
+                model,
+                model.objects.filter(pk__in=SubtreeIds(root_id)).order_by(
+                    'sort_order').values_list(*CategoryRecord.get_attnames(model))))
+
+            cache.set(key, self._cache_encode(branch), self.CACHE_TIMEOUT)
+
+        self._branches[root_id] = (version, branch)
+
+        return branch
+
+    def _get_root_id(self, cid: int) -> Optional[int]:
+        """Returns ID of a root of a branch the given category belongs to.
+        Categories from the head (except for branch roots) do not belong to any branch.
+
+        :param cid:
+
+        """
+        head = self._get_head()
+        category = head[self.CACHE_NAME_IDS].get(cid)
+
+        if category is not None:
+            return cid if cid in self._cache[self.INDEX_BRANCHES] else None
+
+        if cid is None:
+            return None
+
+        chunk = self._get_chunk(self.CACHE_ENTRY_IDS, cid // self.IDS_CHUNK_SIZE)
+
+        if chunk is None:
+            return None
+
+        return chunk.get(cid)
+
+    def _get_alias_root_id(self, alias: str) -> Optional[int]:
+        """Returns ID of a root of a branch the category with the given alias belongs to.
+        Categories from the head are not routed.
+
+        :param alias:
+
+        """
+        if alias is None:
+            return None
+
+        self._cache_init()
+        chunk_id = self._get_alias_chunk_id(alias, self._cache[self.INDEX_ALIASES_CHUNKS_NUM])
+        chunk = self._get_chunk(self.CACHE_ENTRY_ALIASES, chunk_id)
+
+        if chunk is None:
+            return None
+
+        return chunk.get(alias)
+
+    def _get_chunk(self, entry_name: str, chunk_id: int) -> Optional[Dict[Union[int, str], int]]:
+        """Returns a routing map chunk (ID-to-branch or alias-to-branch).
+        Map is taken from Django cache or built from DB if required.
+
+        :param entry_name: CACHE_ENTRY_IDS or CACHE_ENTRY_ALIASES.
+        :param chunk_id:
+
+        """
+        version = self._cache[self._chunks_indexes[entry_name]].get(chunk_id)
+
+        if version is None:
+            return None
+
+        local = self._chunks.get((entry_name, chunk_id))
+
+        if local is not None and local[0] == version:
+            return local[1]
+
+        key = self._chunk_key(entry_name, chunk_id, version)
+        chunk = cache.get(key)
+
+        if chunk is None:
+            # Evicted: build from DB.
+            chunk = self._build_chunk(entry_name, chunk_id)
+            cache.set(key, chunk, self.CACHE_TIMEOUT)
+
+        self._chunks[(entry_name, chunk_id)] = (version, chunk)
+
+        return chunk
+
+    def _build_chunk(self, entry_name: str, chunk_id: int) -> Dict[Union[int, str], int]:
+        """Builds a routing map chunk (ID-to-branch or alias-to-branch) from DB.
+
+        :param entry_name: CACHE_ENTRY_IDS or CACHE_ENTRY_ALIASES.
+        :param chunk_id:
+
+        """
+        categories = get_category_model()._default_manager.values_list('id', 'parent_id', 'alias')
+
+        if entry_name == self.CACHE_ENTRY_IDS:
+            start = chunk_id * self.IDS_CHUNK_SIZE
+            return self._route(dict(
+                (category_id, parent_id)
+                for category_id, parent_id, _ in categories.filter(id__gte=start, id__lt=start + self.IDS_CHUNK_SIZE)))
+
+        chunks_num = self._cache[self.INDEX_ALIASES_CHUNKS_NUM]
+        aliased = [
+            (category_id, parent_id, alias) for category_id, parent_id, alias in categories.exclude(alias=None)
+            if self._get_alias_chunk_id(alias, chunks_num) == chunk_id]
+
+        routes = self._route({category_id: parent_id for category_id, parent_id, _ in aliased})
+
+        return {alias: routes[category_id] for category_id, _, alias in aliased if category_id in routes}
+
+    def _route(self, parents: Dict[int, Optional[int]]) -> Dict[int, int]:
+        """Returns IDs of branch roots for the given categories indexed by categories IDs.
+        Categories not under branch roots are omitted. Ancestors are fetched from DB as required.
+
+        :param parents: Parent IDs indexed by IDs of categories to route.
+
+        """
+        head_ids = self._cache[self.INDEX_HEAD][self.CACHE_NAME_IDS]
+        branches = self._cache[self.INDEX_BRANCHES]
+        manager = get_category_model()._default_manager
+        ancestors = dict(parents)
+
+        while True:
+            # Walk up the tree until categories from the head.
+            unknown = {
+                parent_id for parent_id in ancestors.values()
+                if parent_id is not None and parent_id not in ancestors and parent_id not in head_ids}
+
+            if not unknown:
+                break
+
+            ancestors.update(dict.fromkeys(unknown))  # Just in case some are deleted meanwhile.
+            ancestors.update(manager.filter(id__in=unknown).values_list('id', 'parent_id'))
+
+        routes = {}
+
+        for category_id, parent_id in parents.items():
+            if category_id in head_ids:
+                continue
+
+            while parent_id is not None and parent_id not in head_ids:
+                parent_id = ancestors[parent_id]
+
+            if parent_id in branches:
+                routes[category_id] = parent_id
+
+        return routes
+
+    def _get_parent_structure(self, parent_alias: Optional[str]) -> Optional[dict]:
+        """Returns cache structure (head or branch) holding children of the given parent.
+
+        :param parent_alias:
+
+        """
+        head = self._get_head()
+
+        if parent_alias is None:
+            return head
+
+        parent = head[self.CACHE_NAME_ALIASES].get(parent_alias)
+
+        if parent is not None:
+            if parent.id in self._cache[self.INDEX_BRANCHES]:
+                return self._get_branch(parent.id)
+            return head
+
+        root_id = self._get_alias_root_id(parent_alias)
+
+        if root_id is None:
+            return None
+
+        return self._get_branch(root_id)
+
+    def _cache_patch_many(self, changes: List[Tuple['CategoryBase', bool]]):
+        """Applies category changes by invalidating affected branches only.
+
+        Changes to the head categories (including branch roots), or moving
+        categories with subcategories to another branch invalidate the whole tree.
+
+        """
+        if not CACHE_PATCH or any(category is None for category, _ in changes):
+            self._cache_empty()
+            return
+
+        if not cache.add(self.CACHE_ENTRY_LOCK, 'patch', CACHE_REBUILD_LOCK_TIMEOUT):
+            self._cache_empty()
+            return
+
+        try:
+            invalidated = cache.get(self.CACHE_ENTRY_INVALIDATED)
+            version = cache.get(self.CACHE_ENTRY_VERSION)
+            index = self._cache_invalidate_branches(version, changes)
+
+            if index is None:
+                self._cache_empty()
+                return
+
+            self._cache_put(index)
+
+            if self._cache_publish(version, index[self.CACHE_NAME_VERSION], invalidated):
+                self._cache = index
+
+        finally:
+            cache.delete(self.CACHE_ENTRY_LOCK)
+
+    def _cache_invalidate_branches(
+            self,
+            version: Optional[str],
+            changes: List[Tuple['CategoryBase', bool]]
+    ) -> Optional[dict]:
+        """Returns a new index derived from the one of the given version with branches
+        affected by the given changes invalidated. Returns None if changes could not be applied to branches.
+
+        :param version: Current index version.
+        :param changes:
+
+        """
+        index = self._cache
+
+        if index is None or index[self.CACHE_NAME_VERSION] != version:
+            index = self._cache_fetch()
+
+        if version is None or index is None or index[self.CACHE_NAME_VERSION] != version:
+            return None
+
+        self._cache = index
+        self._checked = None
+
+        head_ids = index[self.INDEX_HEAD][self.CACHE_NAME_IDS]
+        branches = dict(index[self.INDEX_BRANCHES])
+        chunks = {
+            self.INDEX_CHUNKS: dict(index[self.INDEX_CHUNKS]),
+            self.INDEX_ALIASES: dict(index[self.INDEX_ALIASES]),
+        }
+        aliases_chunks_num = index[self.INDEX_ALIASES_CHUNKS_NUM]
+
+        touched_chunks = {}
+        touched_roots: Set[int] = set()
+
+        def touch_chunk(entry_name: str, chunk_id: int) -> dict:
+            key = (entry_name, chunk_id)
+            if key not in touched_chunks:
+                chunk = self._get_chunk(entry_name, chunk_id)
+                touched_chunks[key] = {} if chunk is None else dict(chunk)
+            return touched_chunks[key]
+
+        for category, deleted in changes:
+            category_id = category.id
+
+            if category_id in head_ids:
+                return None
+
+            old_root_id = self._get_root_id(category_id)
+            new_root_id = None
+
+            if not deleted:
+                parent_id = category.parent_id
+
+                if parent_id is None or parent_id in head_ids and parent_id not in branches:
+                    return None  # A new head category.
+
+                new_root_id = self._get_root_id(parent_id)
+
+                if new_root_id is None:
+                    return None
+
+            if old_root_id is not None:
+
+                if (
+                    not deleted and new_root_id != old_root_id
+                    and get_category_model()._default_manager.filter(parent_id=category_id).exists()
+                ):
+                    return None  # Subcategories are moved to another branch.
+
+                touched_roots.add(old_root_id)
+
+            if new_root_id is not None:
+                touched_roots.add(new_root_id)
+
+                if category.alias:
+                    # Entries for aliases no longer used are left intact:
+                    # such aliases are just not found in branches.
+                    chunk_id = self._get_alias_chunk_id(category.alias, aliases_chunks_num)
+                    touch_chunk(self.CACHE_ENTRY_ALIASES, chunk_id)[category.alias] = new_root_id
+
+            routes = touch_chunk(self.CACHE_ENTRY_IDS, category_id // self.IDS_CHUNK_SIZE)
+
+            if new_root_id is None:
+                routes.pop(category_id, None)
+            else:
+                routes[category_id] = new_root_id
+
+        for root_id in touched_roots:
+            # Branch will be built from DB on first access.
+            branches[root_id] = uuid4().hex
+
+        for (entry_name, chunk_id), chunk in touched_chunks.items():
+            chunk_version = chunks[self._chunks_indexes[entry_name]][chunk_id] = uuid4().hex
+            cache.set(self._chunk_key(entry_name, chunk_id, chunk_version), chunk, self.CACHE_TIMEOUT)
+            self._chunks[(entry_name, chunk_id)] = (chunk_version, chunk)
+
+        index = dict(index)
+        index.update(chunks)
+        index.update({
+            self.CACHE_NAME_VERSION: uuid4().hex,
+            self.INDEX_BRANCHES: branches,
+        })
+
+        return index
+
+    def sort_aliases(self, aliases: List[str]) -> List[str]:
+        if not aliases:
+            return aliases
+
+        ranks = {}
+
+        for alias in set(aliases):
+            child_ids = self.get_child_ids(alias)
+            if child_ids:
+                # Parents are ranked by their first children as in `Cache`.
+                ranks[alias] = self.get_category_by_id(child_ids[0]).sort_order
+
+        return sorted(ranks, key=ranks.__getitem__)
+
+    def get_parents_for(self, child_ids: List[int]) -> Set[str]:
+        parents = set()
+
+        for child_id in child_ids:
+            category = self.get_category_by_id(child_id)
+
+            if category is None:
+                continue
+
+            parent = self.get_category_by_id(category.parent_id)
+            parents.add(parent.alias if parent is not None else None)
+
+        return parents
+
+    def get_child_ids(self, parent_alias: str) -> List[int]:
+        structure = self._get_parent_structure(parent_alias)
+
+        if structure is None:
+            return []
+
+        return structure[self.CACHE_NAME_PARENTS].get(parent_alias, [])
+
+    def get_category_by_alias(self, alias: str) -> Optional[CategoryRecord]:
+        category = self._get_head()[self.CACHE_NAME_ALIASES].get(alias)
+
+        if category is not None:
+            return category
+
+        root_id = self._get_alias_root_id(alias)
+
+        if root_id is None:
+            return None
+
+        return self._get_branch(root_id)[self.CACHE_NAME_ALIASES].get(alias)
+
+    def get_category_by_id(self, cid: int) -> Optional[CategoryRecord]:
+        category = self._get_head()[self.CACHE_NAME_IDS].get(cid)
+
+        if category is not None:
+            return category
+
+        root_id = self._get_root_id(cid)
+
+        if root_id is None:
+            return None
+
+        return self._get_branch(root_id)[self.CACHE_NAME_IDS].get(cid)
+
+    def get_descendant_ids(self, parent_alias: Optional[str], include_self: bool = False) -> List[int]:
+        if parent_alias is not None:
+            return super().get_descendant_ids(parent_alias, include_self=include_self)
+
+        head = self._get_head()
+        return self._expand(head[self.CACHE_NAME_TREE_ORDER])
+
+    def _expand(self, head_ids: List[int]) -> List[int]:
+        """Replaces branch roots in the given head categories IDs list with their subtrees.
+
+        :param head_ids:
+
+        """
+        branches = self._cache[self.INDEX_BRANCHES]
+        result = []
+
+        for category_id in head_ids:
+            if category_id in branches:
+                result.extend(self.get_subtree_ids(category_id))
+            else:
+                result.append(category_id)
+
+        return result
+
+    def get_subtree_ids(self, cid: int, include_self: bool = True) -> List[int]:
+        head = self._get_head()
+        root_id = self._get_root_id(cid)
+
+        if root_id is None:
+            span = head[self.CACHE_NAME_TREE_SPANS].get(cid)
+
+            if span is None:
+                return []
+
+            enter, leave, _ = span
+            return self._expand(head[self.CACHE_NAME_TREE_ORDER][enter if include_self else enter + 1:leave])
+
+        branch = self._get_branch(root_id)
+        span = branch[self.CACHE_NAME_TREE_SPANS].get(cid)
+
+        if span is None:
+            return []
+
+        enter, leave, _ = span
+
+        return branch[self.CACHE_NAME_TREE_ORDER][enter if include_self else enter + 1:leave]
+
+    def get_depth(self, cid: int) -> Optional[int]:
+        span = self._get_head()[self.CACHE_NAME_TREE_SPANS].get(cid)
+
+        if span is not None:
+            return span[2]
+
+        root_id = self._get_root_id(cid)
+
+        if root_id is None:
+            return None
+
+        span = self._get_branch(root_id)[self.CACHE_NAME_TREE_SPANS].get(cid)
+
+        return None if span is None else span[2] + CACHE_SHARD_DEPTH
+
+    def is_descendant(self, cid: int, ancestor_id: int) -> bool:
+        if self.get_category_by_id(ancestor_id) is None:
+            return False
+        return any(category.id == ancestor_id for category in self.get_ancestors(cid))
+
+    def find_category(self, parent_alias: str, title: str) -> Optional[CategoryRecord]:
+        return self.find_categories(parent_alias, [title])[title]
+
+    def find_categories(self, parent_alias: str, titles: List[str]) -> Dict[str, Optional[CategoryRecord]]:
+        structure = self._get_parent_structure(parent_alias)
+        parent_titles = {} if structure is None else structure[self.CACHE_NAME_TITLES].get(parent_alias, {})
+
+        found = {}
+
+        for title in titles:
+            category_id = parent_titles.get(title.casefold())
+            found[title] = None if category_id is None else self.get_category_by_id(category_id)
+
+        return found
@@ -0,0 +1,522 @@
+"""Memory-mapped categories tree snapshots shared by processes on a host. See SITECATS_CACHE_MMAP_DIR.
+
+A snapshot is a versioned file with columns of fixed size integers (as in `packing`)
+put at known offsets: category fields, interned strings, children lists
+and tree order. Values of other category model fields are pickled per category.
+Processes map the file and read columns in place (zero-copy).
+Category records are only spawned on access through mapping views.
+
+"""
+import marshal
+import mmap
+import os
+import pickle
+from array import array
+from collections.abc import Mapping, Sequence
+from tempfile import NamedTemporaryFile
+from typing import List, Optional, Type, Iterator, Dict, Tuple, Union
+
+from .packing import NULL, TypeTree, _pack_column
+from .records import CategoryRecord
+
+if False:  # pragma: nocover
+    from .models import CategoryBase  # noqa
+
+
+MAGIC = b'SCTS'
+FORMAT_VERSION = 2
+FILE_PREFIX = 'sitecats-'
+FILE_SUFFIX = '.tree'
+
+
+def get_snapshot_path(directory: str, version: str) -> str:
+    """Returns snapshot file path for the given tree version.
+
+    :param directory:
+    :param version:
+
+    """
+    return os.path.join(directory, f'{FILE_PREFIX}{version}{FILE_SUFFIX}')
+
+
+def write_snapshot(
+        directory: str,
+        version: str,
+        records: List[CategoryRecord],
+        model: Type['CategoryBase'],
+        tree: TypeTree
+) -> str:
+    """Writes categories tree snapshot file atomically. Returns file path.
+    Snapshots of other versions are removed (processes having them mapped are not affected).
+
+    :param directory:
+    :param version: Tree version stamp.
+    :param records: Category records ordered by `sort_order`.
+    :param model: Category model (its fields other than the basic ones are pickled).
+    :param tree: Tree order (category IDs in preorder) and spans ({category ID: (enter, leave, depth)}).
+
+    """
+    positions = {record.id: position for position, record in enumerate(records)}
+    strings = {}
+
+    def intern(value):
+        if value is None:
+            return NULL
+        idx = strings.get(value)
+        if idx is None:
+            idx = strings[value] = len(strings)
+        return idx
+
+    parents = [positions.get(record.parent_id, NULL) for record in records]
+
+    # Children lists (positions in sort order) for every position, concatenated.
+    children = [[] for _ in records]
+    none_bucket = []  # Root categories and children of alias-less categories.
+
+    for position, parent in enumerate(parents):
+        if parent == NULL:
+            none_bucket.append(position)
+        else:
+            children[parent].append(position)
+            if not records[parent].alias:
+                none_bucket.append(position)
+
+    children_offsets = [0]
+    for child_positions in children:
+        children_offsets.append(children_offsets[-1] + len(child_positions))
+
+    by_id = sorted(range(len(records)), key=lambda position: records[position].id)
+    by_alias = sorted(
+        (position for position, record in enumerate(records) if record.alias),
+        key=lambda position: records[position].alias)
+
+    order, spans = tree
+
+    columns = {
+        'id': [record.id for record in records],
+        'parent': parents,
+        'sort_order': [record.sort_order for record in records],
+        'status': [NULL if record.status is None else record.status for record in records],
+        'is_locked': [int(record.is_locked) for record in records],
+        'alias': [intern(record.alias) for record in records],
+        'title': [intern(record.title) for record in records],
+        'note': [intern(record.note) for record in records],
+        'slug': [intern(record.slug) for record in records],
+        'by_id': by_id,
+        'by_alias': by_alias,
+        'children_offsets': children_offsets,
+        'children': [position for child_positions in children for position in child_positions],
+        'none_bucket': none_bucket,
+        'order': [positions[category_id] for category_id in order],
+        'enter': [spans[record.id][0] for record in records],
+        'leave': [spans[record.id][1] for record in records],
+        'depth': [spans[record.id][2] for record in records],
+    }
+
+    blob = bytearray()
+    strings_offsets = [0]
+
+    for string in strings:
+        blob.extend(string.encode())
+        strings_offsets.append(len(blob))
+
+    columns['strings_offsets'] = strings_offsets
+
+    extra_start = len(CategoryRecord.FIELDS)
+    extra_attnames = CategoryRecord.get_attnames(model)[extra_start:]
+    extra_blob = bytearray()
+    extra_offsets = [0]
+
+    for record in records:
+        extra_blob.extend(pickle.dumps(record._values[extra_start:], pickle.HIGHEST_PROTOCOL))
+        extra_offsets.append(len(extra_blob))
+
+    columns['extra_offsets'] = extra_offsets
+
+    chunks = []
+    layout = {}
+    offset = 0
+
+    for name, values in columns.items():
+        typecode, data = _pack_column(values)
+        layout[name] = (typecode, offset, len(values))
+        chunks.append(data)
+        offset += len(data)
+        padding = -offset % 8  # Keep columns aligned.
+        chunks.append(b'\0' * padding)
+        offset += padding
+
+    layout['strings'] = ('B', offset, len(blob))
+    chunks.append(bytes(blob))
+    offset += len(blob)
+
+    layout['extra'] = ('B', offset, len(extra_blob))
+    chunks.append(bytes(extra_blob))
+
+    header = marshal.dumps((FORMAT_VERSION, version, len(records), layout, extra_attnames))
+    header_size = len(MAGIC) + 4 + len(header)
+    header_padding = -header_size % 8
+
+    path = get_snapshot_path(directory, version)
+
+    with NamedTemporaryFile('wb', dir=directory, prefix=FILE_PREFIX, suffix='.tmp', delete=False) as f:
+        f.write(MAGIC)
+        f.write((len(header) + header_padding).to_bytes(4, 'little'))
+        f.write(header)
+        f.write(b'\0' * header_padding)
+        for chunk in chunks:
+            f.write(chunk)
+
+    os.replace(f.name, path)
+
+    for name in os.listdir(directory):
+        if name.startswith(FILE_PREFIX) and name.endswith(FILE_SUFFIX) and name != os.path.basename(path):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:  # pragma: nocover
+                pass
+
+    return path
+
+
+class Snapshot:
+    """Memory-mapped categories tree snapshot."""
+
+    def __init__(self, path: str, model: Type['CategoryBase']):
+        """
+        :param path: Snapshot file path.
+        :param model: Category model.
+
+        """
+        with open(path, 'rb') as f:
+            self._mmap = mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'Not a categories tree snapshot: {path}')
+
+        header_start = len(MAGIC) + 4
+        header_size = int.from_bytes(mm[len(MAGIC):header_start], 'little')
+        format_version, self.version, self.size, layout, *extra = marshal.loads(
+            mm[header_start:header_start + header_size])
+
+        if format_version != FORMAT_VERSION:
+            raise ValueError(f'Unsupported categories tree snapshot format: {format_version}')
+
+        if tuple(extra[0]) != CategoryRecord.get_attnames(model)[len(CategoryRecord.FIELDS):]:
+            raise ValueError(f'Categories tree snapshot is written for other category model fields: {path}')
+
+        view = memoryview(mm)
+        data_start = header_start + header_size
+        columns = {}
+
+        for name, (typecode, offset, count) in layout.items():
+            itemsize = array(typecode).itemsize
+            start = data_start + offset
+            columns[name] = view[start:start + count * itemsize].cast(typecode)
+
+        self.model = model
+        self._columns = columns
+        self._strings = columns['strings']
+        self._strings_offsets = columns['strings_offsets']
+        self._extra = columns['extra']
+        self._extra_offsets = columns['extra_offsets']
+
+    def string(self, idx: int) -> Optional[str]:
+        """Returns a string from interned strings table.
+
+        :param idx:
+
+        """
+        if idx == NULL:
+            return None
+        offsets = self._strings_offsets
+        return bytes(self._strings[offsets[idx]:offsets[idx + 1]]).decode()
+
+    def record(self, position: int) -> CategoryRecord:
+        """Spawns a category record for a position.
+
+        :param position:
+
+        """
+        columns = self._columns
+        string = self.string
+        parent = columns['parent'][position]
+        status = columns['status'][position]
+        extra_offsets = self._extra_offsets
+
+        return CategoryRecord(self.model, (
+            columns['id'][position],
+            string(columns['alias'][position]),
+            string(columns['title'][position]),
+            None if parent == NULL else columns['id'][parent],
+            columns['sort_order'][position],
+            string(columns['note'][position]),
+            None if status == NULL else status,
+            string(columns['slug'][position]),
+            columns['is_locked'][position] == 1,
+            *pickle.loads(self._extra[extra_offsets[position]:extra_offsets[position + 1]]),
+        ))
+
+    def position(self, category_id: int) -> Optional[int]:
+        """Returns a position of a category with the given ID (binary search).
+        None if there is no such category (or a non-integer is given, e.g. None parent ID).
+
+        :param category_id:
+
+        """
+        if not isinstance(category_id, int):
+            return None
+
+        ids = self._columns['id']
+        by_id = self._columns['by_id']
+        low, high = 0, len(by_id)
+
+        while low < high:
+            middle = (low + high) // 2
+            if ids[by_id[middle]] < category_id:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < len(by_id) and ids[by_id[low]] == category_id:
+            return by_id[low]
+
+        return None
+
+    def alias_position(self, alias: str) -> Optional[int]:
+        """Returns a position of a category with the given alias (binary search).
+        None if there is no such category (or a non-string is given).
+
+        :param alias:
+
+        """
+        if not isinstance(alias, str):
+            return None
+
+        aliases = self._columns['alias']
+        by_alias = self._columns['by_alias']
+        string = self.string
+        low, high = 0, len(by_alias)
+
+        while low < high:
+            middle = (low + high) // 2
+            if string(aliases[by_alias[middle]]) < alias:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < len(by_alias) and string(aliases[by_alias[low]]) == alias:
+            return by_alias[low]
+
+        return None
+
+    def children(self, parent_alias: Optional[str]) -> Optional[List[int]]:
+        """Returns positions of children of a category with the given alias
+        (or in `None` bucket) in sort order. None if there are no children.
+
+        :param parent_alias:
+
+        """
+        columns = self._columns
+
+        if parent_alias is None:
+            positions = columns['none_bucket'].tolist()
+
+        else:
+            parent = self.alias_position(parent_alias)
+
+            if parent is None:
+                return None
+
+            offsets = columns['children_offsets']
+            positions = columns['children'][offsets[parent]:offsets[parent + 1]].tolist()
+
+        return positions or None
+
+    def parent_keys(self) -> List[Optional[str]]:
+        """Returns keys of non-empty children buckets ordered by their first children sort orders."""
+
+        columns = self._columns
+        offsets = columns['children_offsets']
+        children = columns['children']
+        first = {}
+
+        if len(columns['none_bucket']):
+            first[None] = columns['none_bucket'][0]
+
+        for position in columns['by_alias']:
+            if offsets[position] != offsets[position + 1]:
+                first[self.string(columns['alias'][position])] = children[offsets[position]]
+
+        # Positions follow sort order.
+        return sorted(first, key=first.__getitem__)
+
+    def get_structure(self, names: Dict[str, str]) -> dict:
+        """Returns categories tree cache structure (see `Cache`) made of views over this snapshot.
+
+        :param names: Structure entries names: ids, aliases, parents, version,
+            child_parents, parent_ranks, titles, tree_order, tree_spans.
+
+        """
+        return {
+            names['ids']: RecordsById(self),
+            names['aliases']: RecordsByAlias(self),
+            names['parents']: ChildrenByParent(self),
+            names['version']: self.version,
+            names['child_parents']: ParentByChild(self),
+            names['parent_ranks']: ParentRanks(self),
+            names['titles']: TitlesByParent(self),
+            names['tree_order']: TreeOrder(self),
+            names['tree_spans']: TreeSpans(self),
+        }
+
+
+class SnapshotView:
+    """Base for views over snapshot data."""
+
+    def __init__(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+        self.columns = snapshot._columns
+
+
+class RecordsById(SnapshotView, Mapping):
+    """Category ID -> category record."""
+
+    def __getitem__(self, category_id: int) -> CategoryRecord:
+        position = self.snapshot.position(category_id)
+        if position is None:
+            raise KeyError(category_id)
+        return self.snapshot.record(position)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.columns['id'].tolist())
+
+    def __len__(self) -> int:
+        return self.snapshot.size
+
+
+class RecordsByAlias(SnapshotView, Mapping):
+    """Category alias -> category record."""
+
+    def __getitem__(self, alias: str) -> CategoryRecord:
+        position = self.snapshot.alias_position(alias)
+        if position is None:
+            raise KeyError(alias)
+        return self.snapshot.record(position)
+
+    def __iter__(self) -> Iterator[str]:
+        string = self.snapshot.string
+        aliases = self.columns['alias']
+        return (string(aliases[position]) for position in self.columns['by_alias'])
+
+    def __len__(self) -> int:
+        return len(self.columns['by_alias'])
+
+
+class ChildrenByParent(SnapshotView, Mapping):
+    """Parent alias (None for root categories and children of alias-less ones) -> children IDs."""
+
+    def __getitem__(self, parent_alias: Optional[str]) -> List[int]:
+        positions = self.snapshot.children(parent_alias)
+        if positions is None:
+            raise KeyError(parent_alias)
+        ids = self.columns['id']
+        return [ids[position] for position in positions]
+
+    def __iter__(self) -> Iterator[Optional[str]]:
+        return iter(self.snapshot.parent_keys())
+
+    def __len__(self) -> int:
+        return len(self.snapshot.parent_keys())
+
+
+class ParentByChild(SnapshotView, Mapping):
+    """Category ID -> parent alias (None for root categories and children of alias-less ones)."""
+
+    def __getitem__(self, category_id: int) -> Optional[str]:
+        position = self.snapshot.position(category_id)
+        if position is None:
+            raise KeyError(category_id)
+        parent = self.columns['parent'][position]
+        return None if parent == NULL else self.snapshot.string(self.columns['alias'][parent])
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.columns['id'].tolist())
+
+    def __len__(self) -> int:
+        return self.snapshot.size
+
+
+class ParentRanks(SnapshotView, Mapping):
+    """Parent alias -> rank. Parents are ranked by sort order of their first children."""
+
+    def __getitem__(self, parent_alias: Optional[str]) -> int:
+        positions = self.snapshot.children(parent_alias)
+        if positions is None:
+            raise KeyError(parent_alias)
+        return positions[0]
+
+    def __iter__(self) -> Iterator[Optional[str]]:
+        return iter(self.snapshot.parent_keys())
+
+    def __len__(self) -> int:
+        return len(self.snapshot.parent_keys())
+
+
+class TitlesByParent(SnapshotView, Mapping):
+    """Parent alias -> {case folded title: category ID}."""
+
+    def __getitem__(self, parent_alias: Optional[str]) -> Dict[str, int]:
+        positions = self.snapshot.children(parent_alias)
+        if positions is None:
+            raise KeyError(parent_alias)
+
+        string = self.snapshot.string
+        ids = self.columns['id']
+        titles = self.columns['title']
+        found = {}
+
+        for position in positions:
+            # The first one wins as in sequential search.
+            found.setdefault(string(titles[position]).casefold(), ids[position])
+
+        return found
+
+    def __iter__(self) -> Iterator[Optional[str]]:
+        return iter(self.snapshot.parent_keys())
+
+    def __len__(self) -> int:
+        return len(self.snapshot.parent_keys())
+
+
+class TreeOrder(SnapshotView, Sequence):
+    """Category IDs in tree order."""
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[int, List[int]]:
+        ids = self.columns['id']
+        order = self.columns['order']
+
+        if isinstance(idx, slice):
+            return [ids[position] for position in order[idx]]
+
+        return ids[order[idx]]
+
+    def __len__(self) -> int:
+        return len(self.columns['order'])
+
+
+class TreeSpans(SnapshotView, Mapping):
+    """Category ID -> (enter, leave, depth) in tree order."""
+
+    def __getitem__(self, category_id: int) -> Tuple[int, int, int]:
+        position = self.snapshot.position(category_id)
+        if position is None:
+            raise KeyError(category_id)
+        columns = self.columns
+        return columns['enter'][position], columns['leave'][position], columns['depth'][position]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.columns['id'].tolist())
+
+    def __len__(self) -> int:
+        return self.snapshot.size
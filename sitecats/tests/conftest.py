@@ -1,4 +1,16 @@
+import pytest
 from pytest_djangoapp import configure_djangoapp_plugin
 
 
 pytest_plugins = configure_djangoapp_plugin()
+
+
+@pytest.fixture(autouse=True)
+def reset_categories_cache():
+    # Test transactions are rolled back without signals,
+    # so cached categories from previous tests are dropped here.
+    from django.core.cache import cache
+    from sitecats.utils import get_cache
+
+    cache.clear()
+    get_cache()._cache = None
@@ -9,7 +9,8 @@ from sitecats.exceptions import SitecatsLockedCategoryDelete, SitecatsConfigurat
 from sitecats.models import Category, Tie
 from sitecats.settings import UNRESOLVED_URL_MARKER
 from sitecats.toolbox import CategoryList, get_category_aliases_under, get_tie_model, \
-    get_category_model
+    get_category_model, get_category_lists, get_category_lists_bulk
+from sitecats.utils import get_cache
 
 MODEL_TIE = get_tie_model()
 MODEL_CATEGORY = get_category_model()
@@ -235,6 +236,38 @@ class TestTie:
         assert len(linked[cat3]) == 1
 
 
+    def test_iter_linked_objects(self, user, create_article, create_comment, create_category):
+        cat1 = create_category()
+        cat2 = create_category()
+
+        article1 = create_article()
+        article2 = create_article()
+        article3 = create_article()
+        comment1 = create_comment()
+
+        article1.add_to_category(cat1, user)
+        article2.add_to_category(cat1, user)
+        article3.add_to_category(cat1, user)
+        article2.add_to_category(cat2, user)
+        comment1.add_to_category(cat2, user)
+
+        chunks = list(MODEL_TIE.iter_linked_objects(chunk_size=2))
+        assert chunks == [
+            (Comment, [comment1.id]),
+            (Article, [article1.id, article2.id]),
+            (Article, [article3.id]),
+        ] or chunks == [
+            (Article, [article1.id, article2.id]),
+            (Article, [article3.id]),
+            (Comment, [comment1.id]),
+        ]
+
+        chunks = list(MODEL_TIE.iter_linked_objects(by_category=True, filter_kwargs={'object_id__in': [
+            article1.id, article2.id, article3.id]}))
+        assert (cat1, Article, [article1.id, article2.id, article3.id]) in chunks
+        assert (cat2, Article, [article2.id]) in chunks
+
+
 class TestModelWithCategory:
 
     # TODO set_category_lists_init_kwargs, get_category_lists, enable_category_lists_editor
@@ -249,6 +282,192 @@ class TestModelWithCategory:
         assert tie.category == cat
         assert tie.creator == user
 
+    def test_bulk_add_to_category(self, user, create_article, create_comment, create_category, monkeypatch):
+        from sitecats import models
+
+        monkeypatch.setattr(models, 'TIES_COUNT', True)
+
+        cat1 = create_category()
+        cat2 = create_category()
+
+        article1 = create_article()
+        article2 = create_article()
+        comment1 = create_comment()
+
+        article1.add_to_category(cat1, user)
+
+        created = Article.bulk_add_to_category({
+            article1: [cat1, cat2.id],
+            article2: [cat1, cat2, cat2],
+            comment1: [cat2],
+        }, user, batch_size=2)
+
+        assert created == 4
+        assert len(Article.get_ties_for_categories_qs([cat1])) == 2
+        assert len(Article.get_ties_for_categories_qs([cat2])) == 2
+        assert len(Comment.get_ties_for_categories_qs([cat2])) == 1
+
+        cat1.refresh_from_db()
+        cat2.refresh_from_db()
+        assert cat1.ties_count == 2
+        assert cat2.ties_count == 3
+
+        assert Article.bulk_add_to_category([(article1, cat1), (comment1, cat2)], user) == 0
+
+        # Counters are consistent with ties created before a failure.
+        article3 = create_article()
+        article4 = create_article()
+        tie_model = models.get_tie_model()
+        bulk_create = tie_model.objects.bulk_create
+        calls = []
+
+        def bulk_create_failing(ties, **kwargs):
+            calls.append(ties)
+            if len(calls) > 1:
+                raise ValueError
+            return bulk_create(ties, **kwargs)
+
+        monkeypatch.setattr(tie_model.objects, 'bulk_create', bulk_create_failing)
+
+        with pytest.raises(ValueError):
+            Article.bulk_add_to_category([(article3, cat1), (article4, cat1)], user, batch_size=1)
+
+        cat1.refresh_from_db()
+        assert cat1.ties_count == len(Article.get_ties_for_categories_qs([cat1])) == 3
+
+    def test_bulk_remove_from_category(self, user, create_article, create_comment, create_category, monkeypatch):
+        from sitecats import models
+
+        monkeypatch.setattr(models, 'TIES_COUNT', True)
+
+        cat1 = create_category()
+        cat2 = create_category()
+        cat3 = create_category()
+
+        article1 = create_article()
+        article2 = create_article()
+        comment1 = create_comment()
+
+        Article.bulk_add_to_category({
+            article1: [cat1, cat2, cat3],
+            article2: [cat1, cat2, cat3],
+            comment1: [cat1, cat2],
+        }, user)
+
+        assert Article.bulk_remove_from_category([cat1, cat2], Article.objects.filter(id=article1.id)) == 2
+        assert len(Article.get_ties_for_categories_qs([cat1, cat2, cat3])) == 4
+
+        assert Article.bulk_remove_from_category(cat3.id, [article2]) == 1
+        assert len(Article.get_ties_for_categories_qs([cat3])) == 1
+
+        assert Article.bulk_remove_from_category(cat1) == 1
+        assert len(Article.get_ties_for_categories_qs([cat1])) == 0
+        assert len(Comment.get_ties_for_categories_qs([cat1])) == 1
+
+        cat1.refresh_from_db()
+        cat3.refresh_from_db()
+        assert cat1.ties_count == 1
+        assert cat3.ties_count == 1
+
+    def test_merge_categories(self, user, create_article, create_category, monkeypatch):
+        from sitecats import models
+
+        monkeypatch.setattr(models, 'TIES_COUNT', True)
+
+        cat1 = create_category()
+        cat2 = create_category()
+
+        article1 = create_article()
+        article2 = create_article()
+
+        Article.bulk_add_to_category({article1: [cat1, cat2], article2: [cat1]}, user)
+
+        assert MODEL_TIE.merge_categories(cat1, cat2.id) == 1
+        assert len(Article.get_ties_for_categories_qs([cat1])) == 0
+        assert set(Article.get_from_category_qs(cat2)) == {article1, article2}
+
+        cat1.refresh_from_db()
+        cat2.refresh_from_db()
+        assert cat1.ties_count == 0
+        assert cat2.ties_count == 2
+
+        # All or nothing.
+        cat3 = create_category()
+        Article.bulk_add_to_category({article1: [cat3], article2: [cat3]}, user)
+
+        def fail(deltas):
+            raise ValueError
+
+        monkeypatch.setattr(Category, 'shift_ties_counts', fail)
+
+        with pytest.raises(ValueError):
+            MODEL_TIE.merge_categories(cat2, cat3)
+
+        assert len(Article.get_ties_for_categories_qs([cat2])) == 2
+
+        monkeypatch.undo()
+
+        # Dependent objects are deleted by cascade.
+        from sitecats.tests.testapp.models import TieNote
+
+        note = TieNote.objects.create(tie=Article.get_ties_for_categories_qs([cat2]).get(object_id=article1.id))
+
+        assert MODEL_TIE.merge_categories(cat2, cat3) == 0
+        assert len(Article.get_ties_for_categories_qs([cat3])) == 2
+        assert not TieNote.objects.filter(id=note.id).exists()
+
+    def test_tie_unique(self, user, create_article, create_category, command_run, monkeypatch):
+        from django import VERSION as DJANGO_VERSION
+        from django.apps import apps
+        from django.db import IntegrityError, transaction
+
+        cat = create_category()
+        article = create_article()
+        tie = article.add_to_category(cat, user)
+
+        command_run('sitecats_tie_unique')
+
+        with pytest.raises(IntegrityError):
+            with transaction.atomic():
+                MODEL_TIE.objects.create(
+                    category=cat, content_type=tie.content_type, object_id=article.id, creator=user)
+
+        assert MODEL_TIE.has_unique()
+
+        # Ties created concurrently do not fail bulk addition.
+        article2 = create_article()
+        bulk_create = MODEL_TIE.objects.bulk_create
+
+        def bulk_create_concurrently(ties, **kwargs):
+            MODEL_TIE.objects.create(
+                category=cat, content_type=tie.content_type, object_id=article2.id, creator=user)
+            return bulk_create(ties, **kwargs)
+
+        with monkeypatch.context() as patch:
+            patch.setattr(MODEL_TIE.objects, 'bulk_create', bulk_create_concurrently)
+
+            if DJANGO_VERSION >= (2, 2):
+                Article.bulk_add_to_category([(article2, cat)], user)
+                assert len(Article.get_ties_for_categories_qs([cat])) == 2
+
+            else:
+                with pytest.raises(IntegrityError):
+                    Article.bulk_add_to_category([(article2, cat)], user)
+
+        command_run('sitecats_tie_unique', options={'drop': True})
+        assert not MODEL_TIE.has_unique()
+
+        # Lost index is restored on migrate if SITECATS_TIES_UNIQUE is set.
+        config = apps.get_app_config('sitecats')
+        config._restore_ties_unique(using='other')
+        assert not MODEL_TIE.has_unique()
+        config._restore_ties_unique(using='default')
+        config._restore_ties_unique(using='default')
+        assert MODEL_TIE.has_unique()
+        MODEL_TIE.set_unique(False)
+        article.add_to_category(cat, user)
+        assert Article.get_ties_for_categories_qs([cat]).filter(object_id=article.id).count() == 2
+
     def test_remove_from_category(self, user, create_article, create_category):
         cat = create_category()
 
@@ -262,6 +481,54 @@ class TestModelWithCategory:
         ties = Article.get_ties_for_categories_qs([cat])
         assert len(ties) == 0
 
+    def test_ties_count(self, user, create_article, create_category, monkeypatch, command_run):
+        from sitecats import models
+
+        # Counter is opt-in for custom category models.
+        assert 'ties_count' not in {field.name for field in models.CategoryBase._meta.local_fields}
+        assert issubclass(Category, models.CategoryTiesCountMixin)
+
+        monkeypatch.setattr(models, 'TIES_COUNT', True)
+
+        cat1 = create_category()
+        cat2 = create_category()
+        article1 = create_article()
+        article2 = create_article()
+
+        article1.add_to_category(cat1, user)
+        article2.add_to_category(cat1, user)
+        article2.add_to_category(cat2, user)
+        article2.remove_from_category(cat1)
+
+        cat1.refresh_from_db()
+        cat2.refresh_from_db()
+        assert cat1.ties_count == 1
+        assert cat2.ties_count == 1
+
+        # Tie is written along with the counter or not at all.
+        def fail(*args, **kwargs):
+            raise ValueError
+
+        with monkeypatch.context() as patch:
+            patch.setattr(Category, 'shift_ties_count', fail)
+
+            with pytest.raises(ValueError):
+                article1.add_to_category(cat2, user)
+
+            with pytest.raises(ValueError):
+                article1.remove_from_category(cat1)
+
+        assert article1.categories.filter(category=cat1).exists()
+        assert not article1.categories.filter(category=cat2).exists()
+
+        Category.objects.update(ties_count=10)
+        command_run('sitecats_recount_ties', options={'chunk_size': 1})
+
+        cat1.refresh_from_db()
+        cat2.refresh_from_db()
+        assert cat1.ties_count == 1
+        assert cat2.ties_count == 1
+
     def test_get_ties_for_categories_qs(self, user_create, create_article, create_category):
 
         user = user_create()
@@ -302,6 +569,71 @@ class TestModelWithCategory:
         assert len(comments_in_cat) == 1
         assert comment in comments_in_cat
 
+    def test_get_from_category_qs_descendants(self, user, create_article, create_category, db_queries):
+        cat1 = create_category()
+        cat11 = create_category(parent=cat1)
+        cat111 = create_category(parent=cat11)
+        cat2 = create_category()
+
+        article1 = create_article()
+        article2 = create_article()
+        article3 = create_article()
+
+        article1.add_to_category(cat1, user)
+        article1.add_to_category(cat11, user)
+        article2.add_to_category(cat111, user)
+        article3.add_to_category(cat2, user)
+
+        assert list(Article.get_from_category_qs(cat1)) == [article1]
+
+        get_cache().get_category_by_id(cat1.id)  # Warm up cache.
+
+        with db_queries.scope() as queries:
+            articles = Article.get_from_category_qs(cat1, include_descendants=True)
+            assert set(articles) == {article1, article2}
+            assert len(queries) == 1
+
+        assert set(Article.get_from_category_qs(cat111.id, include_descendants=True)) == {article2}
+
+    def test_filter_by_categories(self, user, create_article, create_category, db_queries):
+        python = create_category(alias='python')
+        django = create_category(alias='django', parent=python)
+        archived = create_category(alias='archived')
+
+        article1 = create_article()
+        article2 = create_article()
+        article3 = create_article()
+        article4 = create_article()
+
+        article1.add_to_category(python, user)
+        article1.add_to_category(django, user)
+        article2.add_to_category(python, user)
+        article2.add_to_category(django, user)
+        article2.add_to_category(archived, user)
+        article3.add_to_category(django, user)
+        article4.add_to_category(python, user)
+
+        def filter_ids(**kwargs):
+            return set(Article.filter_by_categories(**kwargs).values_list('id', flat=True))
+
+        get_cache().get_category_by_id(python.id)  # Warm up cache.
+
+        with db_queries.scope() as queries:
+            assert filter_ids(all_of=['python', django.id], none_of=[archived]) == {article1.id}
+            assert len(queries) == 1
+
+        assert filter_ids(all_of=['python', 'django']) == {article1.id, article2.id}
+        assert filter_ids(any_of=['python', 'archived']) == {article1.id, article2.id, article4.id}
+        assert filter_ids(none_of=['python']) == {article3.id}
+        assert filter_ids(all_of=['python'], include_descendants=True) == {
+            article1.id, article2.id, article3.id, article4.id}
+        assert filter_ids(all_of=['python', 'archived'], include_descendants=True) == {article2.id}
+        assert filter_ids(all_of=['python', 'unknown']) == set()
+        assert filter_ids(any_of=['unknown']) == set()
+        assert filter_ids(none_of=['unknown']) == {article1.id, article2.id, article3.id, article4.id}
+        assert set(Article.filter_by_categories(
+            all_of=['django'], queryset=Article.objects.exclude(id=article3.id))) == {article1, article2}
+
 
 class TestToolbox:
 
@@ -324,6 +656,191 @@ class TestToolbox:
         assert 'cat11' in under_cat1
 
 
+    def test_get_category_lists_bulk(
+            self, user, create_article, create_comment, create_category, db_queries, template_render_tag,
+            template_context):
+
+        cat1 = create_category(alias='cat1')
+        cat2 = create_category(alias='cat2')
+        cat11 = create_category(parent=cat1)
+        cat12 = create_category(parent=cat1)
+        cat21 = create_category(parent=cat2)
+
+        article1 = create_article()
+        article2 = create_article()
+        article3 = create_article()
+        comment1 = create_comment()
+
+        article1.add_to_category(cat11, user)
+        article1.add_to_category(cat21, user)
+        article2.add_to_category(cat12, user)
+        comment1.add_to_category(cat11, user)
+
+        def dump(lists):
+            return [(lst.alias, [cat.id for cat in lst.get_categories()]) for lst in lists]
+
+        objs = [article1, article2, article3, comment1]
+        expected = {obj: dump(get_category_lists(obj=obj)) for obj in objs}
+
+        get_cache().get_category_by_id(cat1.id)  # Warm up cache.
+
+        with db_queries.scope() as queries:
+            lists = get_category_lists_bulk(Article.objects.filter(id__in=[article1.id, article2.id, article3.id]))
+            assert len(queries) == 2  # Objects and ties.
+
+            lists.update(get_category_lists_bulk([comment1], additional_parents_aliases=['cat2']))
+
+        assert len(lists) == 4
+
+        for obj, obj_lists in lists.items():
+            if obj == comment1:
+                assert dump(obj_lists) == [('cat1', [cat11.id]), ('cat2', [])]
+            else:
+                assert dump(obj_lists) == expected[obj]
+
+        # Prefetched.
+        with db_queries.scope() as queries:
+            assert dump(comment1.get_category_lists()) == [('cat1', [cat11.id]), ('cat2', [])]
+            context = template_context({'obj': comment1})
+            result = template_render_tag('sitecats', 'sitecats_categories from obj', context)
+            assert ('data-catid="%s"' % cat11.id) in result
+            assert len(queries) == 0
+
+        # Prefetched lists are dropped on changes.
+        comment1.add_to_category(cat12, user)
+        assert {cat.id for cat in comment1.get_category_lists()[0].get_categories()} == {cat11.id, cat12.id}
+
+        get_category_lists_bulk([comment1])
+        comment1.remove_from_category(cat11)
+        assert dump(comment1.get_category_lists()) == [('cat1', [cat12.id])]
+
+        get_category_lists_bulk([comment1])
+        comment1.set_category_lists_init_kwargs({'show_title': True})
+        assert all(lst.show_title for lst in comment1.get_category_lists())
+
+
+class TestDbTree:
+
+    def test_all(self, user, create_article, create_comment, create_category, db_queries):
+        from sitecats import dbtree
+
+        cat1 = create_category()
+        cat11 = create_category(parent=cat1)
+        cat111 = create_category(parent=cat11)
+        cat12 = create_category(parent=cat1)
+        cat2 = create_category()
+
+        assert set(dbtree.get_descendant_ids(cat1)) == {cat11.id, cat111.id, cat12.id}
+        assert set(dbtree.get_descendant_ids(cat11.id, include_self=True)) == {cat11.id, cat111.id}
+        assert dbtree.get_descendant_ids(cat2) == []
+
+        assert dbtree.get_ancestor_ids(cat111) == [cat1.id, cat11.id]
+        assert dbtree.get_ancestor_ids(cat1) == []
+
+        article1 = create_article()
+        article2 = create_article()
+        comment1 = create_comment()
+
+        article1.add_to_category(cat1, user)
+        article2.add_to_category(cat111, user)
+        comment1.add_to_category(cat12, user)
+        article1.add_to_category(cat2, user)
+
+        with db_queries.scope() as queries:
+            assert len(dbtree.get_subtree_ties_qs(cat1)) == 3
+            assert len(queries) == 1
+
+        assert len(dbtree.get_subtree_ties_qs(cat1, include_self=False)) == 2
+        assert len(dbtree.get_subtree_ties_qs(cat1, model=Comment)) == 1
+
+        assert set(dbtree.get_subtree_objects_qs(Article, cat1)) == {article1, article2}
+        assert set(dbtree.get_subtree_objects_qs(Article, cat11)) == {article2}
+        assert set(dbtree.get_subtree_objects_qs(Article, cat1, include_self=False)) == {article2}
+
+
+class TestExchange:
+
+    def dump_tree(self):
+        return sorted(
+            (cat.title, cat.alias, cat.parent.title if cat.parent else None, cat.sort_order > 0)
+            for cat in Category.objects.select_related('parent'))
+
+    @pytest.mark.parametrize('fmt', ['jsonl', 'csv'])
+    def test_export_import(self, user, create_category, fmt):
+        from io import StringIO
+        from sitecats.exchange import export_categories, import_categories, read_records
+
+        cat1 = create_category('one', alias='cat1')
+        cat11 = create_category('one-one', parent=cat1, slug='cat11')
+        create_category('one-one-one', parent=cat11)
+        create_category('one-two', parent=cat1, sort_order=5)
+        create_category('two')
+
+        expected = self.dump_tree()
+
+        stream = StringIO()
+        assert export_categories(stream, fmt=fmt) == 5
+        exported = stream.getvalue()
+
+        Category.objects.all().delete()
+
+        assert import_categories(read_records(StringIO(exported), fmt=fmt), user, batch_size=2) == 5
+        assert self.dump_tree() == expected
+        assert Category.objects.get(title='one-two').sort_order == 5
+        assert get_cache().get_child_ids('cat1') == [
+            Category.objects.get(title='one-two').id, Category.objects.get(title='one-one').id]
+
+        # Existing are skipped.
+        assert import_categories(read_records(StringIO(exported), fmt=fmt), user) == 0
+
+    def test_import_addressing(self, user, create_category):
+        from sitecats.exceptions import SitecatsImportError
+        from sitecats.exchange import import_categories
+
+        create_category('root', alias='root')
+
+        records = [
+            {'title': 'deep', 'parent_path': 'root / sub'},  # Parent comes later.
+            {'title': 'sub', 'parent_alias': 'root', 'slug': 'sub'},
+            {'title': 'by slug', 'parent_slug': 'sub'},
+        ]
+        assert import_categories(records, user, path_separator=' / ') == 3
+        assert Category.objects.get(title='deep').parent.title == 'sub'
+        assert Category.objects.get(title='by slug').parent.title == 'sub'
+
+        with pytest.raises(SitecatsImportError):
+            import_categories([{'title': 'orphan', 'parent_alias': 'unknown'}], user)
+
+    def test_import_failure(self, user, create_category):
+        from django.db import IntegrityError
+        from sitecats.exchange import import_categories
+
+        create_category('root', alias='root')
+        cats = get_cache()
+        assert cats.get_category_by_alias('root')
+
+        # The second batch fails on duplicate alias.
+        records = [{'title': 'a', 'alias': 'a'}, {'title': 'b', 'alias': 'b'}, {'title': 'c', 'alias': 'root'}]
+
+        with pytest.raises(IntegrityError):
+            import_categories(records, user, batch_size=2)
+
+        # Categories created before the failure are cached.
+        assert cats.get_category_by_alias('a').title == 'a'
+        assert cats.get_category_by_alias('b').title == 'b'
+
+    def test_commands(self, user, create_category, command_run, tmp_path):
+        create_category('one', alias='cat1')
+
+        target = tmp_path / 'cats.csv'
+        command_run('sitecats_export', options={'output': str(target)})
+
+        Category.objects.all().delete()
+
+        command_run('sitecats_import', args=[str(target)], options={'user': user.username})
+        assert Category.objects.get(alias='cat1').title == 'one'
+
+
 class TestCategoryListBasic:
 
     @pytest.fixture
@@ -472,4 +989,831 @@ class TestCategoryListWithObj:
         assert self.cat11 in cats
 
 
+class CacheSpy:
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.gets = []
+
+    def get(self, key, *args, **kwargs):
+        self.gets.append(key)
+        return self.cache.get(key, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+
+@pytest.fixture
+def cache_spy(monkeypatch):
+    from django.core.cache import cache
+    from sitecats import utils
+
+    spy = CacheSpy(cache)
+    monkeypatch.setattr(utils, 'cache', spy)
+
+    return spy
+
+
+class TestCache:
+
+    def test_records(self, user, create_category, create_article, db_queries):
+        from pickle import dumps, loads
+        from sitecats.records import CategoryRecord, TiedCategory
+
+        cat1 = create_category(alias='cat1', note='some')
+        cat11 = create_category(alias='cat11', parent=cat1)
+        cat12 = create_category(alias='cat12', parent=cat1)
+
+        cats = get_cache()
+        record = cats.get_category_by_alias('cat11')
+
+        assert isinstance(record, CategoryRecord)
+        assert record == cat11
+        assert cat11 == record
+        assert cat11 in [record]
+        assert record != cat12
+        assert cat12 != record
+        assert {cat11: 1}[record] == 1
+        assert record.parent_id == cat1.id
+        assert str(record) == str(cat11)
+        assert loads(dumps(record)) == record
+
+        with pytest.raises(AttributeError):
+            record.title = 'other'
+
+        # Hydration.
+        hydrated = record.hydrate()
+        assert isinstance(hydrated, Category)
+        assert hydrated.pk == cat11.pk
+        assert hydrated.title == cat11.title
+        assert hydrated.get_deferred_fields() == set()
+        assert record.hydrate() is not hydrated
+
+        # All concrete fields are stored.
+        with db_queries.scope() as queries:
+            assert record.time_created == cat11.time_created
+            assert record.time_created == cat11.time_created
+            assert record.creator_id == cat11.creator_id
+            assert record.hydrate().time_modified == cat11.time_modified
+            assert str(record) == str(cat11)
+            assert len(queries) == 0
+
+        # Other attributes are taken from an instance hydrated once.
+        with db_queries.scope() as queries:
+            assert record.creator == cat11.creator
+            assert record.creator == cat11.creator
+            assert len(queries) == 1
+
+        with pytest.raises(AttributeError):
+            del record.title
+
+        # Records are not model instances for ORM.
+        with pytest.raises(TypeError):
+            Category.objects.filter(parent=cats.get_category_by_alias('cat1')).count()
+
+        assert Category.objects.filter(parent=cats.get_category_by_alias('cat1').hydrate()).count() == 2
+
+        with pytest.raises(AttributeError):
+            record._unknown
+
+        # Records work as model instances in API.
+        article1 = create_article()
+        article2 = create_article()
+        article1.add_to_category(record, user)
+        article1.add_to_category(cats.get_category_by_alias('cat12'), user)
+        article2.add_to_category(record, user)
+        assert set(Article.get_from_category_qs(record)) == {article1, article2}
+
+        Category.add('new', user, parent=cats.get_category_by_alias('cat1'))
+        assert len(cats.get_child_ids('cat1')) == 3
+
+        # Ties stats are not shared.
+        stats1 = cats.get_categories('cat1', article1)
+        stats2 = cats.get_categories('cat1', article2)
+        assert all(isinstance(cat, TiedCategory) for cat in stats1)
+        assert {cat.id: cat.ties_num for cat in stats1} == {cat11.id: 1, cat12.id: 1}
+        assert {cat.id: cat.ties_num for cat in stats2} == {cat11.id: 1}
+        assert stats2[0] == record
+        assert stats2[0].title == record.title
+
+        article2.remove_from_category(stats2[0])
+        assert list(Article.get_from_category_qs(record)) == [article1]
+
+    @pytest.mark.parametrize('pack', [True, 'zlib'])
+    def test_pack(self, create_category, monkeypatch, pack):
+        from django.core.cache import cache
+        from sitecats import utils
+        from sitecats.records import CategoryRecord
+
+        monkeypatch.setattr(utils, 'CACHE_PACK', pack)
+
+        cat1 = create_category(alias='cat1', note='some')
+        cat11 = create_category(parent=cat1)
+        cat111 = create_category(alias='cat111', parent=cat11)
+        cat2 = create_category()
+        Category.objects.filter(id=cat2.id).update(status=5, slug='two', is_locked=True)
+
+        cats = get_cache()
+        cats.invalidate()
+        built = cats._cache_build(cats._cache_get_version())
+        cats.get_category_by_id(cat1.id)
+
+        assert isinstance(cache.get(cats.CACHE_ENTRY_NAME), bytes)
+
+        cats._cache = None
+        cats._checked = None
+        unpacked = cats._cache_fetch()
+
+        for name, value in built.items():
+            if name in (cats.CACHE_NAME_IDS, cats.CACHE_NAME_ALIASES):
+                assert {key: record._values for key, record in unpacked[name].items()} == {
+                    key: record._values for key, record in value.items()}
+            elif isinstance(value, dict):
+                assert list(unpacked[name].items()) == list(value.items())
+            else:
+                assert unpacked[name] == value
+
+        record = cats.get_category_by_id(cat2.id)
+        assert (record.status, record.slug, record.is_locked, record.parent_id) == (5, 'two', True, None)
+        assert cats.get_category_by_alias('cat111').parent_id == cat11.id
+        assert cats.get_descendant_ids('cat1') == [cat11.id, cat111.id]
+
+        # Patched tree is packed too.
+        cat12 = create_category(alias='cat12', parent=cat1)
+        cats._cache = None
+        assert cats.get_child_ids('cat1') == [cat11.id, cat12.id]
+
+        # Empty tree is unpacked as well, not rebuilt on every check.
+        Category.objects.all().delete()
+        cats.invalidate()
+        assert cats.get_category_by_id(cat1.id) is None
+        rebuilds = cats.get_stats()['rebuilds']
+        cats._cache = None
+        assert cats.get_category_by_id(cat1.id) is None
+        assert cats.get_stats()['rebuilds'] == rebuilds
+
+        # Tree packed for other model fields is rebuilt.
+        monkeypatch.setitem(CategoryRecord._attnames, Category, CategoryRecord.FIELDS)
+        assert cats._cache_fetch() is None
+
+    def test_sharded(self, user, create_category, monkeypatch):
+        from django.core.cache import cache
+        from sitecats import sharding
+        from sitecats.sharding import ShardedCache
+
+        monkeypatch.setattr(sharding, 'CACHE_SHARD_DEPTH', 1)
+
+        root = create_category(alias='root')
+        b1 = create_category(alias='b1', parent=root)
+        b2 = create_category(alias='b2', parent=root)
+        c11 = create_category(alias='c11', parent=b1)
+        c111 = create_category(alias='c111', parent=c11)
+        c21 = create_category(alias='c21', parent=b2)
+
+        cats = get_cache()
+        sharded = ShardedCache()
+
+        assert sharded.get_child_ids(None) == [root.id]
+        assert sharded.get_child_ids('root') == [b1.id, b2.id]
+        assert not sharded._branches
+        assert sharded.get_child_ids('c11') == [c111.id]
+        assert sharded.get_category_by_alias('c111') == c111
+        assert list(sharded._branches) == [b1.id]
+
+        assert sharded.get_category_by_id(c21.id) == c21
+        assert sharded.get_depth(c111.id) == cats.get_depth(c111.id) == 3
+        assert sharded.get_descendant_ids(None) == cats.get_descendant_ids(None)
+        assert sharded.get_descendant_ids('root') == cats.get_descendant_ids('root')
+        assert sharded.get_subtree_ids(b1.id, include_self=False) == [c11.id, c111.id]
+        assert sharded.is_descendant(c111.id, root.id)
+        assert not sharded.is_descendant(c111.id, b2.id)
+        assert sharded.get_ancestors(c111.id) == [root, b1, c11]
+        assert sharded.find_category('b1', c11.title.upper()) == c11
+        assert sharded.sort_aliases(['c11', 'b2', 'root', 'b1', 'c21']) == cats.sort_aliases(
+            ['c11', 'b2', 'root', 'b1', 'c21'])
+        assert sharded.get_parents_for([c111.id, c21.id]) == cats.get_parents_for([c111.id, c21.id])
+
+        # Evicted branch is built from DB.
+        cache.delete(sharded._branch_key(b1.id, sharded._cache[sharded.INDEX_BRANCHES][b1.id]))
+        sharded._branches.clear()
+        assert sharded.get_child_ids('c11') == [c111.id]
+        assert sharded.get_subtree_ids(b1.id) == [b1.id, c11.id, c111.id]
+
+        # Evicted routing maps are built from DB without tree invalidation.
+        version = cache.get(sharded.CACHE_ENTRY_VERSION)
+        index = sharded._cache
+
+        for entry_name, chunk_id in list(sharded._chunks):
+            chunk_version = index[sharded._chunks_indexes[entry_name]][chunk_id]
+            cache.delete(sharded._chunk_key(entry_name, chunk_id, chunk_version))
+
+        sharded._chunks.clear()
+        sharded._branches.clear()
+        assert sharded.get_category_by_id(c111.id) == c111
+        assert sharded.get_category_by_alias('c21') == c21
+        assert sharded.get_category_by_alias('b1') == b1
+        assert cache.get(sharded.CACHE_ENTRY_VERSION) == version
+        assert sharded._cache is index
+
+        # Only affected branch is invalidated.
+        branches = dict(sharded._cache[sharded.INDEX_BRANCHES])
+        c112 = create_category(alias='c112', parent=c11)
+        assert sharded.get_child_ids('c11') == [c111.id, c112.id]
+        assert sharded._cache[sharded.INDEX_BRANCHES][b1.id] != branches[b1.id]
+        assert sharded._cache[sharded.INDEX_BRANCHES][b2.id] == branches[b2.id]
+
+        # Move between branches.
+        c112.parent = b2
+        c112.alias = 'c22'
+        c112.save()
+        assert sharded.get_child_ids('c11') == [c111.id]
+        assert sharded.get_child_ids('b2') == [c21.id, c112.id]
+        assert sharded.get_category_by_alias('c22') == c112
+        assert sharded.get_category_by_alias('c112') is None
+
+        # Subtree move rebuilds everything.
+        c11.parent = b2
+        c11.save()
+        assert sharded._cache is None
+        assert sharded.get_ancestors(c111.id) == [root, b2, c11]
+
+        # Head change rebuilds everything too.
+        b2.delete()
+        assert sharded._cache is None
+        assert sharded.get_child_ids('root') == [b1.id]
+        assert sharded.get_category_by_id(c111.id) is None
+        assert sharded.get_category_by_alias('c21') is None
+
+        # Aliases are routed with chunked maps.
+        aliased = [create_category(alias=f'c1{idx}', parent=b1) for idx in range(5)]
+        chunked = ShardedCache()
+        chunked.ALIASES_CHUNK_SIZE = 2
+        chunked.invalidate()
+        chunked._get_head()
+        assert len(chunked._cache[chunked.INDEX_ALIASES]) > 1
+        assert [chunked.get_category_by_alias(category.alias) for category in aliased] == aliased
+        assert sharded.get_category_by_alias('c14') == aliased[-1]
+
+    def test_mmap(self, create_category, monkeypatch, tmp_path):
+        from django.core.cache import cache
+        from sitecats import utils
+        from sitecats.records import CategoryRecord
+        from sitecats.snapshot import RecordsById
+        from sitecats.utils import Cache
+
+        monkeypatch.setattr(utils, 'CACHE_MMAP_DIR', str(tmp_path))
+
+        cat1 = create_category(alias='cat1', note='some')
+        cat11 = create_category(parent=cat1, title='Same')
+        cat12 = create_category(parent=cat1, title='same')
+        cat121 = create_category(alias='cat121', parent=cat12)
+        cat2 = create_category(alias='cat2')
+        Category.objects.filter(id=cat2.id).update(status=5, slug='two', is_locked=True)
+
+        cats = get_cache()
+        cats.invalidate()
+        assert cats.get_category_by_id(cat2.id).slug == 'two'
+
+        mapped = cats._cache
+        assert isinstance(mapped[cats.CACHE_NAME_IDS], RecordsById)
+        assert len(list(tmp_path.iterdir())) == 1
+
+        built = cats._cache_build(mapped[cats.CACHE_NAME_VERSION])
+
+        for name, value in built.items():
+            if name == cats.CACHE_NAME_PARENT_RANKS:
+                # Ranks are not dense but ordered the same.
+                assert sorted(mapped[name], key=mapped[name].__getitem__) == sorted(value, key=value.__getitem__)
+            elif isinstance(value, dict):
+                assert dict(mapped[name].items()) == value
+                assert {
+                    key: item._values for key, item in mapped[name].items() if isinstance(item, CategoryRecord)
+                } == {key: item._values for key, item in value.items() if isinstance(item, CategoryRecord)}
+            elif isinstance(value, list):
+                assert list(mapped[name]) == value
+            else:
+                assert mapped[name] == value
+
+        assert cats.get_subtree_ids(cat1.id) == [cat1.id, cat11.id, cat12.id, cat121.id]
+        assert cats.find_category('cat1', 'SAME') == cat11
+        assert cats.sort_aliases(['cat1', 'cat121', None]) == [None, 'cat1']
+        assert cats.get_category_by_alias('cat121').parent_id == cat12.id
+        assert cats.get_category_by_alias('cat3') is None
+        assert cats.get_ancestors(cat121.id) == [cat1, cat12]
+        assert cats.get_ancestors(cat1.id) == []
+        assert cats.get_category_by_id(None) is None
+        assert cats.get_category_by_id('1') is None
+        assert cats.get_category_by_alias(None) is None
+        assert cats.get_category_by_alias(1) is None
+        assert None not in mapped[cats.CACHE_NAME_CHILD_PARENTS]
+
+        # Other processes read the snapshot without fetching the tree.
+        cache.delete(cats.CACHE_ENTRY_NAME)
+        other = Cache()
+        assert other.get_children_for('cat1') == [cat11, cat12]
+
+        # Patched tree gets a new snapshot.
+        cat3 = create_category(alias='cat3', parent=cat2)
+        assert cats.get_child_ids('cat2') == [cat3.id]
+        assert isinstance(cats._cache[cats.CACHE_NAME_IDS], RecordsById)
+        assert len(list(tmp_path.iterdir())) == 1
+
+        cat11.delete()
+        other._checked = None
+        assert other.get_child_ids('cat1') == [cat12.id]
+        assert other.get_category_by_alias('cat3') == cat3
+
+        # Empty tree is mapped as well.
+        Category.objects.all().delete()
+        cats.invalidate()
+        assert cats.get_category_by_alias('cat3') is None
+        assert isinstance(cats._cache[cats.CACHE_NAME_IDS], RecordsById)
+
+    def test_preload(self, create_category, monkeypatch, cache_spy):
+        import gc
+        from django.core.cache import cache
+        from sitecats.utils import Cache
+
+        frozen = []
+        monkeypatch.setattr(gc, 'freeze', lambda: frozen.append(True))
+
+        cat1 = create_category(alias='cat1')
+        cats = Cache()
+        cats.preload()
+
+        assert frozen
+        assert cats._cache is not None
+        assert cats._checked is None
+
+        # Forked process uses preloaded tree.
+        cache_spy.gets.clear()
+        assert cats.get_category_by_alias('cat1') == cat1
+        assert cats.CACHE_ENTRY_NAME not in cache_spy.gets
+
+        # Changes made after fork are picked up.
+        Category.objects.filter(id=cat1.id).update(title='changed')
+        cache.set(cats.CACHE_ENTRY_VERSION, 'changed')
+        cats._checked = None
+        assert cats.get_category_by_alias('cat1').title == 'changed'
+
+        cats.preload(freeze=False)
+        assert len(frozen) == 1
+
+    def test_local_tier(self, create_category, cache_spy):
+        from django.core.cache import cache
+        from django.core.signals import request_started
+        from sitecats.utils import get_cache
+
+        cat1 = create_category(alias='cat1')
+        cat11 = create_category(parent=cat1)
+        cache_spy.gets.clear()
+
+        cats = get_cache()
+        assert cats.get_category_by_alias('cat1') == cat1
+        assert cats.get_children_for('cat1') == [cat11]
+        assert cats.get_category_by_id(cat11.id) == cat11
+        # Whole tree is fetched once.
+        assert cache_spy.gets.count(cats.CACHE_ENTRY_NAME) == 1
+
+        # Version check happens once per request.
+        cache_spy.gets.clear()
+        request_started.send(sender=None)
+        cats.get_category_by_alias('cat1')
+        cats.get_category_by_alias('cat1')
+        assert cache_spy.gets == [cats.CACHE_ENTRY_VERSION]
+
+        # Someone (e.g. other process) has changed the tree.
+        cache.set(cats.CACHE_ENTRY_VERSION, 'other')
+        cats.get_category_by_alias('cat1')
+        assert cats.CACHE_ENTRY_NAME not in cache_spy.gets
+
+        request_started.send(sender=None)
+        assert cats.get_category_by_alias('cat1') == cat1
+        assert cache_spy.gets.count(cats.CACHE_ENTRY_NAME) == 1
+        assert cats._cache[cats.CACHE_NAME_VERSION] == 'other'
+
+    def test_get_parents_for(self, create_category):
+        from sitecats.utils import get_cache
+
+        cat1 = create_category(alias='cat1')
+        cat2 = create_category(alias='cat2')
+        cat11 = create_category(parent=cat1)
+        cat21 = create_category(parent=cat2)
+
+        cats = get_cache()
+        assert cats.get_parents_for([cat11.id]) == {'cat1'}
+        assert cats.get_parents_for([cat11.id, cat21.id, cat1.id]) == {'cat1', 'cat2', None}
+        assert cats.get_parents_for([-1]) == set()
+
+    def test_sort_aliases(self, create_category):
+        from sitecats.utils import get_cache
+
+        cat1 = create_category(alias='cat1', sort_order=10)
+        cat2 = create_category(alias='cat2', sort_order=20)
+        create_category(parent=cat1, sort_order=5)
+        create_category(parent=cat2, sort_order=1)
+
+        cats = get_cache()
+        assert cats.sort_aliases([]) == []
+        assert cats.sort_aliases(['cat1', 'unknown', 'cat2', 'cat1']) == ['cat2', 'cat1']
+        assert cats.sort_aliases(['cat1', None]) == ['cat1', None]
+
+    def test_find_category(self, create_category):
+        from sitecats.utils import get_cache
+
+        cat1 = create_category(alias='cat1')
+        cat11 = create_category('Some', parent=cat1)
+        cat12 = create_category('Other', parent=cat1)
+        root = create_category('Some')
+
+        cats = get_cache()
+        assert cats.find_category('cat1', 'sOME') == cat11
+        assert cats.find_category(None, 'some') == root
+        assert cats.find_category('cat1', 'none') is None
+        assert cats.find_category('unknown', 'some') is None
+
+        assert cats.find_categories('cat1', ['some', 'OTHER', 'none']) == {
+            'some': cat11, 'OTHER': cat12, 'none': None}
+
+    def test_subtree(self, create_category):
+        from sitecats.utils import get_cache
+
+        cat1 = create_category(alias='cat1')
+        cat2 = create_category(alias='cat2')
+        cat11 = create_category(alias='cat11', parent=cat1)
+        cat111 = create_category(parent=cat11)
+        cat112 = create_category(parent=cat11)
+        cat12 = create_category(parent=cat1, sort_order=1)
+
+        cats = get_cache()
+        assert cats.get_descendant_ids('cat1') == [cat12.id, cat11.id, cat111.id, cat112.id]
+        assert cats.get_descendant_ids('cat11', include_self=True) == [cat11.id, cat111.id, cat112.id]
+        assert cats.get_descendant_ids('cat2') == []
+        assert cats.get_descendant_ids('unknown') == []
+        assert cats.get_descendant_ids(None) == [cat1.id, cat12.id, cat11.id, cat111.id, cat112.id, cat2.id]
+
+        assert cats.get_ancestors(cat112.id) == [cat1, cat11]
+        assert cats.get_ancestors(cat1.id) == []
+        assert cats.get_depth(cat112.id) == 2
+        assert cats.get_depth(cat1.id) == 0
+
+        assert cats.is_descendant(cat112.id, cat1.id)
+        assert cats.is_descendant(cat112.id, cat11.id)
+        assert not cats.is_descendant(cat11.id, cat11.id)
+        assert not cats.is_descendant(cat1.id, cat11.id)
+        assert not cats.is_descendant(cat12.id, cat11.id)
+        assert not cats.is_descendant(cat12.id, cat2.id)
+
+    def test_patch(self, user, create_category):
+        from django.db import transaction
+        from sitecats.utils import get_cache
+
+        cats = get_cache()
+
+        def assert_tree_actual():
+            patched = cats._cache
+            built = cats._cache_build('')
+
+            for name in (cats.CACHE_NAME_IDS, cats.CACHE_NAME_ALIASES):
+                assert {key: cat.id for key, cat in patched[name].items()} == {
+                    key: cat.id for key, cat in built[name].items()}
+
+            assert list(patched[cats.CACHE_NAME_PARENTS].items()) == list(built[cats.CACHE_NAME_PARENTS].items())
+            assert patched[cats.CACHE_NAME_CHILD_PARENTS] == built[cats.CACHE_NAME_CHILD_PARENTS]
+            assert patched[cats.CACHE_NAME_PARENT_RANKS] == built[cats.CACHE_NAME_PARENT_RANKS]
+            assert patched[cats.CACHE_NAME_TITLES] == built[cats.CACHE_NAME_TITLES]
+            assert patched[cats.CACHE_NAME_TREE_ORDER] == built[cats.CACHE_NAME_TREE_ORDER]
+            assert patched[cats.CACHE_NAME_TREE_SPANS] == built[cats.CACHE_NAME_TREE_SPANS]
+
+        cat1 = create_category(alias='cat1')
+        cat2 = create_category(alias='cat2')
+        cat11 = create_category(parent=cat1)
+        cats.get_category_by_alias('cat1')
+        rebuilds = cats.get_stats()['rebuilds']
+
+        # Insert.
+        cat12 = Category.add('new', user, parent=cat1)
+        cat121 = create_category(alias='cat121', parent=cat12)
+        cat122 = create_category(parent=cat12)
+        assert cats.get_child_ids('cat1') == [cat11.id, cat12.id]
+        assert cats.get_category_by_alias('cat121') == cat121
+        assert_tree_actual()
+
+        # Reorder.
+        cat12.sort_order = 1
+        cat12.save()
+        assert cats.get_child_ids('cat1') == [cat12.id, cat11.id]
+        assert_tree_actual()
+
+        # Alias change moves children.
+        cat12.alias = 'cat12'
+        cat12.save()
+        assert cats.get_child_ids('cat12') == [cat121.id, cat122.id]
+        assert_tree_actual()
+
+        # Reparent.
+        cat12.parent = cat2
+        cat12.save()
+        assert cats.get_child_ids('cat1') == [cat11.id]
+        assert cats.get_child_ids('cat2') == [cat12.id]
+        assert cats.get_category_by_id(cat12.id).parent_id == cat2.id
+        assert_tree_actual()
+
+        # Remove with subcategories.
+        cat12.delete()
+        assert cats.get_child_ids('cat2') == []
+        assert cats.get_category_by_alias('cat121') is None
+        assert cats.get_category_by_id(cat122.id) is None
+        assert_tree_actual()
+
+        assert cats.get_stats()['rebuilds'] == rebuilds
+
+        # Rolled back changes are not applied.
+        with pytest.raises(ValueError):
+            with transaction.atomic():
+                create_category(alias='ghost', parent=cat1)
+                raise ValueError
+
+        assert cats.get_category_by_alias('ghost') is None
+        assert_tree_actual()
+
+        # Several changes are applied in one batch.
+        from sitecats.toolbox import defer_cache_invalidation
+
+        with defer_cache_invalidation():
+            cat3 = create_category(alias='cat3', parent=cat2)
+            cat31 = create_category(alias='cat31', parent=cat3)
+            cat32 = create_category(parent=cat3)
+            cat2.sort_order = 100
+            cat2.save()
+            cat3.alias = 'cat33'
+            cat3.title = 'renamed'
+            cat3.save()
+            cat31.parent = cat1
+            cat31.save()
+            cat11.delete()
+            cat32.sort_order = 0
+            cat32.save()
+
+        assert cats.get_child_ids('cat1') == [cat31.id]
+        assert cats.get_child_ids('cat33') == [cat32.id]
+        assert cats.find_category('cat2', 'Renamed') == cats.get_category_by_id(cat3.id)
+        assert_tree_actual()
+
+        # The first child stays the same, but its parent is ranked differently.
+        cat31.sort_order = 1000
+        cat31.save()
+        assert_tree_actual()
+
+        cat1.delete()
+        assert_tree_actual()
+
+        assert cats.get_stats()['rebuilds'] == rebuilds
+
+    def test_patch_concurrent(self, user, create_category, monkeypatch):
+        from sitecats.utils import get_cache
+
+        cats = get_cache()
+        cat1 = create_category(alias='cat1')
+        cats.get_category_by_alias('cat1')
+
+        apply = cats._cache_apply
+        concurrent = []
+
+        def apply_concurrently(*args, **kwargs):
+            if not concurrent:
+                # Another writer fails to get the lock while the tree is being patched.
+                concurrent.append(create_category(alias='cat12', parent=cat1))
+            return apply(*args, **kwargs)
+
+        monkeypatch.setattr(cats, '_cache_apply', apply_concurrently)
+
+        create_category(alias='cat11', parent=cat1)
+
+        # Concurrent change is not lost.
+        assert cats.get_category_by_alias('cat12') == concurrent[0]
+        assert cats.get_category_by_alias('cat11') is not None
+
+    def test_deferred(self, user, create_category, monkeypatch):
+        from django.db import transaction
+        from sitecats.toolbox import defer_cache_invalidation
+
+        cats = get_cache()
+        cat1 = create_category(alias='cat1')
+        cats.get_category_by_alias('cat1')
+        rebuilds = cats.get_stats()['rebuilds']
+        version = cats._cache_get_version()
+
+        with transaction.atomic():
+
+            with defer_cache_invalidation():
+                cat11 = create_category(alias='cat11', parent=cat1)
+
+                with cats.deferred():  # Nested.
+                    cat12 = create_category(alias='cat12', parent=cat1)
+                    cat12.delete()
+                    cat11.title = 'renamed'
+                    cat11.save()
+
+            # Waiting for commit.
+            assert cats.get_category_by_alias('cat11') is None
+            assert cats._cache_get_version() == version
+
+        # All changes are applied at once.
+        assert cats._cache_get_version() != version
+        assert cats.get_category_by_alias('cat11').title == 'renamed'
+        assert cats.get_category_by_alias('cat12') is None
+        assert cats.get_stats()['rebuilds'] == rebuilds
+
+        # Too many changes (or explicit invalidation) lead to rebuild.
+        monkeypatch.setattr(cats, 'PATCH_CHANGES_MAX', 1)
+
+        @defer_cache_invalidation()
+        def add():
+            create_category(alias='cat13', parent=cat1)
+            create_category(alias='cat14', parent=cat1)
+
+        add()
+
+        assert [cat.alias for cat in cats.get_children_for('cat1')] == ['cat11', 'cat13', 'cat14']
+        assert cats.get_stats()['rebuilds'] == rebuilds + 1
+
+        # Rolled back changes are not applied.
+        version = cats._cache_get_version()
+
+        with pytest.raises(ValueError):
+            with transaction.atomic():
+                with defer_cache_invalidation():
+                    create_category(alias='cat15', parent=cat1)
+                    raise ValueError
+
+        assert cats._cache_get_version() == version
+
+        # Changes rolled back to a savepoint are not applied.
+        monkeypatch.setattr(cats, 'PATCH_CHANGES_MAX', 10)
+        rebuilds = cats.get_stats()['rebuilds']
+
+        with defer_cache_invalidation():
+            with pytest.raises(ValueError):
+                with transaction.atomic():
+                    create_category(alias='ghost', parent=cat1)
+                    raise ValueError
+
+            with transaction.atomic():
+                create_category(alias='cat16', parent=cat1)
+
+                with pytest.raises(ValueError):
+                    with transaction.atomic():
+                        create_category(alias='ghost2', parent=cat1)
+                        raise ValueError
+
+        assert cats.get_category_by_alias('ghost') is None
+        assert cats.get_category_by_alias('ghost2') is None
+        assert cats.get_category_by_alias('cat16') is not None
+        assert cats.get_stats()['rebuilds'] == rebuilds
+
+    def test_facet_counts(self, user, create_article, create_category, db_queries):
+        brand = create_category(alias='brand')
+        brand1 = create_category(parent=brand)
+        brand2 = create_category(parent=brand)
+        brand3 = create_category(parent=brand)
+        other = create_category()
+
+        article1 = create_article()
+        article2 = create_article()
+        article3 = create_article()
+
+        article1.add_to_category(brand1, user)
+        article1.add_to_category(brand2, user)
+        article2.add_to_category(brand1, user)
+        article3.add_to_category(brand1, user)
+        article3.add_to_category(brand3, user)
+        article3.add_to_category(other, user)
+
+        cats = get_cache()
+        cats.get_category_by_id(brand.id)  # Warm up cache.
+
+        found = Article.objects.filter(id__in=[article2.id, article3.id])
+
+        with db_queries.scope() as queries:
+            assert cats.get_facet_counts(found, ['brand']) == {brand1.id: 2, brand3.id: 1}
+            assert len(queries) == 1
+
+        assert cats.get_facet_counts(Article.objects.all(), ['brand', None]) == {
+            brand1.id: 3, brand2.id: 1, brand3.id: 1, other.id: 1}
+        assert cats.get_facet_counts(found, ['unknown']) == {}
+
+        # Cached.
+        assert cats.get_facet_counts(found, ['brand'], cache_timeout=10) == {brand1.id: 2, brand3.id: 1}
+        article2.remove_from_category(brand1)
+
+        with db_queries.scope() as queries:
+            assert cats.get_facet_counts(found, ['brand'], cache_timeout=10) == {brand1.id: 2, brand3.id: 1}
+            assert cats.get_facet_counts(
+                Article.objects.filter(id=article3.id), ['brand'], cache_timeout=10) == {
+                brand1.id: 1, brand3.id: 1}
+            assert len(queries) == 1
+
+        # Tree change drops cached counts.
+        create_category(parent=brand)
+        assert cats.get_facet_counts(found, ['brand'], cache_timeout=10) == {brand1.id: 1, brand3.id: 1}
+
+    def test_ties_stats_cache(
+            self, user, create_article, create_category, monkeypatch, db_queries, command_run, request):
+        from django.db.models import signals
+        from sitecats import utils
+
+        monkeypatch.setattr(utils, 'TIES_STATS_CACHE', True)
+
+        cats = utils.get_cache()
+        tie_model = utils.get_tie_model()
+        # No listeners by default, so that ties could be deleted in bulk.
+        assert not signals.post_delete.has_listeners(tie_model)
+
+        cats._ties_stats_connect()
+        request.addfinalizer(lambda: (
+            signals.post_save.disconnect(cats._ties_stats_add, sender=tie_model),
+            signals.post_delete.disconnect(cats._ties_stats_remove, sender=tie_model),
+        ))
+
+        cat1 = create_category()
+        cat2 = create_category()
+        cat3 = create_category()
+        article1 = create_article()
+        article2 = create_article()
+
+        article1.add_to_category(cat1, user)
+        article2.add_to_category(cat1, user)
+        article2.add_to_category(cat2, user)
+
+        ids = [cat1.id, cat2.id, cat3.id]
+
+        def get_stats():
+            return (
+                cats.get_ties_stats(ids),
+                cats.get_ties_stats(ids, Article),
+                cats.get_ties_stats(ids, article2),
+            )
+
+        expected = ({cat1.id: 2, cat2.id: 1}, {cat1.id: 2, cat2.id: 1}, {cat1.id: 1, cat2.id: 1})
+        assert get_stats() == expected
+
+        with db_queries.scope() as queries:
+            assert get_stats() == expected
+
+            # Maintained by signals.
+            article2.add_to_category(cat3, user)
+            article1.remove_from_category(cat1)
+            queries.clear()
+
+            assert get_stats() == (
+                {cat1.id: 1, cat2.id: 1, cat3.id: 1},
+                {cat1.id: 1, cat2.id: 1, cat3.id: 1},
+                {cat1.id: 1, cat2.id: 1, cat3.id: 1},
+            )
+            # Only content type is got from DB (or its own cache).
+            assert len(queries) <= 1
+
+        # Drifted.
+        generation = cats._cache_get_version(cats.CACHE_ENTRY_TIES_STATS_GEN)
+        cache = utils.cache
+        cache.set(cats._ties_stats_key(generation, cat1.id), 100)
+        assert cats.get_ties_stats([cat1.id])[cat1.id] == 100
+
+        command_run('sitecats_reconcile_stats')
+        assert cats.get_ties_stats([cat1.id]) == {cat1.id: 1}
+
+    def test_stale_rebuild(self, create_category, monkeypatch):
+        from django.core.cache import cache
+        from django.core.signals import request_started
+        from sitecats import utils
+
+        monkeypatch.setattr(utils, 'CACHE_STALE_REBUILD', True)
+
+        cats = utils.get_cache()
+        cat1 = create_category(alias='cat1')
+        assert cats.get_category_by_alias('cat1') == cat1
+        stats_before = cats.get_stats()
+
+        # Other process is rebuilding the tree. Serve previous generation.
+        cache.add(cats.CACHE_ENTRY_LOCK, 'other')
+        cat2 = create_category(alias='cat2')
+        assert cats.get_category_by_alias('cat2') is None
+
+        stats = cats.get_stats()
+        assert stats['contended'] == stats_before['contended'] + 1
+        assert stats['stale_served'] == stats_before['stale_served'] + 1
+        assert stats['rebuilds'] == stats_before['rebuilds']
+
+        # Lock released. Rebuild on next request.
+        cache.delete(cats.CACHE_ENTRY_LOCK)
+        request_started.send(sender=None)
+        assert cats.get_category_by_alias('cat2') == cat2
+
+        stats = cats.get_stats()
+        assert stats['rebuilds'] == stats_before['rebuilds'] + 1
+        assert stats['rebuild_time_last'] > 0
+        assert cache.get(cats.CACHE_ENTRY_LOCK) is None
+
+
 # TODO CategoryRequestHandler
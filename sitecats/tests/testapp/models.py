@@ -14,3 +14,8 @@ class Article(ModelWithCategory):
 
     def get_category_absolute_url(self, category):
         return '%s/%s' % (category.id, self.title)
+
+
+class TieNote(models.Model):
+
+    tie = models.ForeignKey('sitecats.Tie', on_delete=models.CASCADE)
@@ -1,6 +1,7 @@
+from contextlib import contextmanager
 from inspect import getfullargspec
 from collections import namedtuple
-from typing import List, Callable, Union, Optional, Any, Tuple, Dict
+from typing import List, Callable, Union, Optional, Any, Tuple, Dict, Iterable
 
 from django.db.models import Model
 from django.http import HttpRequest
@@ -30,6 +31,21 @@ def get_category_aliases_under(parent_alias: str = None) -> List[str]:
     return [ch.alias for ch in get_cache().get_children_for(parent_alias, only_with_aliases=True)]
 
 
+@contextmanager
+def defer_cache_invalidation():
+    """Context manager (and decorator) suspending categories tree invalidation
+    till the end of the block (and the current transaction commit).
+    See `Cache.deferred()`.
+
+        @defer_cache_invalidation()
+        def import_categories():
+            ...
+
+    """
+    with get_cache().deferred():
+        yield
+
+
 def get_category_lists(
         init_kwargs: dict = None,
         additional_parents_aliases: List[str] = None,
@@ -57,11 +73,99 @@ def get_category_lists(
         ]
         parent_aliases = list(get_cache().get_parents_for(cat_ids).union(additional_parents_aliases))
 
-    lists = []
-
     aliases = get_cache().sort_aliases(parent_aliases)
     categories_cache = get_cache().get_categories(aliases, obj)
 
+    return _spawn_category_lists(aliases, categories_cache, init_kwargs, obj)
+
+
+def get_category_lists_bulk(
+        objs: Iterable['ModelWithCategory'],
+        init_kwargs: dict = None,
+        additional_parents_aliases: List[str] = None,
+        prefetch: bool = True
+
+) -> Dict['ModelWithCategory', List['CategoryList']]:
+    """Returns a dictionary of CategoryList objects lists indexed by
+    the given model instances. Works as `get_category_lists()` for every object,
+    but fetches ties with one query per content type.
+
+    By default lists are also prefetched into objects, so that
+    `obj.get_category_lists()` (and `sitecats_categories` template tag
+    for such objects) would not hit DB.
+    Prefetched lists are dropped on object's `add_to_category()`, `remove_from_category()`
+    and `set_category_lists_init_kwargs()`.
+
+    :param objs: Model instances (or a QuerySet) to get categories for
+    :param init_kwargs:
+    :param additional_parents_aliases:
+    :param prefetch: Whether to put lists into objects (see `ModelWithCategory.set_category_lists()`).
+
+    """
+    init_kwargs = init_kwargs or {}
+    additional_parents_aliases = additional_parents_aliases or []
+
+    cache = get_cache()
+
+    by_ctype = {}
+
+    for obj in objs:
+        ctype = ContentType.objects.get_for_model(obj)
+        by_ctype.setdefault(ctype, {}).setdefault(obj.id, []).append(obj)
+
+    lists = {}
+
+    for ctype, by_id in by_ctype.items():
+
+        # Ties stats for every object as in `Cache.get_ties_stats()`.
+        ties_stats = {}
+
+        for object_id, category_id in get_tie_model().objects.filter(
+                content_type=ctype, object_id__in=list(by_id)).values_list('object_id', 'category_id'):
+
+            obj_stats = ties_stats.setdefault(object_id, {})
+            obj_stats[category_id] = obj_stats.get(category_id, 0) + 1
+
+        for object_id, objs_ in by_id.items():
+            obj_stats = ties_stats.get(object_id, {})
+
+            parent_aliases = list(cache.get_parents_for(list(obj_stats)).union(additional_parents_aliases))
+            aliases = cache.sort_aliases(parent_aliases)
+
+            for obj in objs_:
+                categories_cache = cache.get_categories(aliases, obj, ties_stats=obj_stats)
+
+                obj_init_kwargs = dict(obj._category_lists_init_kwargs or {})
+                obj_init_kwargs.update(init_kwargs)
+
+                obj_lists = _spawn_category_lists(aliases, categories_cache, obj_init_kwargs, obj)
+
+                if prefetch:
+                    obj.set_category_lists(obj_lists)
+
+                lists[obj] = obj_lists
+
+    return lists
+
+
+def _spawn_category_lists(
+        aliases: List[str],
+        categories_cache: Dict[str, List['CategoryBase']],
+        init_kwargs: dict,
+        obj: Optional[Model]
+
+) -> List['CategoryList']:
+    """Returns a list of CategoryList objects for the given aliases
+    filled with prefetched categories.
+
+    :param aliases:
+    :param categories_cache:
+    :param init_kwargs:
+    :param obj:
+
+    """
+    lists = []
+
     for parent_alias in aliases:
         catlist = CategoryList(parent_alias, **init_kwargs)  # TODO Burned in class name. Make more customizable.
 
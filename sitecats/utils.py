@@ -1,12 +1,26 @@
-from typing import Type, Any, List, Set, Optional, Union, Dict
+import gc
+import os
+from contextlib import contextmanager
+from hashlib import md5
+from operator import attrgetter
+from threading import local
+from time import monotonic, sleep
+from typing import Type, Any, List, Set, Optional, Union, Dict, Tuple
+from uuid import uuid4
 
 from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
-from django.db.models import signals, Count, Model
+from django.core.signals import request_started
+from django.db import router, transaction
+from django.db.models import signals, Count, Model, QuerySet
 from etc.toolbox import get_model_class_from_string
 
-from .settings import MODEL_CATEGORY, MODEL_TIE
+from .packing import pack_records, unpack_records
+from .records import CategoryRecord, TiedCategory
+from .settings import MODEL_CATEGORY, MODEL_TIE, CACHE_CHECK_INTERVAL, CACHE_STALE_REBUILD, \
+    CACHE_REBUILD_LOCK_TIMEOUT, CACHE_PATCH, TIES_STATS_CACHE, CACHE_PACK, CACHE_MMAP_DIR
+from .snapshot import Snapshot, RecordsById, get_snapshot_path, write_snapshot
 
 if False:  # pragma: nocover
     from .models import CategoryBase, TieBase, ModelWithCategory  # noqa
@@ -43,27 +57,103 @@ class Cache:
     CACHE_TIMEOUT: str = 31536000
     CACHE_ENTRY_NAME: str = 'sitecats'
 
+    CACHE_ENTRY_VERSION: str = 'sitecats_version'
+    CACHE_ENTRY_LOCK: str = 'sitecats_lock'
+    CACHE_ENTRY_INVALIDATED: str = 'sitecats_invalidated'
+    CACHE_ENTRY_TIES_STATS: str = 'sitecats_ties'
+    CACHE_ENTRY_TIES_STATS_GEN: str = 'sitecats_ties_gen'
+    CACHE_ENTRY_FACETS: str = 'sitecats_facets'
+
     CACHE_NAME_IDS: str = 'ids'
     CACHE_NAME_ALIASES: str = 'aliases'
     CACHE_NAME_PARENTS: str = 'parents'
+    CACHE_NAME_VERSION: str = 'version'
+    CACHE_NAME_CHILD_PARENTS: str = 'child_parents'
+    CACHE_NAME_PARENT_RANKS: str = 'parent_ranks'
+    CACHE_NAME_TITLES: str = 'titles'
+    CACHE_NAME_TREE_ORDER: str = 'tree_order'
+    CACHE_NAME_TREE_SPANS: str = 'tree_spans'
+
+    # Maximum number of deferred category changes applied to the tree incrementally.
+    # The tree is invalidated instead if there are more.
+    PATCH_CHANGES_MAX: int = 100
 
     def __init__(self):
         self._cache = None
+        # Monotonic time of the last version check. None forces the check on next access.
+        self._checked = None
+        # Category changes recorded while invalidation is deferred (see .deferred()).
+        self._deferred = local()
+        self._stats = {
+            'rebuilds': 0,  # Number of trees built by this process.
+            'rebuild_time': 0.0,  # Total time (in seconds) spent building trees.
+            'rebuild_time_last': 0.0,
+            'contended': 0,  # Number of times rebuild lock was held by someone else.
+            'stale_served': 0,  # Number of times previous tree generation was served.
+        }
         # Listen for signals from the models.
         category_model = get_category_model()
-        signals.post_save.connect(self._cache_empty, sender=category_model)
-        signals.post_delete.connect(self._cache_empty, sender=category_model)
+        signals.post_save.connect(self._cache_patch, sender=category_model)
+        signals.post_delete.connect(self._cache_patch, sender=category_model)
 
-    def _cache_init(self):
-        """Initializes local cache from Django cache if required."""
-        cache_ = cache.get(self.CACHE_ENTRY_NAME)
+        if TIES_STATS_CACHE:
+            self._ties_stats_connect()
 
-        if cache_ is None:
-            categories = get_category_model().objects.order_by('sort_order')
+        # Local copy version is checked at most once per request.
+        request_started.connect(self._cache_recheck)
+
+    def _cache_get_version(self, entry_name: str = None) -> str:
+        """Returns a version stamp (categories tree version by default) from Django cache.
+        Initializes a new one if none is set.
+
+        :param entry_name: Cache entry name for version stamp.
+
+        """
+        entry_name = entry_name or self.CACHE_ENTRY_VERSION
+        version = cache.get(entry_name)
+
+        if version is None:
+            version = uuid4().hex
+            if not cache.add(entry_name, version, self.CACHE_TIMEOUT):
+                # Someone has just set it.
+                version = cache.get(entry_name) or version
+
+        return version
+
+    def _cache_build(self, version: str) -> dict:
+        """Builds categories tree cache structure from DB.
+
+        :param version: Version stamp to tag structure with.
+
+        """
+        model = get_category_model()
+        categories = CategoryRecord.make_many(
+            model, model.objects.order_by('sort_order').values_list(*CategoryRecord.get_attnames(model)))
+
+        return self._cache_assemble(version, categories)
+
+    def _cache_assemble(
+            self,
+            version: str,
+            categories: List[CategoryRecord],
+            tree: Optional[Tuple[List[int], Dict[int, Tuple[int, int, int]]]] = None,
+            index: Optional[Tuple[Dict[Optional[str], List[int]], Dict[Optional[str], Dict[str, int]]]] = None
+    ) -> dict:
+        """Assembles categories tree cache structure from category records.
+
+        :param version: Version stamp to tag structure with.
+        :param categories: Category records ordered by `sort_order`.
+        :param tree: Precalculated tree order and spans (see `_cache_index()`).
+        :param index: Precalculated children by parents and titles indexes (see `_cache_index()`).
+
+        """
+        ids = {category.id: category for category in categories}
+        aliases = {category.alias: category for category in categories if category.alias}
 
-            ids = {category.id: category for category in categories}
-            aliases = {category.alias: category for category in categories if category.alias}
+        if index:
+            parent_to_children, titles = index
 
+        else:
             parent_to_children = {}
 
             for category in categories:
@@ -78,20 +168,688 @@ class Cache:
 
                 parent_to_children[parent_alias].append(category.id)
 
-            cache_ = {
-                self.CACHE_NAME_IDS: ids,
-                self.CACHE_NAME_PARENTS: parent_to_children,
-                self.CACHE_NAME_ALIASES: aliases
-            }
+        cache_ = {
+            self.CACHE_NAME_IDS: ids,
+            self.CACHE_NAME_PARENTS: parent_to_children,
+            self.CACHE_NAME_ALIASES: aliases,
+            self.CACHE_NAME_VERSION: version,
+        }
+
+        if tree:
+            cache_[self.CACHE_NAME_TREE_ORDER], cache_[self.CACHE_NAME_TREE_SPANS] = tree
+
+        if index:
+            cache_[self.CACHE_NAME_TITLES] = titles
+
+        self._cache_index(cache_, tree=not tree, titles=not index)
+
+        return cache_
+
+    def _cache_index(self, cache_: dict, tree: bool = True, titles: bool = True):
+        """Adds indexes derived from basic cache entries into the given cache structure.
+
+        :param cache_:
+        :param tree: Whether tree order index should be built.
+        :param titles: Whether titles index should be built.
+
+        """
+        cache_[self.CACHE_NAME_CHILD_PARENTS] = {
+            child_id: parent_alias
+            for parent_alias, child_ids in cache_[self.CACHE_NAME_PARENTS].items()
+            for child_id in child_ids
+        }
+        cache_[self.CACHE_NAME_PARENT_RANKS] = {
+            parent_alias: rank for rank, parent_alias in enumerate(cache_[self.CACHE_NAME_PARENTS])
+        }
+
+        ids = cache_[self.CACHE_NAME_IDS]
+
+        if titles:
+            titles = {}
+
+            for parent_alias, child_ids in cache_[self.CACHE_NAME_PARENTS].items():
+                parent_titles = titles[parent_alias] = {}
+                for child_id in child_ids:
+                    # The first one wins as in sequential search.
+                    parent_titles.setdefault(ids[child_id].title.casefold(), child_id)
+
+            cache_[self.CACHE_NAME_TITLES] = titles
+
+        if not tree:
+            return
+
+        children = {}
 
-            cache.set(self.CACHE_ENTRY_NAME, cache_, self.CACHE_TIMEOUT)
+        for category in sorted(ids.values(), key=attrgetter('sort_order')):
+            parent_id = category.parent_id if category.parent_id in ids else None
+            children.setdefault(parent_id, []).append(category.id)
+
+        cache_[self.CACHE_NAME_TREE_ORDER], cache_[self.CACHE_NAME_TREE_SPANS] = self._cache_tour(children)
+
+    @staticmethod
+    def _cache_tour(children: Dict[Optional[int], List[int]]) -> Tuple[List[int], Dict[int, tuple]]:
+        """Returns Euler tour of a tree: categories in preorder with subtree spans.
+        Descendants of a category occupy `order[enter + 1:leave]`.
+
+        :param children: Sorted children IDs by parent ID (`None` for root categories).
+
+        """
+        order = []
+        spans = {}
+        stack = [(child_id, 0) for child_id in reversed(children.get(None, []))]
+
+        while stack:
+            category_id, depth = stack.pop()
+
+            if depth < 0:  # Leaving subtree.
+                enter, _, depth = spans[category_id]
+                spans[category_id] = (enter, len(order), depth)
+                continue
+
+            spans[category_id] = (len(order), None, depth)
+            order.append(category_id)
+
+            stack.append((category_id, -1))
+            stack.extend((child_id, depth + 1) for child_id in reversed(children.get(category_id, [])))
+
+        return order, spans
+
+    def _cache_init(self):
+        """Initializes local cache from Django cache if required.
+
+        Process-local copy is reused until its version differs from
+        the one in Django cache. The version is checked once per request
+        or when CACHE_CHECK_INTERVAL is exceeded.
+
+        """
+        local = self._cache
+        checked = self._checked
+        now = monotonic()
+
+        if local is not None and checked is not None and now - checked < CACHE_CHECK_INTERVAL:
+            return
+
+        self._checked = now
+
+        version = self._cache_get_version()
+
+        if local is not None and local[self.CACHE_NAME_VERSION] == version:
+            return
+
+        cache_ = self._cache_map(version)
+
+        if cache_ is None:
+            cache_ = self._cache_fetch()
+
+            if cache_ is None or cache_.get(self.CACHE_NAME_VERSION) != version:
+                cache_ = self._cache_rebuild(version, stale=local if local is not None else cache_)
+
+            cache_ = self._cache_localize(cache_)
 
         self._cache = cache_
 
+    def _cache_map(self, version: str) -> Optional[dict]:
+        """Returns categories tree cache structure backed by a snapshot file
+        of the given version if CACHE_MMAP_DIR is set and the file exists.
+
+        :param version:
+
+        """
+        if not CACHE_MMAP_DIR or version is None:
+            return None
+
+        try:
+            snapshot = Snapshot(get_snapshot_path(CACHE_MMAP_DIR, version), get_category_model())
+
+        except (OSError, ValueError):
+            # No snapshot yet, or it has been just replaced by a newer one.
+            return None
+
+        return snapshot.get_structure({
+            'ids': self.CACHE_NAME_IDS,
+            'aliases': self.CACHE_NAME_ALIASES,
+            'parents': self.CACHE_NAME_PARENTS,
+            'version': self.CACHE_NAME_VERSION,
+            'child_parents': self.CACHE_NAME_CHILD_PARENTS,
+            'parent_ranks': self.CACHE_NAME_PARENT_RANKS,
+            'titles': self.CACHE_NAME_TITLES,
+            'tree_order': self.CACHE_NAME_TREE_ORDER,
+            'tree_spans': self.CACHE_NAME_TREE_SPANS,
+        })
+
+    def _cache_localize(self, cache_: dict) -> dict:
+        """Returns categories tree cache structure to be kept by this process.
+
+        If CACHE_MMAP_DIR is set the tree is written into a snapshot file
+        and the structure read from that file is returned.
+
+        :param cache_:
+
+        """
+        if not CACHE_MMAP_DIR or isinstance(cache_[self.CACHE_NAME_IDS], RecordsById):
+            return cache_
+
+        version = cache_[self.CACHE_NAME_VERSION]
+
+        if not os.path.exists(get_snapshot_path(CACHE_MMAP_DIR, version)):
+            os.makedirs(CACHE_MMAP_DIR, exist_ok=True)
+            write_snapshot(
+                CACHE_MMAP_DIR,
+                version,
+                sorted(cache_[self.CACHE_NAME_IDS].values(), key=attrgetter('sort_order')),
+                get_category_model(),
+                (cache_[self.CACHE_NAME_TREE_ORDER], cache_[self.CACHE_NAME_TREE_SPANS]))
+
+        mapped = self._cache_map(version)
+
+        return cache_ if mapped is None else mapped
+
+    def _cache_rebuild(self, version: str, stale: Optional[dict] = None) -> dict:
+        """Builds categories tree and publishes it into Django cache.
+
+        If CACHE_STALE_REBUILD is set only one process rebuilds the tree,
+        the others get the previous tree generation (if any) meanwhile.
+
+        :param version: Version stamp to tag tree with.
+        :param stale: Previous tree generation.
+
+        """
+        stats = self._stats
+        locked = False
+
+        if CACHE_STALE_REBUILD:
+            locked = cache.add(self.CACHE_ENTRY_LOCK, version, CACHE_REBUILD_LOCK_TIMEOUT)
+
+            if not locked:
+                stats['contended'] += 1
+
+                if stale is not None:
+                    stats['stale_served'] += 1
+                    return stale
+
+                # Nothing to serve yet. Wait for the lock holder to publish.
+                deadline = monotonic() + CACHE_REBUILD_LOCK_TIMEOUT
+
+                while monotonic() < deadline:
+                    sleep(0.1)
+                    cache_ = self._cache_fetch()
+                    if cache_ is not None and cache_.get(self.CACHE_NAME_VERSION) == version:
+                        return cache_
+
+        try:
+            started = monotonic()
+            cache_ = self._cache_build(version)
+            self._cache_put(cache_)
+
+            elapsed = monotonic() - started
+            stats['rebuilds'] += 1
+            stats['rebuild_time'] += elapsed
+            stats['rebuild_time_last'] = elapsed
+
+        finally:
+            if locked:
+                cache.delete(self.CACHE_ENTRY_LOCK)
+
+        return cache_
+
+    def _cache_encode(self, cache_: dict) -> Union[dict, bytes]:
+        """Returns categories tree cache structure prepared to be put into Django cache.
+
+        If CACHE_PACK is set the tree is packed into compact columnar format.
+
+        :param cache_:
+
+        """
+        if not CACHE_PACK:
+            return cache_
+
+        return pack_records(
+            cache_[self.CACHE_NAME_VERSION],
+            sorted(cache_[self.CACHE_NAME_IDS].values(), key=attrgetter('sort_order')),
+            get_category_model(),
+            tree=(cache_[self.CACHE_NAME_TREE_ORDER], cache_[self.CACHE_NAME_TREE_SPANS]),
+            compress=CACHE_PACK == 'zlib',
+            index=(cache_[self.CACHE_NAME_PARENTS], cache_[self.CACHE_NAME_TITLES]))
+
+    def _cache_decode(self, value: Optional[Union[dict, bytes]]) -> Optional[dict]:
+        """Returns categories tree cache structure from a value taken from Django cache.
+
+        :param value:
+
+        """
+        if isinstance(value, bytes):
+            try:
+                value = self._cache_assemble(*unpack_records(value, get_category_model()))
+
+            except ValueError:
+                # Packed by an older version or for other model fields.
+                return None
+
+        return value
+
+    def _cache_fetch(self) -> Optional[dict]:
+        """Returns categories tree cache structure from Django cache (if any)."""
+        return self._cache_decode(cache.get(self.CACHE_ENTRY_NAME))
+
+    def _cache_put(self, cache_: dict):
+        """Puts categories tree cache structure into Django cache.
+
+        :param cache_:
+
+        """
+        cache.set(self.CACHE_ENTRY_NAME, self._cache_encode(cache_), self.CACHE_TIMEOUT)
+
+    def _cache_recheck(self, **kwargs):
+        """Forces local cache version check on next access."""
+        self._checked = None
+
     def _cache_empty(self, **kwargs):
-        """Empties cached sitecats data."""
-        self._cache = None
-        cache.delete(self.CACHE_ENTRY_NAME)
+        """Empties cached sitecats data.
+
+        If CACHE_STALE_REBUILD is set tree data is not dropped but marked stale.
+
+        """
+        self._checked = None
+        # Let a concurrent patch know its result is outdated (see `_cache_publish()`).
+        cache.set(self.CACHE_ENTRY_INVALIDATED, uuid4().hex, self.CACHE_TIMEOUT)
+        cache.set(self.CACHE_ENTRY_VERSION, uuid4().hex, self.CACHE_TIMEOUT)
+
+        if not CACHE_STALE_REBUILD:
+            self._cache = None
+            cache.delete(self.CACHE_ENTRY_NAME)
+
+    def _cache_patch(self, instance: 'CategoryBase', **kwargs):
+        """Applies a single category change to cached data and publishes
+        patched tree under a new version once the change is committed.
+
+        Changes are only recorded if invalidation is deferred (see `.deferred()`).
+
+        """
+        deleted = 'created' not in kwargs
+        changes = getattr(self._deferred, 'changes', None)
+
+        if deleted:
+            # Only ID is required to drop a category. Instance ID is gone
+            # by the time changes are applied.
+            category = type(instance)(id=instance.id)
+        else:
+            # Take a snapshot: instance may be changed further.
+            category = self._cache_clone(instance)
+
+        using = router.db_for_write(type(instance))
+
+        # Rolled back changes (including ones rolled back to a savepoint) should not get into the shared tree.
+        if changes is None:
+            transaction.on_commit(lambda: self._cache_patch_many([(category, deleted)]), using=using)
+        else:
+            transaction.on_commit(lambda: changes.append((category, deleted)), using=using)
+
+    def _cache_patch_many(self, changes: List[Tuple['CategoryBase', bool]]):
+        """Applies category changes to cached data and publishes
+        patched tree under a new version just once.
+
+        Falls back to emptying cache if there is no actual tree to patch,
+        the tree is being rebuilt by someone else, or there are too many changes.
+
+        :param changes: A list of (category, deleted) tuples.
+            `None` category requests invalidation.
+
+        """
+        if (
+            not CACHE_PATCH
+            or len(changes) > self.PATCH_CHANGES_MAX
+            or any(category is None for category, _ in changes)
+        ):
+            self._cache_empty()
+            return
+
+        if not cache.add(self.CACHE_ENTRY_LOCK, 'patch', CACHE_REBUILD_LOCK_TIMEOUT):
+            self._cache_empty()
+            return
+
+        try:
+            invalidated = cache.get(self.CACHE_ENTRY_INVALIDATED)
+            version = cache.get(self.CACHE_ENTRY_VERSION)
+            base = self._cache
+
+            if base is None or base[self.CACHE_NAME_VERSION] != version:
+                base = self._cache_fetch()
+
+            if version is None or base is None or base[self.CACHE_NAME_VERSION] != version:
+                self._cache_empty()
+                return
+
+            patched = self._cache_apply(base, changes)
+
+            patched_version = uuid4().hex
+            patched[self.CACHE_NAME_VERSION] = patched_version
+
+            self._cache_put(patched)
+
+            if not self._cache_publish(version, patched_version, invalidated):
+                return
+
+            self._cache = self._cache_localize(patched)
+            self._checked = None
+
+        finally:
+            cache.delete(self.CACHE_ENTRY_LOCK)
+
+    def _cache_publish(self, base_version: str, version: str, invalidated: Optional[str]) -> bool:
+        """Sets a new version stamp for a tree derived from the one of the base version.
+        Should be called under the lock. Returns whether the version is published.
+
+        Cache is emptied instead if it has been invalidated meanwhile (e.g. by a writer
+        who failed to get the lock), so that the derived tree lacking those changes is not served.
+
+        :param base_version: Version stamp of the tree the new one is derived from.
+        :param version: New version stamp.
+        :param invalidated: Invalidation marker taken before the base tree.
+
+        """
+        if cache.get(self.CACHE_ENTRY_VERSION) != base_version:
+            self._cache_empty()
+            return False
+
+        cache.set(self.CACHE_ENTRY_VERSION, version, self.CACHE_TIMEOUT)
+
+        if cache.get(self.CACHE_ENTRY_INVALIDATED) != invalidated:
+            # Invalidation stamp might have been overwritten just now.
+            self._cache_empty()
+            return False
+
+        return True
+
+    def _cache_apply(self, base: dict, changes: List[Tuple['CategoryBase', bool]]) -> dict:
+        """Returns a copy of the given cache structure with categories
+        added, updated, moved or removed (with their subcategories).
+
+        All the changes are applied first, then derived indexes are updated
+        just once and only for parents affected. Tree order is kept if nothing
+        is moved, otherwise it is rebuilt from the base one (positions are shifted anyway).
+
+        Base structure itself is left intact.
+
+        :param base: Cache structure to patch.
+        :param changes: A list of (category, deleted) tuples.
+
+        """
+        ids = dict(base[self.CACHE_NAME_IDS])
+        aliases = dict(base[self.CACHE_NAME_ALIASES])
+        parents = dict(base[self.CACHE_NAME_PARENTS])
+        base_parents = base[self.CACHE_NAME_PARENTS]
+
+        touched = set()  # Parent aliases with children changed.
+        unsorted = set()  # Parent aliases with children to be sorted.
+        changed = set()  # IDs of categories changed or removed.
+        moved = False  # Whether tree order is affected.
+        by_parent = None  # Children IDs by parent ID. Built on first removal.
+
+        def get_parent_alias(cat):
+            parent_category = ids.get(cat.parent_id, False)
+            return parent_category.alias if parent_category else None
+
+        def get_children(key):
+            # Lists of the base structure are shared, so they are copied before modification.
+            if key not in touched:
+                touched.add(key)
+                parents[key] = list(parents.get(key, ()))
+            return parents[key]
+
+        def drop(cat):
+            key = get_parent_alias(cat)
+            children = get_children(key)
+            if cat.id in children:
+                children.remove(cat.id)
+
+            if cat.alias and aliases.get(cat.alias) == cat:
+                del aliases[cat.alias]
+
+            if by_parent is not None:
+                by_parent.get(cat.parent_id, set()).discard(cat.id)
+
+        def put(key, child_ids):
+            get_children(key).extend(child_ids)
+            unsorted.add(key)
+
+        for category, deleted in changes:
+            category_id = category.id
+            previous = ids.get(category_id)
+            children_ids = []
+            moved = moved or (
+                previous is None or deleted
+                or previous.parent_id != category.parent_id or previous.sort_order != category.sort_order)
+
+            if previous is not None:
+                # Children of an alias-less category are stored under `None` with the root ones.
+                children_ids = [
+                    cid for cid in parents.get(previous.alias, [])
+                    if ids[cid].parent_id == category_id]
+
+            if deleted:
+                if previous is None:
+                    continue
+
+                if by_parent is None:
+                    by_parent = {}
+                    for cat in ids.values():
+                        by_parent.setdefault(cat.parent_id, set()).add(cat.id)
+
+                # Subcategories are deleted by cascade.
+                removed = [previous]
+                for cat in removed:
+                    removed.extend(ids[cid] for cid in by_parent.get(cat.id, ()))
+
+                for cat in reversed(removed):
+                    drop(cat)
+                    by_parent.pop(cat.id, None)
+                    del ids[cat.id]
+                    changed.add(cat.id)
+
+                continue
+
+            if previous is not None:
+                drop(previous)
+
+            category = self._cache_clone(category)
+            ids[category_id] = category
+            changed.add(category_id)
+
+            if by_parent is not None:
+                by_parent.setdefault(category.parent_id, set()).add(category_id)
+
+            if category.alias:
+                aliases[category.alias] = category
+
+            put(get_parent_alias(category), [category_id])
+
+            if previous is not None and previous.alias != category.alias and children_ids:
+                # Subcategories are now addressed by the new alias.
+                children = get_children(previous.alias)
+                children[:] = [cid for cid in children if cid not in children_ids]
+                put(category.alias, children_ids)
+
+        for key in unsorted:
+            parents[key].sort(key=lambda cid: ids[cid].sort_order)
+
+        child_parents = dict(base[self.CACHE_NAME_CHILD_PARENTS])
+        titles = dict(base[self.CACHE_NAME_TITLES])
+        reorder = False
+
+        for key in touched:
+            for child_id in base_parents.get(key, ()):
+                if child_parents.get(child_id) == key:
+                    del child_parents[child_id]
+
+        for key in touched:
+            children = parents[key]
+            base_children = base_parents.get(key)
+
+            if not children:
+                del parents[key]
+                titles.pop(key, None)
+                reorder = reorder or base_children is not None
+                continue
+
+            # Parents order depends only on their first child.
+            reorder = reorder or not base_children or base_children[0] != children[0] or children[0] in changed
+
+            parent_titles = titles[key] = {}
+            for child_id in children:
+                child_parents[child_id] = key
+                # The first one wins as in sequential search.
+                parent_titles.setdefault(ids[child_id].title.casefold(), child_id)
+
+        ranks = base[self.CACHE_NAME_PARENT_RANKS]
+
+        if reorder:
+            # Keep parents ordered as if the tree was built from scratch.
+            parents = dict(sorted(parents.items(), key=lambda item: ids[item[1][0]].sort_order))
+            ranks = {parent_alias: rank for rank, parent_alias in enumerate(parents)}
+
+        patched = dict(base)
+        patched.update({
+            self.CACHE_NAME_IDS: ids,
+            self.CACHE_NAME_PARENTS: parents,
+            self.CACHE_NAME_ALIASES: aliases,
+            self.CACHE_NAME_CHILD_PARENTS: child_parents,
+            self.CACHE_NAME_PARENT_RANKS: ranks,
+            self.CACHE_NAME_TITLES: titles,
+        })
+
+        if not moved:
+            return patched
+
+        # Positions are shifted by any move, so the tree order is rebuilt.
+        # Still siblings in the base tree order are already sorted,
+        # so only changed categories are to be put into place.
+        tree = {}
+
+        for category_id in base[self.CACHE_NAME_TREE_ORDER]:
+            if category_id in changed:
+                continue
+            parent_id = ids[category_id].parent_id
+            tree.setdefault(parent_id if parent_id in ids else None, []).append(category_id)
+
+        for category_id in changed:
+            category = ids.get(category_id)
+
+            if category is None:
+                continue
+
+            siblings = tree.setdefault(category.parent_id if category.parent_id in ids else None, [])
+            sort_order = category.sort_order
+            lo, hi = 0, len(siblings)
+
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if ids[siblings[mid]].sort_order <= sort_order:
+                    lo = mid + 1
+                else:
+                    hi = mid
+
+            siblings.insert(lo, category_id)
+
+        patched[self.CACHE_NAME_TREE_ORDER], patched[self.CACHE_NAME_TREE_SPANS] = self._cache_tour(tree)
+
+        return patched
+
+    @staticmethod
+    def _cache_clone(category: Union['CategoryBase', CategoryRecord]) -> CategoryRecord:
+        """Returns an immutable record for a category object to be put into cache.
+
+        :param category:
+
+        """
+        if isinstance(category, CategoryRecord):
+            return category
+
+        record = CategoryRecord.from_category(category)
+
+        if not record.sort_order:
+            # Sort order is set to ID right after the first save, see CategoryBase.save().
+            record = CategoryRecord(
+                record.model, (
+                    record.id if attname == 'sort_order' else value
+                    for attname, value in zip(CategoryRecord.get_attnames(record.model), record._values)))
+
+        return record
+
+    @contextmanager
+    def deferred(self):
+        """Context manager (and decorator) suspending categories tree invalidation
+        for the current thread.
+
+        Category changes made within are coalesced into just one incremental
+        tree patch (or one invalidation if there are too many of them)
+        applied on exit, or, inside a transaction, right after it is committed.
+
+        Nested blocks are applied by the outermost one.
+
+            with get_cache().deferred():
+                for category in categories:
+                    category.save()
+
+        """
+        state = self._deferred
+
+        if getattr(state, 'changes', None) is not None:
+            yield
+            return
+
+        state.changes = changes = []
+
+        try:
+            yield
+
+        finally:
+            state.changes = None
+
+            def apply():
+                # Changes are recorded once committed, so inside a transaction
+                # they are known only after it is committed (see `_cache_patch()`).
+                if changes:
+                    self._cache_patch_many(changes)
+
+            transaction.on_commit(apply, using=router.db_for_write(get_category_model()))
+
+    def invalidate(self):
+        """Invalidates cached categories tree. Useful after categories
+        are changed bypassing signals (e.g. with `bulk_create()` or `update()`).
+
+        """
+        changes = getattr(self._deferred, 'changes', None)
+
+        if changes is None:
+            self._cache_empty()
+        else:
+            changes.append((None, True))
+
+    def preload(self, freeze: bool = True):
+        """Loads categories tree in advance.
+
+        Meant to be called in a parent process of a preforking server (e.g. gunicorn with `preload_app`)
+        so that forked workers share the tree copy-on-write and serve their first requests warm.
+        Tree version is still checked by workers on first access.
+
+        :param freeze: Whether to move all objects tracked by garbage collector
+            into permanent generation (`gc.freeze()`, Python 3.7+), so that collections
+            in workers do not touch (and copy) shared memory pages.
+
+        """
+        self._cache_init()
+        # Force version check in forked processes.
+        self._checked = None
+
+        if freeze and hasattr(gc, 'freeze'):
+            gc.freeze()
+
+    def get_stats(self) -> Dict[str, Union[int, float]]:
+        """Returns categories tree rebuild statistics for this process:
+        rebuilds number and time, lock contention and stale data usage counters.
+
+        """
+        return dict(self._stats)
 
     ENTIRE_ENTRY_KEY = tuple()
 
@@ -122,8 +880,8 @@ class Cache:
         self._cache_init()
         if not aliases:
             return aliases
-        parent_aliases = self._cache_get_entry(self.CACHE_NAME_PARENTS).keys()
-        return [parent_alias for parent_alias in parent_aliases if parent_alias in aliases]
+        ranks = self._cache_get_entry(self.CACHE_NAME_PARENT_RANKS)
+        return sorted({alias for alias in aliases if alias in ranks}, key=ranks.__getitem__)
 
     def get_parents_for(self, child_ids: List[int]) -> Set[str]:
         """Returns parent aliases for a list of child IDs.
@@ -132,13 +890,10 @@ class Cache:
 
         """
         self._cache_init()
-        parent_candidates = []
-        for parent, children in self._cache_get_entry(self.CACHE_NAME_PARENTS).items():
-            if set(children).intersection(child_ids):
-                parent_candidates.append(parent)
-        return set(parent_candidates)  # Make unique.
+        child_parents = self._cache_get_entry(self.CACHE_NAME_CHILD_PARENTS)
+        return {child_parents[child_id] for child_id in child_ids if child_id in child_parents}
 
-    def get_children_for(self, parent_alias: str = None, only_with_aliases: bool = False) -> List['CategoryBase']:
+    def get_children_for(self, parent_alias: str = None, only_with_aliases: bool = False) -> List[CategoryRecord]:
         """Returns a list with with categories under the given parent.
 
         :param parent_alias: Parent category alias or None for categories under root
@@ -169,7 +924,7 @@ class Cache:
         self._cache_init()
         return self._cache_get_entry(self.CACHE_NAME_PARENTS, parent_alias, [])
 
-    def get_category_by_alias(self, alias: str) -> Optional['CategoryBase']:
+    def get_category_by_alias(self, alias: str) -> Optional[CategoryRecord]:
         """Returns Category object by its alias.
 
         :param alias:
@@ -178,7 +933,7 @@ class Cache:
         self._cache_init()
         return self._cache_get_entry(self.CACHE_NAME_ALIASES, alias, None)
 
-    def get_category_by_id(self, cid: int) -> Optional['CategoryBase']:
+    def get_category_by_id(self, cid: int) -> Optional[CategoryRecord]:
         """Returns Category object by its id.
 
         :param cid:
@@ -187,25 +942,239 @@ class Cache:
         self._cache_init()
         return self._cache_get_entry(self.CACHE_NAME_IDS, cid, None)
 
-    def find_category(self, parent_alias: str, title: str) -> Optional['CategoryBase']:
+    def get_descendant_ids(self, parent_alias: Optional[str], include_self: bool = False) -> List[int]:
+        """Returns IDs of all categories under the given one (at any depth)
+        in tree order (depth-first, siblings by sort order).
+
+        :param parent_alias: Parent category alias or None for all categories
+        :param include_self: Whether to include parent category ID itself
+
+        """
+        self._cache_init()
+
+        if parent_alias is None:
+            return list(self._cache_get_entry(self.CACHE_NAME_TREE_ORDER))
+
+        category = self.get_category_by_alias(parent_alias)
+
+        if category is None:
+            return []
+
+        return self.get_subtree_ids(category.id, include_self=include_self)
+
+    def get_subtree_ids(self, cid: int, include_self: bool = True) -> List[int]:
+        """Returns IDs of a category with the given ID and all categories under it (at any depth)
+        in tree order (depth-first, siblings by sort order).
+
+        :param cid:
+        :param include_self: Whether to include category ID itself
+
+        """
+        self._cache_init()
+        span = self._cache_get_entry(self.CACHE_NAME_TREE_SPANS, cid, None)
+
+        if span is None:
+            return []
+
+        enter, leave, _ = span
+
+        return self._cache_get_entry(self.CACHE_NAME_TREE_ORDER)[enter if include_self else enter + 1:leave]
+
+    def get_ancestors(self, cid: int) -> List[CategoryRecord]:
+        """Returns ancestors of a category with the given ID
+        starting from the root one down to the direct parent.
+
+        :param cid:
+
+        """
+        self._cache_init()
+        ancestors = []
+
+        category = self.get_category_by_id(cid)
+
+        while category is not None:
+            category = self.get_category_by_id(category.parent_id)
+            if category is not None:
+                ancestors.append(category)
+
+        ancestors.reverse()
+
+        return ancestors
+
+    def get_depth(self, cid: int) -> Optional[int]:
+        """Returns a depth (0 for root categories) of a category with the given ID.
+
+        :param cid:
+
+        """
+        self._cache_init()
+        span = self._cache_get_entry(self.CACHE_NAME_TREE_SPANS, cid, None)
+        return None if span is None else span[2]
+
+    def is_descendant(self, cid: int, ancestor_id: int) -> bool:
+        """Returns flag whether a category with the given ID is located
+        under (at any depth) the other one.
+
+        :param cid: ID of a category to check
+        :param ancestor_id: ID of a supposed ancestor
+
+        """
+        self._cache_init()
+        spans = self._cache_get_entry(self.CACHE_NAME_TREE_SPANS)
+
+        span = spans.get(cid)
+        ancestor_span = spans.get(ancestor_id)
+
+        if span is None or ancestor_span is None:
+            return False
+
+        return ancestor_span[0] < span[0] < ancestor_span[1]
+
+    def find_category(self, parent_alias: str, title: str) -> Optional[CategoryRecord]:
         """Searches parent category children for the given title (case independent).
 
         :param parent_alias:
         :param title:
 
         """
+        self._cache_init()
+        category_id = self._cache_get_entry(self.CACHE_NAME_TITLES, parent_alias, {}).get(title.casefold())
+
+        if category_id is None:
+            return None
+
+        return self.get_category_by_id(category_id)
+
+    def find_categories(self, parent_alias: str, titles: List[str]) -> Dict[str, Optional[CategoryRecord]]:
+        """Searches parent category children for the given titles (case independent).
+        Returns a dict indexed by titles with found categories or None.
+
+        :param parent_alias:
+        :param titles:
+
+        """
+        self._cache_init()
+        parent_titles = self._cache_get_entry(self.CACHE_NAME_TITLES, parent_alias, {})
         get_by_id = self.get_category_by_id
 
-        for cid in self.get_child_ids(parent_alias):
-            category = get_by_id(cid)
-            if category and category.title.lower() == title.lower():
-                return category
+        found = {}
+
+        for title in titles:
+            category_id = parent_titles.get(title.casefold())
+            found[title] = None if category_id is None else get_by_id(category_id)
+
+        return found
+
+    def _ties_stats_key(
+            self,
+            generation: str,
+            category_id: int,
+            ctype_id: Optional[int] = None,
+            object_id: Optional[int] = None
+    ) -> str:
+        """Returns cache entry name for ties stats of a category,
+        optionally narrowed to a content type and an object.
+
+        :param generation:
+        :param category_id:
+        :param ctype_id:
+        :param object_id:
+
+        """
+        return f"{self.CACHE_ENTRY_TIES_STATS}:{generation}:{category_id}:{ctype_id or ''}:{object_id or ''}"
+
+    def _ties_stats_connect(self):
+        """Connects tie model signals listeners maintaining cached ties stats.
+
+        Listeners are connected only if TIES_STATS_CACHE is set, since `post_delete` ones
+        prevent Django from deleting ties in bulk (e.g. on category deletion).
+
+        """
+        tie_model = get_tie_model()
+        signals.post_save.connect(self._ties_stats_add, sender=tie_model)
+        signals.post_delete.connect(self._ties_stats_remove, sender=tie_model)
+
+    def _ties_stats_add(self, instance: 'TieBase', created: bool = False, **kwargs):
+        """Accounts for a saved tie in cached ties stats."""
+
+        if created:
+            self._ties_stats_shift(instance, 1)
+
+        else:
+            # Previous tie state is unknown. Drop all the stats.
+            self.reset_ties_stats()
+
+    def _ties_stats_remove(self, instance: 'TieBase', **kwargs):
+        """Accounts for a deleted tie in cached ties stats."""
+        self._ties_stats_shift(instance, -1)
+
+    def _ties_stats_shift(self, tie: 'TieBase', delta: int):
+        """Increments (decrements) cached ties stats counters for the given tie.
+
+        :param tie:
+        :param delta:
+
+        """
+        generation = self._cache_get_version(self.CACHE_ENTRY_TIES_STATS_GEN)
+        category_id = tie.category_id
+        ctype_id = tie.content_type_id
+
+        for key in (
+            self._ties_stats_key(generation, category_id),
+            self._ties_stats_key(generation, category_id, ctype_id),
+            self._ties_stats_key(generation, category_id, ctype_id, tie.object_id),
+        ):
+            try:
+                cache.incr(key, delta)
+
+            except ValueError:
+                pass  # Not cached yet, will be counted on demand.
+
+    def reset_ties_stats(self):
+        """Drops all cached ties stats."""
+        cache.set(self.CACHE_ENTRY_TIES_STATS_GEN, uuid4().hex, self.CACHE_TIMEOUT)
+
+    def reconcile_ties_stats(self, chunk_size: int = 1000) -> int:
+        """Recounts ties stats for categories and categories in content types
+        and puts them into cache, dropping all previously cached stats.
+        Returns a number of cache entries set.
+
+        Could be run periodically to correct counters drift.
 
-        return None
+        :param chunk_size: Number of entries to put into cache at once.
+
+        """
+        generation = uuid4().hex
+        key = self._ties_stats_key
+
+        totals = {}
+        values = {}
+
+        for item in get_tie_model().objects.values(
+                'category_id', 'content_type_id').annotate(ties_num=Count('category')).order_by():
+
+            category_id = item['category_id']
+            ties_num = item['ties_num']
+
+            values[key(generation, category_id, item['content_type_id'])] = ties_num
+            totals[category_id] = totals.get(category_id, 0) + ties_num
+
+        values.update({key(generation, category_id): ties_num for category_id, ties_num in totals.items()})
+
+        items = list(values.items())
+
+        for idx in range(0, len(items), chunk_size):
+            cache.set_many(dict(items[idx:idx + chunk_size]), self.CACHE_TIMEOUT)
+
+        cache.set(self.CACHE_ENTRY_TIES_STATS_GEN, generation, self.CACHE_TIMEOUT)
+
+        return len(items)
 
     def get_ties_stats(self, categories: List[int], target_model: Optional[Model] = None) -> Dict[int, int]:
         """Returns a dict with categories popularity stats.
 
+        If TIES_STATS_CACHE is set stats are taken from cache when possible.
+
         :param categories:
         :param target_model:
 
@@ -214,6 +1183,9 @@ class Cache:
             'category_id__in': categories
         }
 
+        ctype_id = None
+        object_id = None
+
         if target_model is not None:
             is_cls = hasattr(target_model, '__name__')
 
@@ -222,30 +1194,119 @@ class Cache:
 
             else:
                 concrete = True
-                filter_kwargs['object_id'] = target_model.id
+                object_id = filter_kwargs['object_id'] = target_model.id
 
             filter_kwargs['content_type'] = ContentType.objects.get_for_model(
                 target_model, for_concrete_model=concrete
             )
+            ctype_id = filter_kwargs['content_type'].id
+
+        def count(filter_kwargs):
+            return {
+                item['category_id']: item['ties_num'] for item in
+                get_tie_model().objects.filter(
+                    **filter_kwargs).values('category_id').annotate(ties_num=Count('category'))
+            }
+
+        if not TIES_STATS_CACHE:
+            return count(filter_kwargs)
+
+        generation = self._cache_get_version(self.CACHE_ENTRY_TIES_STATS_GEN)
+
+        keys = {
+            self._ties_stats_key(generation, category_id, ctype_id, object_id): category_id
+            for category_id in categories
+        }
 
-        return {
-            item['category_id']: item['ties_num'] for item in
+        cached = cache.get_many(list(keys))
+        stats = {keys[key]: ties_num for key, ties_num in cached.items()}
+
+        missing = [category_id for key, category_id in keys.items() if key not in cached]
+
+        if missing:
+            filter_kwargs['category_id__in'] = missing
+            counted = count(filter_kwargs)
+
+            # Zeros are cached too.
+            counted = {category_id: counted.get(category_id, 0) for category_id in missing}
+            cache.set_many({
+                self._ties_stats_key(generation, category_id, ctype_id, object_id): ties_num
+                for category_id, ties_num in counted.items()
+            }, self.CACHE_TIMEOUT)
+
+            stats.update(counted)
+
+        return {category_id: ties_num for category_id, ties_num in stats.items() if ties_num > 0}
+
+    def get_facet_counts(
+            self,
+            queryset: QuerySet,
+            parent_aliases: List[Optional[str]],
+            cache_timeout: Optional[int] = None
+    ) -> Dict[int, int]:
+        """Returns a dict with numbers of objects from the given queryset
+        associated with each subcategory of the given parent categories.
+        Objects are counted with one grouped query.
+
+            # How many search results are in each `brand` subcategory.
+            counts = get_cache().get_facet_counts(Article.objects.filter(title__contains='x'), ['brand'])
+
+        :param queryset: QuerySet of objects (`ModelWithCategory` heirs) to count.
+        :param parent_aliases: Parent categories aliases. None stands for root categories.
+        :param cache_timeout: Number of seconds to cache counts for. If not set, counts are not cached.
+            Cache entry is tied to the queryset SQL and the categories tree version,
+            yet counts may lag behind ties changes for that time.
+
+        """
+        category_ids = []
+
+        for parent_alias in parent_aliases:
+            category_ids.extend(self.get_child_ids(parent_alias))
+
+        if not category_ids:
+            return {}
+
+        key = None
+
+        if cache_timeout:
+            sql, params = queryset.query.sql_with_params()
+            digest = md5(f'{queryset.db}:{sql}:{params!r}:{category_ids!r}'.encode()).hexdigest()
+            key = f'{self.CACHE_ENTRY_FACETS}:{self._cache_get_version()}:{digest}'
+
+            counts = cache.get(key)
+
+            if counts is not None:
+                return counts
+
+        counts = {
+            item['category_id']: item['objects_num'] for item in
             get_tie_model().objects.filter(
-                **filter_kwargs).values('category_id').annotate(ties_num=Count('category'))
+                content_type=ContentType.objects.get_for_model(queryset.model, for_concrete_model=False),
+                category_id__in=category_ids,
+                object_id__in=queryset.order_by().values('pk'),
+            ).values('category_id').annotate(objects_num=Count('object_id', distinct=True)).order_by()
         }
 
+        if key:
+            cache.set(key, counts, cache_timeout)
+
+        return counts
+
     def get_categories(
             self,
             parent_aliases: Optional[Union[str, List[str]]] = None,
             target_object: 'ModelWithCategory' = None,
-            tied_only: bool = True
+            tied_only: bool = True,
+            ties_stats: Dict[int, int] = None
     ):
         """Returns subcategories (or ties if `target_object` is set)
         for the given parent category.
 
         :param parent_aliases:
         :param target_object:
-        :param tied_only: Flag to get only categories with ties. Ties stats are stored in `ties_num` attrs.
+        :param tied_only: Flag to get only categories with ties. Categories are wrapped into `TiedCategory`
+            objects with ties stats in `ties_num` attrs.
+        :param ties_stats: Precalculated ties stats (see `get_ties_stats()`) to use for `tied_only`.
 
         """
         single_mode = False
@@ -266,7 +1327,7 @@ class Cache:
         ties = {}
         if tied_only:
             source = {}
-            ties = self.get_ties_stats(all_children, target_object)
+            ties = ties_stats if ties_stats is not None else self.get_ties_stats(all_children, target_object)
             for parent_alias, child_ids in parents_to_children.items():
                 common = set(ties.keys()).intersection(child_ids)
                 if common:
@@ -283,7 +1344,8 @@ class Cache:
                 cat = self.get_category_by_id(cat_id)
 
                 if tied_only:
-                    cat.ties_num = ties.get(cat_id, 0)
+                    # Records are shared, so stats are put into a wrapper.
+                    cat = TiedCategory(cat, ties.get(cat_id, 0))
 
                 if parent_alias not in categories:
                     categories[parent_alias] = []